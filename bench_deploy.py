@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Deploy Benchmark - 以合成的 skills 資料量測 deploy.py 的效能
+
+產生指定數量的 skills、檔案與檔案大小分佈，對多個 targets 依序執行
+cold (全新部署)、warm (部分檔案變更後) 與 no-op (沒有任何變更) 三個階段，
+記錄每個階段的 wall time、寫入的 bytes 與檔案操作數到 JSON 檔案。
+
+使用方式:
+    python bench_deploy.py
+    python bench_deploy.py --skills 200 --files 30 --targets 3 --strategy hardlink
+    python bench_deploy.py --sizes lognormal:4096:1.5 --output results.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+from deploy import COPY_MODES, STRATEGIES, TargetResult, link_skills
+
+# 每個 skill 中的子目錄，模擬 SKILL.md + references + assets 的結構
+SUBDIRS = ("", "references", "assets")
+
+
+def parse_size_distribution(spec: str, rng: random.Random):
+    """
+    解析檔案大小分佈，返回產生大小 (bytes) 的函式
+
+    支援格式:
+    - fixed:N              每個檔案 N bytes
+    - uniform:MIN:MAX      MIN 到 MAX 之間均勻分佈
+    - lognormal:MEDIAN:SIGMA  以 MEDIAN 為中位數的 log-normal 分佈 (接近真實文件大小)
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(":")] if params else []
+    if kind == "fixed" and len(values) == 1:
+        return lambda: int(values[0])
+    if kind == "uniform" and len(values) == 2:
+        return lambda: rng.randint(int(values[0]), int(values[1]))
+    if kind == "lognormal" and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda: max(1, int(rng.lognormvariate(mu, values[1])))
+    raise ValueError(f"無效的檔案大小分佈: {spec}")
+
+
+def generate_workload(
+    root: Path,
+    skills: int,
+    files_per_skill: int,
+    sizes: str,
+    targets: int,
+    strategy: str = "copy",
+    seed: int = 0,
+) -> Path:
+    """
+    產生合成的 source 目錄與 config
+
+    Returns:
+        config 檔案路徑
+    """
+    rng = random.Random(seed)
+    next_size = parse_size_distribution(sizes, rng)
+    source_dir = root / "source"
+
+    skill_names = [f"skill-{index:04d}" for index in range(skills)]
+    for name in skill_names:
+        skill_dir = source_dir / name
+        for subdir in SUBDIRS:
+            (skill_dir / subdir).mkdir(parents=True, exist_ok=True)
+        (skill_dir / "SKILL.md").write_bytes(rng.randbytes(next_size()))
+        for index in range(files_per_skill - 1):
+            subdir = SUBDIRS[1 + index % (len(SUBDIRS) - 1)]
+            (skill_dir / subdir / f"file-{index:04d}.md").write_bytes(rng.randbytes(next_size()))
+
+    target_sections = "".join(
+        f'\n[targets.target{index}]\npath = "{root / f"target{index}"}"\n'
+        f'enabled = true\nstrategy = "{strategy}"\n'
+        for index in range(targets)
+    )
+    config_path = root / "bench_config.toml"
+    config_path.write_text(
+        f"skills = {json.dumps(skill_names)}\n\n"
+        f'[store]\npath = "{root / "store"}"\n\n'
+        f'[sources]\npaths = ["{source_dir}"]\n'
+        f"{target_sections}"
+    )
+    return config_path
+
+
+def modify_workload(root: Path, ratio: float, seed: int = 1) -> int:
+    """
+    重寫 source 中 ratio 比例的檔案內容 (大小不變)，模擬編輯
+
+    Returns:
+        修改的檔案數
+    """
+    rng = random.Random(seed)
+    files = sorted(path for path in (root / "source").rglob("*") if path.is_file())
+    changed = rng.sample(files, max(1, int(len(files) * ratio))) if files else []
+    for path in changed:
+        path.write_bytes(rng.randbytes(path.stat().st_size))
+    return len(changed)
+
+
+def _summarize(results: list[TargetResult], elapsed: float) -> dict[str, Any]:
+    """將 link_skills 的結果整理成一個階段的量測數據"""
+    bytes_written = 0
+    file_ops = 0
+    synced = 0
+    unchanged = 0
+    for result in results:
+        synced += result.count("synced")
+        unchanged += result.count("unchanged")
+        file_ops += result.removed
+        for skill in result.skills:
+            bytes_written += skill.stats.bytes_copied
+            file_ops += skill.stats.files_copied + skill.stats.files_deleted
+    return {
+        "wall_time_s": round(elapsed, 6),
+        "bytes_written": bytes_written,
+        "file_ops": file_ops,
+        "skills_synced": synced,
+        "skills_unchanged": unchanged,
+    }
+
+
+def run_phase(config_path: Path, **deploy_options: Any) -> dict[str, Any]:
+    """執行一次 link_skills 並量測，deploy 本身的輸出會被捨棄"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        results = link_skills(config_path, **deploy_options)
+        elapsed = time.perf_counter() - start
+    return _summarize(results, elapsed)
+
+
+def measure_cold_start(config_path: Path, runs: int) -> dict[str, Any]:
+    """
+    以新的 interpreter 執行 no-op 部署 runs 次，量測包含 interpreter 啟動與 import 的時間
+
+    分別量測 console script (import deploy)、python deploy.py (每次重新編譯)，
+    以及 make zipapp 建立的 dist/deploy.pyz (預先編譯，存在時才量測)。
+    """
+    deploy_script = Path(__file__).with_name("deploy.py")
+    zipapp = deploy_script.with_name("dist") / "deploy.pyz"
+    commands = {
+        "console_script": [
+            sys.executable,
+            "-c",
+            "import sys, deploy; sys.argv[0] = 'deploy'; deploy.main()",
+            str(config_path),
+        ],
+        "script": [sys.executable, str(deploy_script), str(config_path)],
+    }
+    if zipapp.exists():
+        commands["zipapp"] = [sys.executable, str(zipapp), str(config_path)]
+    env = dict(os.environ, PYTHONPATH=str(deploy_script.parent))
+    timings: dict[str, Any] = {}
+    for name, command in commands.items():
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, env=env)
+            samples.append(time.perf_counter() - start)
+        timings[name] = {
+            "median_s": round(statistics.median(samples), 6),
+            "min_s": round(min(samples), 6),
+        }
+    return timings
+
+
+def run_benchmark(
+    skills: int = 50,
+    files_per_skill: int = 10,
+    sizes: str = "lognormal:4096:1.0",
+    targets: int = 3,
+    strategy: str = "copy",
+    copy_mode: str = "auto",
+    jobs: int = 1,
+    atomic: bool = True,
+    change_ratio: float = 0.1,
+    seed: int = 0,
+    work_dir: Path | None = None,
+    cold_start_runs: int = 0,
+) -> dict[str, Any]:
+    """
+    產生 workload 並依序執行 cold、warm、no-op 三個階段
+
+    cold_start_runs > 0 時，另外以新的 process 執行 no-op 部署量測冷啟動時間。
+
+    Returns:
+        包含參數、環境與每個階段量測數據的 dict
+    """
+    with tempfile.TemporaryDirectory(dir=work_dir, prefix="deploy-bench-") as tmp:
+        root = Path(tmp)
+        config_path = generate_workload(
+            root, skills, files_per_skill, sizes, targets, strategy, seed
+        )
+        deploy_options = {"jobs": jobs, "copy_mode": copy_mode, "atomic": atomic}
+
+        phases = {"cold": run_phase(config_path, **deploy_options)}
+        changed_files = modify_workload(root, change_ratio, seed + 1)
+        phases["warm"] = run_phase(config_path, **deploy_options)
+        phases["warm"]["files_modified"] = changed_files
+        phases["noop"] = run_phase(config_path, **deploy_options)
+        cold_start = measure_cold_start(config_path, cold_start_runs) if cold_start_runs else None
+
+    return {
+        "params": {
+            "skills": skills,
+            "files_per_skill": files_per_skill,
+            "sizes": sizes,
+            "targets": targets,
+            "strategy": strategy,
+            "copy_mode": copy_mode,
+            "jobs": jobs,
+            "atomic": atomic,
+            "change_ratio": change_ratio,
+            "seed": seed,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "phases": phases,
+        "cold_start": cold_start,
+    }
+
+
+def main():
+    """主程式入口"""
+    parser = argparse.ArgumentParser(description="以合成的 skills 資料量測 deploy.py 的效能")
+    parser.add_argument("--skills", type=int, default=50, help="skill 數量 (預設: 50)")
+    parser.add_argument("--files", type=int, default=10, help="每個 skill 的檔案數 (預設: 10)")
+    parser.add_argument(
+        "--sizes",
+        default="lognormal:4096:1.0",
+        help="檔案大小分佈：fixed:N、uniform:MIN:MAX、lognormal:MEDIAN:SIGMA "
+        "(預設: lognormal:4096:1.0)",
+    )
+    parser.add_argument("--targets", type=int, default=3, help="target 數量 (預設: 3)")
+    parser.add_argument("--strategy", choices=STRATEGIES, default="copy", help="部署方式")
+    parser.add_argument("--copy-mode", choices=COPY_MODES, default="auto", help="檔案複製方式")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="worker 數量 (預設: 1)")
+    parser.add_argument("--no-atomic", dest="atomic", action="store_false", help="不使用 staging")
+    parser.add_argument(
+        "--change-ratio", type=float, default=0.1, help="warm 階段修改的檔案比例 (預設: 0.1)"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="亂數種子 (預設: 0)")
+    parser.add_argument(
+        "--cold-start",
+        type=int,
+        default=0,
+        metavar="RUNS",
+        help="以新的 process 執行 no-op 部署 RUNS 次，量測冷啟動時間 (預設: 不量測)",
+    )
+    parser.add_argument(
+        "--work-dir", type=Path, default=None, help="產生 workload 的目錄 (預設: 系統暫存目錄)"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=Path("bench_results.json"),
+        help="結果 JSON 檔案 (預設: bench_results.json)",
+    )
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        skills=args.skills,
+        files_per_skill=args.files,
+        sizes=args.sizes,
+        targets=args.targets,
+        strategy=args.strategy,
+        copy_mode=args.copy_mode,
+        jobs=args.jobs,
+        atomic=args.atomic,
+        change_ratio=args.change_ratio,
+        seed=args.seed,
+        work_dir=args.work_dir,
+        cold_start_runs=args.cold_start,
+    )
+    args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False) + "\n")
+
+    for phase, data in report["phases"].items():
+        print(
+            f"{phase:>5}: {data['wall_time_s'] * 1000:9.1f} ms  "
+            f"{data['bytes_written']:>12} bytes  {data['file_ops']:>7} file ops"
+        )
+    for command, data in (report["cold_start"] or {}).items():
+        print(f"cold start ({command}): {data['median_s'] * 1000:.1f} ms (median)")
+    print(f"✓ 結果已寫入: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,11 +10,105 @@ Skill Copier - 從 skills 資料庫複製 skills 到各 IDE 的 skills 目錄
 預設 config 檔案: ./skills_config.toml
 """
 
+import contextlib
+import errno
+import functools
+import itertools
+import json
+import os
+import re
 import shutil
+import stat
 import sys
-import tomllib
+import threading
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any
+from typing import Any, NamedTuple
+
+# 每個 target 的部署方式：完整複製、每個檔案 hardlink、整個 skill 目錄 symlink、
+# 或從 content-addressed store 以 hardlink (跨檔案系統時 reflink/複製) 建立
+STRATEGIES = ("copy", "hardlink", "symlink", "store")
+
+# watch 模式：inotify 監看的事件 (見 inotify(7))
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+
+# deploy 在 target 目錄中建立的暫存項目 (staging 目錄等) 都以此為前綴
+INTERNAL_PREFIX = ".deploy-"
+
+# renameat2(2) 的 RENAME_EXCHANGE：原子性地交換兩個路徑
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+# capget/capset(2)：setfsuid 換成一般使用者後加回 CAP_DAC_READ_SEARCH，仍可讀取 sources
+LINUX_CAPABILITY_VERSION_3 = 0x20080522
+CAP_DAC_READ_SEARCH = 2
+
+# 檔案複製方式：auto 依序嘗試 reflink、copy_file_range，最後才一般複製
+COPY_MODES = ("auto", "reflink", "copy")
+
+# Linux ioctl FICLONE (_IOW(0x94, 9, int))：在 btrfs/XFS 等檔案系統上以 copy-on-write 複製檔案
+FICLONE = 0x40049409
+
+# FICLONE / copy_file_range 回報「此檔案系統 (或 kernel) 不支援」時的 errno，其他錯誤照常拋出
+CLONE_UNSUPPORTED_ERRNOS = frozenset(
+    {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS}
+)
+
+# 已知不支援 FICLONE / copy_file_range 的 (source 裝置, target 裝置)，
+# 每組裝置只會失敗一次，之後的檔案直接使用下一種方式
+_reflink_unsupported: set[tuple[int, int]] = set()
+_copy_range_unsupported: set[tuple[int, int]] = set()
+
+# config 旁邊的快取目錄 (skill 解析結果等)，可隨時刪除
+CACHE_DIR_NAME = ".deploy-cache"
+RESOLVE_CACHE_VERSION = 1
+PLAN_CACHE_VERSION = 4
+# 會影響路徑展開結果的環境變數 (~ 與預設的 store 目錄)，是 plan 快取 key 的一部分
+PLAN_ENV_VARS = ("HOME", "XDG_CACHE_HOME")
+
+# 每個 target 的部署狀態 (manifest 等) 放在 target 旁邊的隱藏目錄，
+# 讓 target 目錄本身只包含 config 中定義的 skills
+STATE_SUFFIX = ".deploy"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# target path 中可使用的樣板變數，搭配 homes (home 目錄的 glob) 展開成多個 targets
+TEMPLATE_VARS = ("{home}", "{user}")
+
+# skill 目錄中的排除規則檔 (gitignore 格式)，與 config 的 exclude、skill_exclude 合併
+SKILLIGNORE_NAME = ".skillignore"
+
+# 超過這個大小的檔案以 mmap 計算 digest
+MMAP_THRESHOLD = 1 << 20
+
+# 狀態目錄中的 trash：要刪除的目錄先 rename 到這裡 (O(1))，再於背景或下次執行時刪除
+TRASH_NAME = "trash"
+
+# 狀態目錄中的 staging 區：staged 部署在這裡建立新版本，再 rename 換到 target，
+# 建立中的目錄與換下來的舊目錄都不會出現在 target 中 (IDE agents 看不到)
+STAGE_NAME = "stage"
 
 
 def log(message: str, verbose: bool = False, force: bool = False):
@@ -23,292 +117,3920 @@ def log(message: str, verbose: bool = False, force: bool = False):
         print(message)
 
 
-def find_skill_in_sources(skill_name: str, source_dirs: list[Path]) -> Path | None:
+class Tracer:
+    """
+    以 Chrome trace-event 格式記錄巢狀的 spans (可在 chrome://tracing 或 Perfetto 中檢視)
+
+    每個 span 是一個 complete event ("ph": "X")，同一個 thread 中的 spans 依時間自動巢狀。
+    """
+
+    def __init__(self):
+        self.events: list[dict[str, Any]] = []
+        self._threads: dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter_ns()
+        self._pid = os.getpid()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args: Any):
+        """記錄 with 區塊的執行時間；args 會顯示在 trace viewer 的詳細資訊中"""
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            thread = threading.current_thread()
+            event = {
+                "name": name,
+                "cat": "deploy",
+                "ph": "X",
+                "ts": (start - self._origin) / 1000,
+                "dur": (end - start) / 1000,
+                "pid": self._pid,
+                "tid": thread.native_id,
+            }
+            if args:
+                event["args"] = {
+                    key: value if isinstance(value, int | float | str) else str(value)
+                    for key, value in args.items()
+                }
+            with self._lock:
+                self.events.append(event)
+                self._threads.setdefault(thread.native_id, thread.name)
+
+    def save(self, path: Path):
+        """寫入 trace 檔案 (JSON object 格式，附上 thread 名稱)"""
+        with self._lock:
+            metadata = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self._pid,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for tid, name in self._threads.items()
+            ]
+            events = metadata + sorted(self.events, key=lambda event: event["ts"])
+        path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}) + "\n")
+
+
+# 目前啟用的 tracer；None 時 span() 只返回共用的 nullcontext，幾乎沒有額外成本
+_tracer: Tracer | None = None
+_NO_SPAN = contextlib.nullcontext()
+
+
+def start_tracing() -> Tracer:
+    """啟用 tracing，之後的 span() 都會記錄到返回的 tracer"""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop_tracing() -> Tracer | None:
+    """停用 tracing，返回原本的 tracer"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def span(name: str, **args: Any) -> contextlib.AbstractContextManager:
+    """tracing 啟用時記錄一個 span，停用時不做任何事"""
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.span(name, **args)
+
+
+def traced(name: str):
+    """decorator：將整個函式呼叫記錄為一個 span"""
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def find_skill_in_sources(skill_name: str, source_dirs: list[Path]) -> Path | None:
+    """
+    在多個 source 目錄中搜尋 skill
+
+    Args:
+        skill_name: skill 名稱
+        source_dirs: source 目錄列表
+
+    Returns:
+        找到的 skill 路徑，找不到則返回 None
+    """
+    for source_dir in source_dirs:
+        skill_path = source_dir / skill_name
+        if skill_path.exists() and skill_path.is_dir():
+            return skill_path
+    return None
+
+
+def _exclude_regex(pattern: str) -> str:
+    """
+    將一個 gitignore 格式的 pattern 轉成 regex
+
+    比對的是 skill 目錄中的相對路徑，目錄以 / 結尾；pattern 以 / 結尾時只比對目錄，
+    開頭或中間有 / 時從 skill 根目錄比對，否則比對任何深度的名稱。
+    """
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    parts = ["" if anchored else "(?:.*/)?"]
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and pattern.find("]", i + 1) > i + 1:
+            end = pattern.find("]", i + 1)
+            body = pattern[i + 1 : end]
+            parts.append("[" + ("^" + body[1:] if body.startswith("!") else body) + "]")
+            i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    parts.append("/" if dir_only else "/?")
+    return "".join(parts)
+
+
+def compile_excludes(patterns: list[str]) -> re.Pattern[str] | None:
+    """
+    將 gitignore 格式的 patterns 編譯成一個 regex，每個路徑只需要比對一次
+
+    支援 *、?、**、[...]、開頭的 / (從根目錄比對)、結尾的 / (只比對目錄)、
+    # 註解與 ! (重新包含)；與 gitignore 相同，以最後一個符合的規則為準。
+
+    Returns:
+        以 match 比對相對路徑 (目錄加上結尾的 /) 的 regex；沒有排除規則時為 None
+    """
+    rules = []
+    for line in patterns:
+        pattern = line.strip()
+        if not pattern or pattern.startswith("#"):
+            continue
+        # ! 開頭為重新包含；\ 跳脫開頭的 ! 或 #
+        negated = pattern.startswith("!")
+        if negated or pattern.startswith("\\"):
+            pattern = pattern[1:]
+        rules.append((negated, _exclude_regex(pattern)))
+
+    # 由後往前：每組連續的排除規則只在之後的 ! 規則都不符合時才排除
+    alternatives = []
+    excluded: list[str] = []
+    included: list[str] = []
+    # 結尾的 (True, None) 用來送出最前面的一組排除規則
+    for negated, regex in [*reversed(rules), (True, None)]:
+        if not negated:
+            excluded.append(regex)
+            continue
+        if excluded:
+            negation = f"(?!(?:{'|'.join(included)})\\Z)" if included else ""
+            alternatives.append(f"{negation}(?:{'|'.join(reversed(excluded))})")
+            excluded = []
+        if regex is not None:
+            included.append(regex)
+    if not alternatives:
+        return None
+    return re.compile(f"(?:{'|'.join(reversed(alternatives))})\\Z")
+
+
+def skill_excludes(
+    skill_path: Path, exclude: list[str], skill_exclude: dict[str, list[str]]
+) -> re.Pattern[str] | None:
+    """
+    skill 的排除規則：config 的 exclude、skill_exclude 中這個 skill 的規則與 .skillignore
+
+    .skillignore 本身也不會被部署。
+    """
+    patterns = [*exclude, *skill_exclude.get(skill_path.name, [])]
+    try:
+        ignore_file = (skill_path / SKILLIGNORE_NAME).read_text(encoding="utf-8")
+    except OSError:
+        pass
+    else:
+        patterns += [f"/{SKILLIGNORE_NAME}", *ignore_file.splitlines()]
+    return compile_excludes(patterns)
+
+
+def build_source_index(source_dirs: list[Path]) -> dict[str, Path]:
+    """
+    建立 skill 名稱到路徑的索引
+
+    每個 source 目錄只做一次 os.scandir (DirEntry 通常不需額外 stat)，
+    之後的查詢都是 O(1)；與 find_skill_in_sources 相同，先列出的 source 優先。
+
+    Args:
+        source_dirs: source 目錄列表
+
+    Returns:
+        {skill 名稱: skill 路徑}；不存在的 source 目錄會被略過
+    """
+    index: dict[str, Path] = {}
+    for source_dir in source_dirs:
+        try:
+            with os.scandir(source_dir) as entries:
+                for entry in entries:
+                    if entry.name not in index and entry.is_dir():
+                        index[entry.name] = source_dir / entry.name
+        except OSError:
+            continue
+    return index
+
+
+def config_cache_dir(config_path: Path) -> Path:
+    """config 檔案旁邊的快取目錄"""
+    return config_path.parent / CACHE_DIR_NAME
+
+
+def _dir_fingerprint(path: Path) -> list[int] | None:
+    """目錄的 (st_dev, st_ino, st_mtime_ns)；目錄中新增、刪除或改名項目時 mtime 會改變"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_dev, st.st_ino, st.st_mtime_ns]
+
+
+def resolve_skills(
+    config_path: Path, skill_names: list[str], source_dirs: list[Path], write_cache: bool = True
+) -> tuple[dict[str, Path], list[str]]:
+    """
+    將 skill 名稱解析為來源路徑，結果快取在 config 旁的 .deploy-cache 中
+
+    快取以 config 路徑、skills 列表、source 目錄列表與每個 source 目錄的
+    fingerprint 為 key；source 目錄中新增、刪除或改名項目都會改變它的 mtime，
+    使快取自動失效。快取有效時完全不需要掃描 source 目錄。
+
+    Args:
+        config_path: config 檔案路徑
+        skill_names: 要解析的 skill 名稱
+        source_dirs: source 目錄列表 (先列出的優先)
+        write_cache: 是否寫入新的快取
+
+    Returns:
+        ({skill 名稱: 路徑} (依 skill_names 順序), 找不到的 skill 名稱)
+    """
+    cache_path = config_cache_dir(config_path) / f"resolve-{config_path.name}.json"
+    key = {
+        "version": RESOLVE_CACHE_VERSION,
+        "config": str(config_path.resolve()),
+        "skills": skill_names,
+        "sources": [str(source_dir) for source_dir in source_dirs],
+        "fingerprints": [_dir_fingerprint(source_dir) for source_dir in source_dirs],
+    }
+
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cached = json.load(f)
+        if {name: cached.get(name) for name in key} == key:
+            resolved = {name: Path(path) for name, path in cached["resolved"].items()}
+            return resolved, cached["not_found"]
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+
+    source_index = build_source_index(source_dirs)
+    resolved = {}
+    not_found = []
+    for skill_name in skill_names:
+        skill_path = source_index.get(skill_name)
+        if skill_path:
+            resolved[skill_name] = skill_path
+        else:
+            not_found.append(skill_name)
+
+    if write_cache:
+        cached = dict(key, resolved={name: str(path) for name, path in resolved.items()})
+        cached["not_found"] = not_found
+        write_cache_file(cache_path, cached)
+
+    return resolved, not_found
+
+
+def write_cache_file(cache_path: Path, data: dict[str, Any]):
+    """以 write-then-rename 寫入 .deploy-cache 中的快取；寫入失敗時忽略 (下次重新計算)"""
+    try:
+        cache_path.parent.mkdir(exist_ok=True)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+
+class FileStat(NamedTuple):
+    """檔案的 stat 摘要，用來快速判斷內容是否變更"""
+
+    size: int
+    mtime_ns: int
+    mode: int
+    dev: int = 0
+    ino: int = 0
+
+
+@dataclass
+class SyncStats:
+    """一次同步實際執行的檔案操作統計"""
+
+    files_copied: int = 0
+    bytes_copied: int = 0
+    files_deleted: int = 0
+    # 實際使用的複製方式與次數，例如 {"reflink": 3}
+    copy_methods: dict[str, int] = field(default_factory=dict)
+    # staged 部署換下來的舊目錄，由呼叫端在之後刪除
+    replaced_tree: Path | None = None
+
+
+class SourceCache:
+    """
+    一次部署中所有 targets 共用的 source 掃描與 digest 快取
+
+    同一個 skill 部署到多個 targets (例如展開成數百個 home 目錄) 時，
+    每個 source 目錄只掃描一次、每個檔案的內容只讀一次計算 digest。
+    """
+
+    def __init__(
+        self, exclude: list[str] | None = None, skill_exclude: dict[str, list[str]] | None = None
+    ):
+        self._exclude = exclude or []
+        self._skill_exclude = skill_exclude or {}
+        self._scans: dict[Path, tuple[dict[str, FileStat], set[str]]] = {}
+        self._digests: dict[tuple[str, int, int, int], str] = {}
+        self._lock = threading.Lock()
+
+    def scan(self, root: Path) -> tuple[dict[str, FileStat], set[str]]:
+        """scan_tree(root) 的結果與子目錄 set；排除符合 exclude 規則的項目 (見 skill_excludes)"""
+        with self._lock:
+            cached = self._scans.get(root)
+        if cached is None:
+            dirs: set[str] = set()
+            exclude = skill_excludes(root, self._exclude, self._skill_exclude)
+            cached = (scan_tree(root, dirs, exclude=exclude), dirs)
+            with self._lock:
+                cached = self._scans.setdefault(root, cached)
+        return cached
+
+    def digest(self, path: Path, st: FileStat) -> str:
+        """file_digest(path)；以 (路徑, size, mtime, inode) 為 key"""
+        key = (str(path), st.size, st.mtime_ns, st.ino)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            digest = file_digest(path)
+            with self._lock:
+                self._digests[key] = digest
+        return digest
+
+
+@dataclass
+class TreeDiff:
+    """dry-run 時 source 與 target 的檔案層級差異：每一項是 (相對路徑, bytes)"""
+
+    added: list[tuple[str, int]] = field(default_factory=list)
+    modified: list[tuple[str, int]] = field(default_factory=list)
+    deleted: list[tuple[str, int]] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.modified or self.deleted)
+
+
+@dataclass
+class DeployOptions:
+    """一次部署中所有 targets 共用的執行選項"""
+
+    dry_run: bool = False
+    verbose: bool = False
+    copy_mode: str = "auto"
+    store_dir: Path | None = None
+    atomic: bool = True
+    checksum: bool = False  # dry-run 時以內容 digest 判斷檔案是否修改
+    force: bool = False  # 不使用 manifest 與 target 中的檔案，重新複製所有 skills
+    sources: SourceCache = field(default_factory=SourceCache)
+
+
+@dataclass
+class SkillResult:
+    """單一 (target, skill) 的同步結果"""
+
+    name: str
+    status: str = ""  # "synced"、"unchanged"、"skipped" 或 "failed"
+    messages: list[str] = field(default_factory=list)
+    entry: dict[str, Any] | None = None
+    stats: SyncStats = field(default_factory=SyncStats)
+    error: str = ""
+    duration: float = 0.0  # 同步這個 skill 花費的秒數
+    diff: TreeDiff | None = None  # dry-run 時會新增、修改與刪除的檔案
+
+
+@dataclass
+class TargetResult:
+    """單一 target 的部署結果"""
+
+    name: str
+    base_dir: Path
+    strategy: str = "copy"
+    messages: list[str] = field(default_factory=list)
+    manifest: dict[str, Any] = field(default_factory=dict)
+    removed: int = 0
+    skills: list[SkillResult] = field(default_factory=list)
+    device: int = 0  # target 目錄所在裝置的 st_dev，用來依裝置排程 I/O
+    owner: Path | None = None  # 樣板 target 的 home 目錄，以 root 執行時 chown 給它的擁有者
+    # 處理這個 target 花費的秒數 (準備、各 skills 與收尾的時間加總，與 jobs 數無關)
+    duration: float = 0.0
+    error: str = ""  # 整個 target 沒有部署的原因 (例如超過 max_tokens)
+
+    def count(self, status: str) -> int:
+        """計算指定狀態的 skill 數量"""
+        return sum(1 for skill in self.skills if skill.status == status)
+
+    def total(self, stat: str) -> int:
+        """所有 skills 的 SyncStats 欄位加總，例如 total("bytes_copied")"""
+        return sum(getattr(skill.stats, stat) for skill in self.skills)
+
+    def copy_methods(self) -> dict[str, int]:
+        """所有 skills 實際使用的複製方式與檔案數"""
+        methods: dict[str, int] = {}
+        for skill in self.skills:
+            for method, count in skill.stats.copy_methods.items():
+                methods[method] = methods.get(method, 0) + count
+        return methods
+
+
+def scan_tree(
+    root: Path,
+    dirs: set[str] | None = None,
+    follow_symlinks: bool = True,
+    exclude: re.Pattern[str] | None = None,
+) -> dict[str, FileStat]:
+    """
+    用 os.scandir 遞迴掃描目錄中的所有檔案
+
+    Args:
+        root: 要掃描的目錄
+        dirs: 若提供，會將所有子目錄的相對路徑加入此 set
+        follow_symlinks: 是否跟隨 symlink；掃描 target 時應為 False，
+            讓 symlink 被當成需要替換的檔案，而不是走進它指向的目錄
+        exclude: compile_excludes 的結果；符合的檔案略過，符合的目錄不會進入
+
+    Returns:
+        {相對路徑 (POSIX 格式): FileStat}
+    """
+    files: dict[str, FileStat] = {}
+    stack = [(root, "")]
+    while stack:
+        current, prefix = stack.pop()
+        with os.scandir(current) as entries:
+            for entry in entries:
+                rel = f"{prefix}{entry.name}"
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    if exclude is not None and exclude.match(f"{rel}/"):
+                        continue
+                    if dirs is not None:
+                        dirs.add(rel)
+                    stack.append((Path(entry.path), f"{rel}/"))
+                elif exclude is None or not exclude.match(rel):
+                    st = entry.stat(follow_symlinks=follow_symlinks)
+                    files[rel] = FileStat(
+                        st.st_size, st.st_mtime_ns, st.st_mode, st.st_dev, st.st_ino
+                    )
+    return files
+
+
+def _clone_file(
+    source_fd: int, destination_fd: int, copy_mode: str, devices: tuple[int, int]
+) -> str:
+    """
+    嘗試以 kernel 端的方式複製檔案內容，已知這組裝置不支援的方式不再嘗試
+
+    Returns:
+        使用的方式："reflink" 或 "copy_file_range"
+
+    Raises:
+        OSError: 檔案系統不支援時 errno 屬於 CLONE_UNSUPPORTED_ERRNOS；其他 I/O 錯誤原樣拋出
+    """
+    if devices not in _reflink_unsupported:
+        try:
+            import fcntl
+
+            fcntl.ioctl(destination_fd, FICLONE, source_fd)
+            return "reflink"
+        except ImportError:
+            _reflink_unsupported.add(devices)
+        except OSError as e:
+            if e.errno not in CLONE_UNSUPPORTED_ERRNOS:
+                raise
+            _reflink_unsupported.add(devices)
+
+    if copy_mode == "reflink" or devices in _copy_range_unsupported:
+        raise OSError(errno.EOPNOTSUPP, "不支援 reflink")
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "不支援 copy_file_range")
+
+    # copy_file_range 在同一個檔案系統上可能直接共用 extents，至少也省去 user space 的緩衝
+    try:
+        while os.copy_file_range(source_fd, destination_fd, 1 << 30) > 0:
+            pass
+    except OSError as e:
+        if e.errno in CLONE_UNSUPPORTED_ERRNOS:
+            _copy_range_unsupported.add(devices)
+        raise
+    return "copy_file_range"
+
+
+def copy_file(source: Path, destination: Path, copy_mode: str = "auto") -> str:
+    """
+    複製單一檔案並保留 metadata (mode、mtime)
+
+    reflink / auto 模式下先嘗試 FICLONE (auto 另外嘗試 os.copy_file_range)，
+    檔案系統不支援時自動改用一般複製；其他錯誤 (目標已存在、I/O 錯誤等) 直接拋出。
+    裝置由已開啟的檔案取得，不需要額外 stat。
+
+    Args:
+        source: 來源檔案
+        destination: 目標檔案 (不可已存在)
+        copy_mode: COPY_MODES 其中之一
+
+    Returns:
+        實際使用的方式："reflink"、"copy_file_range" 或 "copy"
+    """
+    if copy_mode == "copy":
+        shutil.copy2(source, destination)
+        return "copy"
+
+    with open(source, "rb") as src, open(destination, "xb") as dst:
+        devices = (os.fstat(src.fileno()).st_dev, os.fstat(dst.fileno()).st_dev)
+        try:
+            method = _clone_file(src.fileno(), dst.fileno(), copy_mode, devices)
+        except OSError as e:
+            if e.errno not in CLONE_UNSUPPORTED_ERRNOS:
+                raise
+            # 以已開啟的檔案一般複製 (從頭寫入，捨棄失敗前可能寫入的部分)
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            shutil.copyfileobj(src, dst)
+            method = "copy"
+    shutil.copystat(source, destination)
+    return method
+
+
+def link_file(source: Path, destination: Path, copy_mode: str = "auto") -> str:
+    """
+    以 hardlink 建立檔案，只需 metadata 操作，不讀取任何內容
+
+    跨檔案系統或不允許 hardlink 時改用 copy_file。
+
+    Returns:
+        實際使用的方式："hardlink" 或 copy_file 的回傳值
+    """
+    try:
+        os.link(source, destination)
+        return "hardlink"
+    except OSError:
+        return copy_file(source, destination, copy_mode)
+
+
+def _is_up_to_date(current: FileStat | None, st: FileStat, strategy: str) -> bool:
+    """target 檔案是否已與 source 一致 (hardlink 需指向同一個 inode)"""
+    if current is None:
+        return False
+    linked = strategy in ("hardlink", "store")
+    if linked and (current.dev, current.ino) == (st.dev, st.ino):
+        return True
+    # hardlink 失敗改用複製時 (例如跨檔案系統)，內容一致的複本也視為最新
+    same_content = current[:3] == st[:3] and stat.S_ISREG(current.mode)
+    return same_content and (not linked or current.dev != st.dev)
+
+
+def _resolve_origin(
+    source: Path,
+    rel: str,
+    st: FileStat,
+    strategy: str,
+    store_dir: Path | None,
+    digests: dict[str, str] | None,
+    copy_mode: str,
+    stats: SyncStats,
+) -> tuple[Path, FileStat]:
+    """檔案實際要複製或連結的來源；store 模式下先寫入 store，改為 store 中的 blob"""
+    origin = source / rel
+    if strategy != "store":
+        return origin, st
+
+    blob, created = store_add(store_dir, origin, digests[rel], st.mode, copy_mode)
+    if created:
+        stats.bytes_copied += st.size
+    blob_st = blob.stat()
+    return blob, FileStat(
+        blob_st.st_size, blob_st.st_mtime_ns, blob_st.st_mode, blob_st.st_dev, blob_st.st_ino
+    )
+
+
+def sync_tree(
+    source: Path,
+    target: Path,
+    copy_mode: str = "auto",
+    strategy: str = "copy",
+    source_files: dict[str, FileStat] | None = None,
+    source_dirs: set[str] | None = None,
+    store_dir: Path | None = None,
+    digests: dict[str, str] | None = None,
+    force: bool = False,
+) -> SyncStats:
+    """
+    以 delta 方式將 source 目錄同步到 target (類似 rsync)
+
+    同時掃描 source 與 target，只複製新增或變更的檔案 (size、mtime、mode
+    任一不同)，只刪除 source 中已不存在的項目，成本與變更量成正比。
+    檔案以 copy2 複製並保留 mtime，下次同步時才能用 stat 判斷是否變更。
+
+    Args:
+        source: 來源目錄
+        target: 目標目錄；若是 symlink 或檔案會先被移除
+        copy_mode: 檔案複製方式，見 copy_file
+        strategy: "copy" 複製檔案；"hardlink" 以 hardlink 建立檔案 (見 link_file)；
+            "store" 先將檔案寫入 store_dir，再從 store 的 blob 以 hardlink 建立
+        source_files: 已經掃描過的 scan_tree(source) 結果，避免重複掃描
+        source_dirs: 與 source_files 同一次掃描得到的子目錄 set
+        store_dir: content-addressed store 目錄 (strategy 為 "store" 時使用)
+        digests: {相對路徑: digest} (strategy 為 "store" 時使用)
+        force: 即使 stat 相同也重新複製所有檔案 (修復內容被修改但 stat 不變的檔案)
+
+    Returns:
+        實際執行的檔案操作統計
+    """
+    stats = SyncStats()
+
+    # target 不是真正的目錄時 (symlink、檔案)，先移除再建立
+    if target.is_symlink() or (target.exists() and not target.is_dir()):
+        target.unlink()
+    target.mkdir(parents=True, exist_ok=True)
+
+    if source_files is None or source_dirs is None:
+        source_dirs = set()
+        source_files = scan_tree(source, source_dirs)
+    target_dirs: set[str] = set()
+    target_files = scan_tree(target, target_dirs, follow_symlinks=False)
+
+    # 移除 source 中已不存在的目錄 (由上而下，父目錄移除後子目錄一併消失)
+    removed_dirs: list[str] = []
+    for rel in sorted(target_dirs - source_dirs):
+        if any(rel.startswith(f"{parent}/") for parent in removed_dirs):
+            continue
+        shutil.rmtree(target / rel)
+        removed_dirs.append(rel)
+        stats.files_deleted += 1
+
+    # 移除 source 中已不存在的檔案
+    for rel in target_files.keys() - source_files.keys():
+        if any(rel.startswith(f"{parent}/") for parent in removed_dirs):
+            continue
+        (target / rel).unlink()
+        stats.files_deleted += 1
+
+    # 建立新增的目錄
+    for rel in sorted(source_dirs - target_dirs):
+        (target / rel).mkdir(exist_ok=True)
+        shutil.copymode(source / rel, target / rel)
+
+    # 複製新增或變更的檔案
+    transfer = link_file if strategy in ("hardlink", "store") else copy_file
+    for rel, st in source_files.items():
+        origin, st = _resolve_origin(
+            source, rel, st, strategy, store_dir, digests, copy_mode, stats
+        )
+        current = target_files.get(rel)
+        if not force and _is_up_to_date(current, st, strategy):
+            continue
+        destination = target / rel
+        # 先移除舊檔案再複製：避免寫穿 symlink 或與其他路徑共用的 hardlink inode
+        if current is not None:
+            destination.unlink()
+        method = transfer(origin, destination, copy_mode)
+        stats.copy_methods[method] = stats.copy_methods.get(method, 0) + 1
+        stats.files_copied += 1
+        if method != "hardlink":
+            stats.bytes_copied += st.size
+
+    return stats
+
+
+def diff_tree(
+    source: Path,
+    target: Path,
+    source_files: dict[str, FileStat],
+    strategy: str = "copy",
+    store_dir: Path | None = None,
+    digests: dict[str, str] | None = None,
+    checksum: bool = False,
+    sources: SourceCache | None = None,
+) -> TreeDiff:
+    """
+    計算 sync_tree 會新增、修改與刪除哪些檔案，不寫入任何東西
+
+    與 sync_tree 相同，只用 scandir 的 stat (size、mtime、mode) 判斷；
+    checksum=True 時 (只用於 copy)，size 相同但 stat 不同的檔案再比對內容 digest，
+    內容相同就不算修改。
+
+    Args:
+        source: 來源目錄
+        target: 目標目錄；不是目錄 (或不存在) 時所有檔案都算新增
+        source_files: scan_tree(source) 的結果
+        strategy: 部署方式，hardlink/store 需指向同一個 inode 才算一致
+        store_dir: content-addressed store 目錄 (strategy 為 "store" 時使用)
+        digests: {相對路徑: digest}
+        checksum: 是否比對內容 digest
+        sources: 若提供，source 的 digest 透過這個快取計算
+    """
+    diff = TreeDiff()
+    target_files: dict[str, FileStat] = {}
+    if target.is_dir() and not target.is_symlink():
+        target_files = scan_tree(target, follow_symlinks=False)
+
+    for rel, st in sorted(source_files.items()):
+        current = target_files.get(rel)
+        if current is None:
+            diff.added.append((rel, st.size))
+            continue
+        origin = st
+        if strategy == "store" and digests and digests.get(rel):
+            # store 中的 blob 還不存在時，一定需要重新連結
+            with contextlib.suppress(OSError):
+                blob = store_blob_path(store_dir, digests[rel], st.mode).stat()
+                origin = FileStat(
+                    blob.st_size, blob.st_mtime_ns, blob.st_mode, blob.st_dev, blob.st_ino
+                )
+        if _is_up_to_date(current, origin, strategy):
+            continue
+        if checksum and strategy == "copy" and current.size == st.size:
+            expected = (digests or {}).get(rel)
+            if expected is None:
+                expected = (
+                    sources.digest(source / rel, st) if sources else file_digest(source / rel)
+                )
+            if stat.S_ISREG(current.mode) and file_digest(target / rel) == expected:
+                continue
+        diff.modified.append((rel, st.size))
+
+    for rel in sorted(target_files.keys() - source_files.keys()):
+        diff.deleted.append((rel, target_files[rel].size))
+    return diff
+
+
+def remove_path(path: Path):
+    """移除檔案、symlink 或目錄 (不跟隨 symlink)"""
+    if path.is_symlink() or not path.is_dir():
+        path.unlink(missing_ok=True)
+    else:
+        shutil.rmtree(path)
+
+
+class TrashCollector:
+    """
+    將要刪除的目錄 rename 到 trash 目錄，並在背景 thread 中刪除
+
+    rename 是 O(1) 且原子性的，部署不需要等待大型目錄的 rmtree；
+    背景 thread 是 daemon，程式結束時還沒刪完的項目留在 trash 中，下次執行時繼續刪除。
+    """
+
+    def __init__(self):
+        self._pending: list[tuple[Path, tuple[int, int] | None]] = []
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._counter = itertools.count()
+
+    def discard(self, path: Path, trash: Path | None):
+        """
+        移除 path：rename 到 trash 後由背景刪除
+
+        trash 為 None 或無法 rename (例如跨檔案系統) 時直接刪除。
+        """
+        if trash is not None:
+            try:
+                trash.mkdir(parents=True, exist_ok=True)
+                os.rename(path, trash / f"{path.name}.{os.getpid()}.{next(self._counter)}")
+            except OSError:
+                pass
+            else:
+                self.schedule(trash)
+                return
+        remove_path(path)
+
+    def schedule(self, trash: Path):
+        """
+        在背景刪除 trash 目錄中的所有項目
+
+        背景 thread 以呼叫端 thread 目前的身分 (見 fs_identity) 刪除，
+        其他使用者 home 中的 trash 不會以 root 的權限刪除。
+        """
+        with self._lock:
+            self._pending.append((trash, _fs_ids()))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trash", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                trash, ids = self._pending.pop(0)
+            with span("empty_trash", trash=trash), fs_identity(ids):
+                empty_trash(trash)
+
+    def wait(self):
+        """等待背景刪除完成"""
+        while True:
+            with self._lock:
+                thread = self._thread
+            if thread is None:
+                return
+            thread.join()
+
+
+def empty_trash(trash: Path):
+    """刪除 trash 目錄中的所有項目；刪除失敗的項目留到下次"""
+    try:
+        entries = list(trash.iterdir())
+    except OSError:
+        return
+    for entry in entries:
+        with contextlib.suppress(OSError):
+            remove_path(entry)
+
+
+# 整個程式共用的 trash collector
+_trash = TrashCollector()
+
+
+def wait_for_trash():
+    """等待背景刪除完成 (--wait-trash)"""
+    _trash.wait()
+
+
+@functools.cache
+def _renameat2():
+    """取得 libc 的 renameat2；非 Linux 或 libc 不提供時返回 None"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+
+        func = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    func.restype = ctypes.c_int
+    return func
+
+
+def _rename_exchange(first: Path, second: Path) -> bool:
+    """以 renameat2(RENAME_EXCHANGE) 原子性地交換兩個路徑；不支援時返回 False"""
+    renameat2 = _renameat2()
+    if renameat2 is None:
+        return False
+    result = renameat2(AT_FDCWD, os.fsencode(first), AT_FDCWD, os.fsencode(second), RENAME_EXCHANGE)
+    return result == 0
+
+
+def swap_into_place(staged: Path, target: Path) -> Path | None:
+    """
+    將建立好的 staged 目錄換到 target
+
+    target 不存在時只需一次 rename；已存在時以 RENAME_EXCHANGE 原子性地交換，
+    不支援時退回兩次 rename (中間有極短的空窗)。
+
+    Returns:
+        被換下來的舊 target 所在路徑 (需由呼叫端刪除)；target 原本不存在時為 None
+    """
+    if not (target.exists() or target.is_symlink()):
+        os.rename(staged, target)
+        return None
+
+    if _rename_exchange(staged, target):
+        return staged
+
+    retired = staged.with_name(f"{staged.name}.old")
+    if retired.exists() or retired.is_symlink():
+        remove_path(retired)
+    os.rename(target, retired)
+    os.rename(staged, target)
+    return retired
+
+
+def stage_tree(
+    source: Path,
+    target: Path,
+    stage: Path,
+    copy_mode: str = "auto",
+    strategy: str = "copy",
+    source_files: dict[str, FileStat] | None = None,
+    source_dirs: set[str] | None = None,
+    store_dir: Path | None = None,
+    digests: dict[str, str] | None = None,
+    force: bool = False,
+) -> SyncStats:
+    """
+    在 stage 目錄建立完整的新版本，再以一次 rename 換到 target
+
+    與 sync_tree 相同只傳輸新增或變更的檔案：沒有變更的檔案直接從現有的 target
+    以 hardlink 帶到 stage (只需 metadata 操作)。讀取 target 的程式在任何時間點
+    都只會看到完整的舊版本或新版本。參數與 sync_tree 相同。
+
+    Args:
+        stage: 與 target 在同一個檔案系統的暫存目錄 (已存在時先清除)
+
+    Returns:
+        實際執行的檔案操作統計；stats.replaced_tree 為換下來的舊目錄
+    """
+    stats = SyncStats()
+
+    if source_files is None or source_dirs is None:
+        source_dirs = set()
+        source_files = scan_tree(source, source_dirs)
+    reference_files: dict[str, FileStat] = {}
+    if target.is_dir() and not target.is_symlink():
+        reference_files = scan_tree(target, follow_symlinks=False)
+    stats.files_deleted = len(reference_files.keys() - source_files.keys())
+
+    if stage.exists() or stage.is_symlink():
+        remove_path(stage)
+    try:
+        stage.mkdir()
+        shutil.copymode(source, stage)
+        for rel in sorted(source_dirs):
+            (stage / rel).mkdir()
+            shutil.copymode(source / rel, stage / rel)
+
+        transfer = link_file if strategy in ("hardlink", "store") else copy_file
+        for rel, st in source_files.items():
+            origin, st = _resolve_origin(
+                source, rel, st, strategy, store_dir, digests, copy_mode, stats
+            )
+            destination = stage / rel
+            if not force and _is_up_to_date(reference_files.get(rel), st, strategy):
+                try:
+                    os.link(target / rel, destination)
+                    continue
+                except OSError:
+                    pass
+            method = transfer(origin, destination, copy_mode)
+            stats.copy_methods[method] = stats.copy_methods.get(method, 0) + 1
+            stats.files_copied += 1
+            if method != "hardlink":
+                stats.bytes_copied += st.size
+
+        stats.replaced_tree = swap_into_place(stage, target)
+    except BaseException:
+        if stage.exists() or stage.is_symlink():
+            remove_path(stage)
+        raise
+
+    return stats
+
+
+def default_store_dir() -> Path:
+    """預設的 content-addressed store 位置：$XDG_CACHE_HOME/agent-forge/store"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or "~/.cache"
+    return Path(cache_home).expanduser() / "agent-forge" / "store"
+
+
+def store_blob_path(store_dir: Path, digest: str, mode: int) -> Path:
+    """
+    blob 在 store 中的路徑：objects/<digest 前兩碼>/<digest>
+
+    hardlink 會共用 mode，所以可執行檔另外存成 <digest>-x。
+    """
+    suffix = "-x" if mode & 0o111 else ""
+    return store_dir / "objects" / digest[:2] / f"{digest}{suffix}"
+
+
+def store_add(
+    store_dir: Path, source: Path, digest: str, mode: int, copy_mode: str = "auto"
+) -> tuple[Path, bool]:
+    """
+    將檔案寫入 content-addressed store，相同內容只會寫入一次
+
+    blob 設為唯讀，避免透過 target 中的 hardlink 修改到其他 targets 共用的內容。
+
+    Returns:
+        (blob 路徑, 這次是否新寫入)
+    """
+    blob = store_blob_path(store_dir, digest, mode)
+    if blob.exists():
+        return blob, False
+
+    # 部署到其他使用者的 home 時 thread 以該使用者的身分執行 (見 fs_identity)，
+    # store 屬於 deploy 本身，以原本的身分寫入
+    with fs_identity((os.geteuid(), os.getegid())):
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dir = store_dir / "tmp"
+        tmp_dir.mkdir(exist_ok=True)
+        tmp_path = tmp_dir / f"{blob.name}.{os.getpid()}.{threading.get_ident()}"
+        tmp_path.unlink(missing_ok=True)
+        try:
+            copy_file(source, tmp_path, copy_mode)
+            os.chmod(tmp_path, 0o555 if mode & 0o111 else 0o444)
+            # 以 link 發布 blob：其他 thread 已寫入相同內容時沿用既有的 blob
+            os.link(tmp_path, blob)
+            return blob, True
+        except FileExistsError:
+            return blob, False
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+
+def gc_store(store_dir: Path, referenced: set[str], dry_run: bool = False) -> tuple[int, int]:
+    """
+    移除 store 中沒有被任何 target 引用的 blobs
+
+    仍有其他 hardlink (st_nlink > 1) 的 blob 代表還被某個 target 使用
+    (例如其他 config 或其他使用者部署的 target)，一律保留。
+
+    Args:
+        store_dir: store 目錄
+        referenced: 已部署 targets 的 manifest 中引用的 digests
+        dry_run: 只計算，不實際刪除
+
+    Returns:
+        (移除的 blob 數量, 釋放的 bytes)
+    """
+    removed = 0
+    freed = 0
+    objects_dir = store_dir / "objects"
+    if not objects_dir.is_dir():
+        return removed, freed
+
+    for bucket in sorted(objects_dir.iterdir()):
+        for blob in sorted(bucket.iterdir()):
+            st = blob.stat()
+            if blob.name.removesuffix("-x") in referenced or st.st_nlink > 1:
+                continue
+            if not dry_run:
+                blob.unlink()
+            removed += 1
+            freed += st.st_size
+        if not dry_run and not any(bucket.iterdir()):
+            bucket.rmdir()
+
+    # 清除中斷時留下的暫存檔
+    if not dry_run and (store_dir / "tmp").is_dir():
+        shutil.rmtree(store_dir / "tmp")
+
+    return removed, freed
+
+
+def symlink_tree(
+    source: Path, target: Path, trash: Path | None = None, stage: Path | None = None
+) -> bool:
+    """
+    將 target 設為指向 source 的 symlink
+
+    新的 symlink 先建立在 stage 目錄 (見 stage_dir；未指定時為 target 所在目錄)，
+    已存在的 symlink 或檔案以 os.replace 原子性地替換；已存在的目錄以
+    swap_into_place 換下後再刪除 (指定 trash 時移到 trash 由背景刪除)，
+    讀取 target 的程式不會看到它消失。
+
+    Returns:
+        是否有變更 (target 已是指向 source 的 symlink 時為 False)
+    """
+    if target.is_symlink() and os.readlink(target) == str(source):
+        return False
+
+    if stage is None:
+        tmp_link = target.with_name(f"{INTERNAL_PREFIX}link-{target.name}")
+    else:
+        stage.mkdir(parents=True, exist_ok=True)
+        tmp_link = stage / f"link-{target.name}"
+    tmp_link.unlink(missing_ok=True)
+    tmp_link.symlink_to(source, target_is_directory=True)
+    if target.is_dir() and not target.is_symlink():
+        # 目錄無法被 os.replace 覆蓋：先原子性地換上 symlink，再刪除舊目錄
+        retired = swap_into_place(tmp_link, target)
+        if retired is not None:
+            _trash.discard(retired, trash)
+    else:
+        os.replace(tmp_link, target)
+    return True
+
+
+def file_digest(path: Path) -> str:
+    """
+    計算檔案內容的 sha256 digest
+
+    大檔案以 mmap 讀取，直接交給 hashlib 而不經過 Python 的 buffer；
+    hashlib 計算時會釋放 GIL，可以在 thread pool 中平行計算。
+    """
+    # hashlib (OpenSSL) 只在真的需要計算 digest 時才載入，no-op 部署不需要
+    import hashlib
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            import mmap
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return hashlib.sha256(mapped).hexdigest()
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def sha256_hex(data: bytes) -> str:
+    """計算 data 的 sha256 digest (與 file_digest 相同，需要時才載入 hashlib)"""
+    import hashlib
+
+    return hashlib.sha256(data).hexdigest()
+
+
+def target_state_dir(target_base_dir: Path) -> Path:
+    """target 的狀態目錄，例如 ~/.claude/skills -> ~/.claude/.skills.deploy"""
+    return target_base_dir.parent / f".{target_base_dir.name}{STATE_SUFFIX}"
+
+
+def trash_dir(target_base_dir: Path) -> Path:
+    """target 的 trash 目錄 (與 target 在同一個檔案系統，rename 不需複製)"""
+    return target_state_dir(target_base_dir) / TRASH_NAME
+
+
+def stage_dir(target_base_dir: Path) -> Path:
+    """
+    target 的 staging 目錄 (必須與 target 在同一個檔案系統，才能以 rename 換上)
+
+    通常在狀態目錄中；target 目錄本身是掛載點 (bind mount、container volume 等) 時
+    狀態目錄在另一個檔案系統上，改用 target 目錄中的 .deploy-stage (部署完成後移除)。
+    """
+    state_dir = target_state_dir(target_base_dir)
+    try:
+        device = os.stat(target_base_dir).st_dev
+        state_device = os.stat(state_dir if state_dir.exists() else state_dir.parent).st_dev
+    except OSError:
+        return state_dir / STAGE_NAME
+    if device == state_device:
+        return state_dir / STAGE_NAME
+    return target_base_dir / f"{INTERNAL_PREFIX}{STAGE_NAME}"
+
+
+def load_manifest(target_base_dir: Path) -> dict[str, Any]:
+    """
+    讀取 target 上次部署的 manifest
+
+    格式：{"version": 1, "skills": {skill 名稱: {"source": 路徑,
+    "files": {相對路徑: [size, mtime_ns, digest]}}}}
+
+    檔案不存在、損壞或版本不符時返回空的 manifest，等同全部重新部署。
+    """
+    try:
+        with open(target_state_dir(target_base_dir) / MANIFEST_NAME, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"version": MANIFEST_VERSION, "skills": {}}
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return {"version": MANIFEST_VERSION, "skills": {}}
+    manifest.setdefault("skills", {})
+    return manifest
+
+
+def save_manifest(target_base_dir: Path, manifest: dict[str, Any]):
+    """以 write-then-rename 的方式寫入 manifest，避免留下寫到一半的檔案"""
+    state_dir = target_state_dir(target_base_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    path = state_dir / MANIFEST_NAME
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def build_manifest_entry(
+    source: Path,
+    files: dict[str, FileStat],
+    previous: dict[str, Any] | None,
+    strategy: str = "copy",
+    sources: SourceCache | None = None,
+) -> tuple[dict[str, Any], bool]:
+    """
+    根據 source 的掃描結果建立 manifest entry
+
+    stat (size, mtime) 與上次相同的檔案直接沿用舊的 digest，只有 stat 變更的
+    檔案才會讀取內容重新計算，所以沒有變更時只需要 stat 的成本。
+    hardlink 部署不讀取檔案內容，digest 記錄為 None。
+
+    Args:
+        source: skill 來源目錄
+        files: scan_tree(source) 的結果
+        previous: 上次部署時的 manifest entry (沒有則為 None)
+        strategy: 這次的部署方式，與上次不同時視為有變更
+        sources: 若提供，digest 透過這個快取計算 (多個 targets 共用)
+
+    Returns:
+        (新的 manifest entry, 內容是否與上次部署完全相同)
+    """
+    with_digests = strategy in ("copy", "store")
+    previous_files = {}
+    unchanged = (
+        previous is not None
+        and previous.get("source") == str(source)
+        and previous.get("strategy", "copy") == strategy
+    )
+    if unchanged:
+        previous_files = previous.get("files", {})
+        unchanged = previous_files.keys() == files.keys()
+
+    entry_files = {}
+    for rel, st in files.items():
+        old = previous_files.get(rel)
+        same_stat = old is not None and old[0] == st.size and old[1] == st.mtime_ns
+        if same_stat and (old[2] or not with_digests):
+            digest = old[2]
+        elif with_digests:
+            digest = sources.digest(source / rel, st) if sources else file_digest(source / rel)
+            if not old or old[0] != st.size or old[2] != digest:
+                unchanged = False
+        else:
+            digest = None
+            unchanged = False
+        entry_files[rel] = [st.size, st.mtime_ns, digest]
+
+    entry = {"source": str(source), "strategy": strategy, "files": entry_files}
+    return entry, unchanged
+
+
+def expand_path(path_str: str, config_dir: Path) -> Path:
+    """
+    展開路徑，支援:
+    - ~ (home directory)
+    - 相對路徑 (相對於 config 檔案所在目錄)
+    """
+    path = Path(path_str).expanduser()
+
+    # 如果是相對路徑，相對於 config 檔案所在目錄
+    if not path.is_absolute():
+        path = (config_dir / path).resolve()
+
+    return path
+
+
+def expand_targets(targets: dict[str, dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    """
+    展開樣板 targets
+
+    path 中含有 {home} 或 {user} 的 target 需設定 homes (home 目錄的 glob，例如
+    "/home/*")，每個符合的目錄展開成一個名為 "<target>@<user>" 的 target，
+    並記錄 owner (該 home 目錄)，以 root 執行時以它的擁有者的身分部署 (見 fs_identity)，
+    部署的檔案也會 chown 給它的擁有者。
+    其他 targets 保持不變。
+    """
+    import glob
+
+    expanded: dict[str, dict[str, Any]] = {}
+    for name, target_config in targets.items():
+        path = target_config.get("path", "")
+        if not any(var in path for var in TEMPLATE_VARS):
+            expanded[name] = target_config
+            continue
+        homes = target_config.get("homes")
+        if not homes:
+            print(f"✗ {name}: path 使用樣板時必須設定 homes")
+            continue
+        for home in sorted(glob.glob(os.path.expanduser(homes))):
+            if not os.path.isdir(home):
+                continue
+            user = os.path.basename(home.rstrip("/"))
+            expanded[f"{name}@{user}"] = {
+                **target_config,
+                "path": path.replace("{home}", home).replace("{user}", user),
+                "owner": home,
+            }
+    return expanded
+
+
+def resolve_store_dir(config: dict[str, Any], config_dir: Path) -> Path:
+    """config 中 [store] path 指定的 store 目錄，未指定時使用 default_store_dir()"""
+    store_path = config.get("store", {}).get("path")
+    if store_path:
+        return expand_path(store_path, config_dir)
+    return default_store_dir()
+
+
+def compile_plan(config: dict[str, Any], config_dir: Path) -> dict[str, Any]:
+    """
+    驗證 config 並展開所有路徑，產生可直接執行的部署計畫 (可序列化為 JSON)
+
+    Args:
+        config: load_config 的結果
+        config_dir: config 檔案所在目錄 (相對路徑的基準)
+
+    Returns:
+        {"ok": 是否可以部署, "messages": 驗證訊息 (每次執行都會輸出),
+        "skills": skill 名稱, "source_dirs": 展開後的 source 目錄 (skills 與 sources
+        有效時即使沒有可部署的 targets 也會填入), "store_dir": store 目錄,
+        "targets": {名稱: 啟用的 target 設定 (path 已展開；樣板 target 執行時才展開 homes)},
+        "exclude": 所有 skills 的排除規則, "skill_exclude": {skill 名稱: 排除規則}}
+    """
+    plan: dict[str, Any] = {
+        "ok": False,
+        "messages": [],
+        "skills": [],
+        "source_dirs": [],
+        "store_dir": "",
+        "targets": {},
+        "exclude": [],
+        "skill_exclude": {},
+    }
+    messages = plan["messages"]
+
+    # 檢查 skills 格式
+    skills_config = config.get("skills", [])
+    if not isinstance(skills_config, list) or not skills_config:
+        messages.append("⚠ Config 中沒有定義任何 skills")
+        return plan
+    if not isinstance(skills_config[0], str):
+        messages.append("✗ skills 必須是字串列表")
+        messages.append('  正確格式：skills = ["skill1", "skill2"]')
+        return plan
+
+    source_paths = config.get("sources", {}).get("paths", [])
+    if not source_paths:
+        messages.append("⚠ Config 中沒有定義 sources.paths")
+        return plan
+
+    # 排除規則：exclude 套用到所有 skills，skill_exclude 為 {skill 名稱: 規則列表}
+    exclude = config.get("exclude", [])
+    skill_exclude = config.get("skill_exclude", {})
+    if not _is_string_list(exclude):
+        messages.append("✗ exclude 必須是字串列表")
+        messages.append('  正確格式：exclude = [".git/", "node_modules/"]')
+        return plan
+    if not isinstance(skill_exclude, dict) or not all(
+        _is_string_list(patterns) for patterns in skill_exclude.values()
+    ):
+        messages.append("✗ skill_exclude 的每個 skill 必須對應字串列表")
+        messages.append('  正確格式：[skill_exclude]\n  my-skill = ["drafts/"]')
+        return plan
+
+    # skills 與 sources 有效時即可建立 catalog (list、search 等不需要 targets)
+    plan.update(
+        skills=skills_config,
+        source_dirs=[str(expand_path(path, config_dir)) for path in source_paths],
+        exclude=exclude,
+        skill_exclude=skill_exclude,
+    )
+
+    targets = config.get("targets", {})
+    if not targets:
+        messages.append("⚠ Config 中沒有定義任何 targets")
+        return plan
+
+    # 檢查每個啟用的 target 的部署方式、worker 上限與 token 預算，無效的 target 不處理
+    enabled_targets: dict[str, dict[str, Any]] = {}
+    for name, target_config in targets.items():
+        if not target_config.get("enabled", False):
+            continue
+        strategy = target_config.get("strategy", "copy")
+        target_jobs = target_config.get("jobs", 1)
+        max_tokens = target_config.get("max_tokens", 1)
+        path = target_config.get("path", "")
+        if strategy not in STRATEGIES:
+            messages.append(
+                f"✗ {name}: 未知的 strategy '{strategy}' (可用: {', '.join(STRATEGIES)})"
+            )
+        elif not isinstance(target_jobs, int) or isinstance(target_jobs, bool) or target_jobs < 1:
+            messages.append(f"✗ {name}: jobs 必須是正整數 (目前: {target_jobs!r})")
+        elif not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens < 1:
+            messages.append(f"✗ {name}: max_tokens 必須是正整數 (目前: {max_tokens!r})")
+        elif not path:
+            messages.append(f"✗ {name}: 沒有設定 path")
+        elif any(var in path for var in TEMPLATE_VARS):
+            if target_config.get("homes"):
+                enabled_targets[name] = dict(target_config)
+            else:
+                messages.append(f"✗ {name}: path 使用樣板時必須設定 homes")
+        else:
+            enabled_targets[name] = {**target_config, "path": str(expand_path(path, config_dir))}
+
+    if not enabled_targets:
+        messages.append("⚠ 沒有啟用的 targets (enabled = true)")
+        return plan
+
+    plan.update(
+        ok=True,
+        store_dir=str(resolve_store_dir(config, config_dir)),
+        targets=enabled_targets,
+    )
+    return plan
+
+
+def _is_string_list(value: Any) -> bool:
+    """value 是否為字串列表"""
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def load_plan(config_path: Path, write_cache: bool = True) -> dict[str, Any]:
+    """
+    讀取 config 的部署計畫 (見 compile_plan)，結果快取在 config 旁的 .deploy-cache 中
+
+    config 的 size 與 mtime 沒有變更時直接使用快取，不需要讀取或解析 config；
+    stat 變更但內容 (sha256) 相同時 (例如 touch 或 git checkout) 也沿用快取。
+    影響路徑展開的環境變數不同時重新編譯。
+
+    Args:
+        config_path: config 檔案路徑
+        write_cache: 是否寫入新的快取
+    """
+    cache_path = config_cache_dir(config_path) / f"plan-{config_path.name}.json"
+    key = {
+        "version": PLAN_CACHE_VERSION,
+        "config": str(config_path.absolute()),
+        "env": {name: os.environ.get(name) for name in PLAN_ENV_VARS},
+    }
+
+    try:
+        st = os.stat(config_path)
+    except OSError:
+        st = None
+    data = None
+    if st is not None:
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+            if {name: cached.get(name) for name in key} == key:
+                if cached["stat"] == [st.st_size, st.st_mtime_ns]:
+                    return cached["plan"]
+                data = config_path.read_bytes()
+                if cached["sha256"] == sha256_hex(data):
+                    if write_cache:
+                        write_cache_file(
+                            cache_path, dict(cached, stat=[st.st_size, st.st_mtime_ns])
+                        )
+                    return cached["plan"]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+
+    config = load_config(config_path)
+    plan = compile_plan(config, config_path.parent)
+    if write_cache and st is not None:
+        if data is None:
+            data = config_path.read_bytes()
+        cached = dict(key, stat=[st.st_size, st.st_mtime_ns], plan=plan)
+        cached["sha256"] = sha256_hex(data)
+        write_cache_file(cache_path, cached)
+    return plan
+
+
+def load_config(config_path: Path) -> dict[str, Any]:
+    """讀取 TOML config 檔案"""
+    import tomllib
+
+    try:
+        with open(config_path, "rb") as f:
+            config = tomllib.load(f)
+        return config
+    except FileNotFoundError:
+        print(f"錯誤: Config 檔案不存在: {config_path}")
+        sys.exit(1)
+    except tomllib.TOMLDecodeError as e:
+        print(f"錯誤: Config 檔案格式錯誤: {e}")
+        sys.exit(1)
+
+
+def copy_skill(source: Path, target: Path, dry_run: bool = False, copy_mode: str = "auto") -> bool:
+    """
+    複製 skill 目錄
+
+    Args:
+        source: skill 來源目錄
+        target: 目標路徑 (完整路徑，包含 skill 名稱)
+        dry_run: 只顯示操作，不實際執行
+        copy_mode: 檔案複製方式，見 copy_file
+
+    Returns:
+        是否成功複製
+    """
+    # 檢查 source 是否存在
+    if not source.exists():
+        print(f"  ⚠️  來源不存在，跳過: {source}")
+        return False
+
+    # 如果 target 已存在
+    if target.exists():
+        if dry_run:
+            print(f"  🔄 將覆蓋: {target}")
+        elif target.is_symlink() or target.is_file():
+            # 移除已存在的檔案或 symlink，目錄則交給 sync_tree 做增量同步
+            target.unlink()
+            print(f"  🗑️  已移除舊檔案: {target}")
+
+    # 複製目錄
+    if dry_run:
+        print(f"  ➡️  {source} -> {target}")
+    else:
+        try:
+            sync_tree(source, target, copy_mode)
+            print(f"  ✅ 已複製: {target.name} <- {source}")
+            return True
+        except Exception as e:
+            print(f"  ❌ 複製失敗: {e}")
+            return False
+
+    return True
+
+
+@traced("link_skills")
+def link_skills(
+    config_path: Path,
+    dry_run: bool = False,
+    verbose: bool = False,
+    jobs: int = 1,
+    copy_mode: str = "auto",
+    atomic: bool = True,
+    only_skills: set[str] | None = None,
+    metrics_file: Path | None = None,
+    checksum: bool = False,
+    force: bool = False,
+) -> list[TargetResult]:
+    """
+    主要執行函式：根據 config 複製 skills
+
+    Config 格式：
+    - skills: skill 名稱列表 (例如：["architect", "frontend-design"])
+    - sources.paths: skill 來源目錄列表 (例如：["./skills", "~/external-skills"])
+    - targets: 目標 IDE 目錄設定
+
+    Args:
+        config_path: config 檔案路徑
+        dry_run: 只顯示操作，不實際執行
+        verbose: 顯示詳細輸出
+        jobs: 同時處理 targets 的 worker 數量；(target, skill) 依 target 所在裝置分組，
+            每個裝置最多 jobs 個 worker (傳統硬碟為 1，見 device_limits)
+        copy_mode: 檔案複製方式 (auto、reflink、copy)，見 copy_file
+        atomic: 在 staging 目錄建立新版本後以 rename 換上 (見 stage_tree)；
+            False 時直接在 target 中做增量同步 (見 sync_tree)
+        only_skills: 只同步這些 skills (watch 模式使用)；其他 skills 保持原狀，
+            但不在 config 中的項目仍會被清理
+        metrics_file: 部署完成後寫入 Prometheus textfile 格式的 metrics (見 write_metrics)
+        checksum: dry-run 時 stat 不同的檔案再比對內容 digest (見 diff_tree)
+        force: 不使用 manifest 跳過未變更的 skills，並重新複製所有檔案
+            (修復 deploy verify 回報的差異)
+
+    Returns:
+        每個 target 的部署結果 (config 無效時為空列表)
+    """
+    run_start = time.perf_counter()
+    log(f"📖 讀取 config: {config_path}\n", verbose)
+    with span("load_config", path=config_path):
+        plan = load_plan(config_path, write_cache=not dry_run)
+    config_dir = config_path.parent
+    for message in plan["messages"]:
+        print(message)
+    if not plan["ok"]:
+        return []
+
+    skill_names = plan["skills"]
+    source_dirs = [Path(path) for path in plan["source_dirs"]]
+
+    log(f"📚 找到 {len(source_dirs)} 個 source 目錄", verbose)
+    log(f"🎯 找到 {len(skill_names)} 個 skills\n", verbose)
+
+    # 建立 skills 列表（帶有實際路徑）
+    with span("resolve_skills", skills=len(skill_names)):
+        resolved, not_found_skills = resolve_skills(
+            config_path, skill_names, source_dirs, write_cache=not dry_run
+        )
+    skills = [{"name": name, "path": path} for name, path in resolved.items()]
+    for skill_name in not_found_skills:
+        log(f"⚠️  找不到 skill: {skill_name}", verbose)
+
+    if not skills:
+        print("⚠ 沒有可連結的 skills")
+        return []
+
+    skills_to_sync = [
+        skill for skill in skills if only_skills is None or skill["name"] in only_skills
+    ]
+    if not skills_to_sync:
+        return []
+    kept_skills = {skill["name"] for skill in skills} - {skill["name"] for skill in skills_to_sync}
+
+    # 樣板 targets 每次執行時依 homes 展開 (home 目錄可能增減)
+    enabled_targets = expand_targets(plan["targets"])
+    if not enabled_targets:
+        print("⚠ 沒有啟用的 targets (enabled = true)")
+        return []
+
+    log(f"📍 啟用的 targets: {', '.join(enabled_targets.keys())}\n", verbose)
+
+    if dry_run:
+        log("🔍 Dry-run 模式 (不會實際複製檔案)\n", verbose)
+        print("[dry-run]")
+
+    options = DeployOptions(
+        dry_run=dry_run,
+        verbose=verbose,
+        copy_mode=copy_mode,
+        store_dir=Path(plan["store_dir"]),
+        atomic=atomic,
+        checksum=checksum,
+        force=force,
+        sources=SourceCache(plan["exclude"], plan["skill_exclude"]),
+    )
+
+    # 估計的 token 數超過 max_tokens 的 targets 整個不部署 (所有 targets 部署相同的 skills)
+    budgets = {
+        name: target_config["max_tokens"]
+        for name, target_config in enabled_targets.items()
+        if "max_tokens" in target_config
+    }
+    over_budget: dict[str, TargetResult] = {}
+    if budgets:
+        with span("token_budget"):
+            token_cache = TokenCache(config_path)
+            costs = skill_token_costs(resolved, token_cache, options.sources)
+            if not dry_run:
+                token_cache.save()
+        total_tokens = sum(sum(parts.values()) for parts in costs.values())
+        for name, limit in budgets.items():
+            if total_tokens > limit:
+                over_budget[name] = TargetResult(
+                    name=name,
+                    base_dir=expand_path(enabled_targets[name]["path"], config_dir),
+                    error=f"估計 {total_tokens} tokens，超過 max_tokens ({limit})，未部署",
+                )
+    target_order = list(enabled_targets)
+    enabled_targets = {
+        name: target_config
+        for name, target_config in enabled_targets.items()
+        if name not in over_budget
+    }
+
+    # 每個 target 與每個 (target, skill) 都是獨立的 I/O 工作，交給 thread pool 執行；
+    # 訊息先收集在各自的結果中，最後依 config 順序輸出，讓輸出與 jobs 數無關
+    # 其他使用者 home 中的 targets 以該使用者的身分處理 (見 fs_identity)
+    def prepare(item: tuple[str, dict[str, Any]]) -> TargetResult:
+        start = time.perf_counter()
+        with span("prepare_target", target=item[0]), fs_identity(owner_ids(item[1].get("owner"))):
+            result = _prepare_target(item[0], item[1], config_dir, skills, options)
+        result.duration += time.perf_counter() - start
+        return result
+
+    def sync(pair: tuple[TargetResult, dict[str, Any]]) -> SkillResult:
+        start = time.perf_counter()
+        with (
+            span("sync_skill", target=pair[0].name, skill=pair[1]["name"]),
+            fs_identity(owner_ids(pair[0].owner)),
+        ):
+            result = _sync_skill(pair[0], pair[1], options)
+        result.duration = time.perf_counter() - start
+        return result
+
+    with span("prepare_targets", targets=len(enabled_targets)):
+        if jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(prepare, enabled_targets.items()))
+        else:
+            # 單一 worker 時不建立 thread pool (也不需要 import concurrent.futures)
+            results = [prepare(item) for item in enabled_targets.items()]
+
+    # 被拒絕的 targets (見 check_home_target) 不同步任何 skill
+    ready = [result for result in results if not result.error]
+
+    # 同一個裝置上的 targets 共用一組 worker，慢的裝置 (NFS 等) 不會拖慢其他裝置
+    limits = device_limits(ready, enabled_targets, jobs)
+    for device, limit in limits.items():
+        log(f"💽 裝置 {os.major(device)}:{os.minor(device)}: {limit} 個 worker", verbose)
+    pairs = [(result, skill) for result in ready for skill in skills_to_sync]
+    with span("sync_skills", pairs=len(pairs)):
+        skill_results = run_by_device(sync, pairs, lambda pair: pair[0].device, limits, jobs)
+
+    count = len(skills_to_sync)
+    for index, result in enumerate(ready):
+        result.skills = skill_results[index * count : (index + 1) * count]
+        start = time.perf_counter()
+        with span("finish_target", target=result.name):
+            _finish_target(result, count, options, kept_skills)
+        result.duration += time.perf_counter() - start
+        result.duration += sum(skill_result.duration for skill_result in result.skills)
+
+    if over_budget:
+        processed = {result.name: result for result in results}
+        results = [over_budget.get(name) or processed[name] for name in target_order]
+
+    for result in results:
+        for message in result.messages:
+            print(message)
+        _print_target_summary(result, dry_run)
+
+    # 顯示警告和錯誤
+    if not_found_skills:
+        print(f"⚠ Not found: {', '.join(not_found_skills)}")
+
+    for result in results:
+        for skill_result in result.skills:
+            if skill_result.status == "failed":
+                print(f"✗ Failed: {skill_result.name} ({skill_result.error})")
+
+    if metrics_file is not None and not dry_run:
+        try:
+            write_metrics(metrics_file, results, time.perf_counter() - run_start)
+        except OSError as e:
+            print(f"⚠ 無法寫入 metrics: {e}")
+
+    if dry_run:
+        log("\n💡 這是 dry-run 模式的結果", verbose)
+        log("   要實際複製檔案，請執行: ./deploy.py", verbose)
+
+    return results
+
+
+def device_of(path: Path) -> int:
+    """path 所在裝置的 st_dev；path 還不存在 (dry-run) 時使用最近存在的上層目錄"""
+    for candidate in (path, *path.parents):
+        try:
+            return os.stat(candidate).st_dev
+        except OSError:
+            continue
+    return 0
+
+
+@functools.cache
+def is_rotational(device: int) -> bool:
+    """裝置是否為傳統硬碟 (Linux 的 /sys/dev/block/<major>:<minor>/queue/rotational)"""
+    block = Path("/sys/dev/block") / f"{os.major(device)}:{os.minor(device)}"
+    # partition 沒有自己的 queue，使用所屬磁碟的設定
+    for queue in (block / "queue", block / ".." / "queue"):
+        try:
+            return (queue / "rotational").read_text().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+
+def device_limits(
+    results: list[TargetResult], target_configs: dict[str, dict[str, Any]], jobs: int
+) -> dict[int, int]:
+    """
+    每個裝置同時寫入的 worker 上限
+
+    預設為 jobs；傳統硬碟為 1，避免平行的隨機寫入造成大量 seek；
+    target 設定了 jobs 時，該裝置使用所有 targets 中最小的上限。
+    """
+    limits: dict[int, int] = {}
+    for result in results:
+        limit = 1 if is_rotational(result.device) else jobs
+        limit = min(limit, target_configs[result.name].get("jobs", limit))
+        limits[result.device] = min(limits.get(result.device, limit), limit)
+    return limits
+
+
+def run_by_device(func, items: list, device_key, limits: dict[int, int], jobs: int) -> list:
+    """
+    以每個裝置各自的 thread pool 執行 func(item)，返回依 items 順序排列的結果
+
+    每個裝置最多 limits[裝置] 個 worker 同時執行，所有裝置合計不超過 jobs；
+    jobs <= 1 時依序執行，與單一 worker 的行為相同。
+    """
+    if jobs <= 1:
+        return [func(item) for item in items]
+    from concurrent.futures import ThreadPoolExecutor
+
+    slots = threading.BoundedSemaphore(jobs)
+
+    def run(item):
+        with slots:
+            return func(item)
+
+    pools = {
+        device: ThreadPoolExecutor(
+            max_workers=limit, thread_name_prefix=f"dev-{os.major(device)}:{os.minor(device)}"
+        )
+        for device, limit in limits.items()
+    }
+    try:
+        futures = [pools[device_key(item)].submit(run, item) for item in items]
+        return [future.result() for future in futures]
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+
+
+def _log_to(messages: list[str], message: str, verbose: bool):
+    """與 log 相同，但先收集到 messages 中，稍後再依序輸出"""
+    if verbose:
+        messages.append(message)
+
+
+def _prepare_target(
+    target_name: str,
+    target_config: dict[str, Any],
+    config_dir: Path,
+    skills: list[dict[str, Any]],
+    options: DeployOptions,
+) -> TargetResult:
+    """建立 target 目錄、讀取 manifest，並清理不在 config 中的舊項目"""
+    target_base_dir = expand_path(target_config["path"], config_dir)
+    result = TargetResult(
+        name=target_name,
+        base_dir=target_base_dir,
+        strategy=target_config.get("strategy", "copy"),
+        owner=Path(target_config["owner"]) if "owner" in target_config else None,
+    )
+    messages = result.messages
+    _log_to(messages, f"🎯 處理 target: {target_name}", options.verbose)
+    _log_to(messages, f"   目標目錄: {target_base_dir}", options.verbose)
+
+    # 其他使用者 home 中的 target 經由 symlink 指到別處時不做任何清理、寫入或 chown
+    if result.owner is not None:
+        try:
+            check_home_target(result.owner, target_base_dir)
+        except ValueError as e:
+            result.error = f"拒絕部署: {e}"
+            return result
+
+    # 建立目標目錄 (如果不存在)
+    if not target_base_dir.exists():
+        if options.dry_run:
+            _log_to(messages, f"   📁 將建立目錄: {target_base_dir}", options.verbose)
+        else:
+            target_base_dir.mkdir(parents=True, exist_ok=True)
+            _log_to(messages, f"   📁 已建立目錄: {target_base_dir}", options.verbose)
+
+    result.device = device_of(target_base_dir)
+
+    # 收集所有應該存在的 skill 名稱
+    expected_skills = {skill["name"] for skill in skills}
+
+    # 讀取上次部署的 manifest
+    with span("load_manifest"):
+        result.manifest = load_manifest(target_base_dir)
+
+    # 上次執行沒刪完的項目在背景繼續刪除
+    trash = trash_dir(target_base_dir)
+    if not options.dry_run and trash.is_dir():
+        _trash.schedule(trash)
+
+    # 檢查並清理不在 config 中的舊項目；目錄移到 trash 後在背景刪除
+    if target_base_dir.exists():
+        with span("prune"):
+            for item in target_base_dir.iterdir():
+                if item.name in expected_skills:
+                    continue
+                # 這個項目不在 config 中，應該移除
+                if options.dry_run:
+                    _log_to(
+                        messages, f"   🗑️  將移除 (不在 config 中): {item.name}", options.verbose
+                    )
+                    result.removed += 1
+                    continue
+                if item.is_symlink():
+                    item.unlink()
+                    _log_to(
+                        messages,
+                        f"   🗑️  已移除 symlink (不在 config 中): {item.name}",
+                        options.verbose,
+                    )
+                elif item.is_file():
+                    item.unlink()
+                    _log_to(
+                        messages, f"   🗑️  已移除 (不在 config 中): {item.name}", options.verbose
+                    )
+                elif item.is_dir():
+                    _trash.discard(item, trash)
+                    _log_to(
+                        messages, f"   🗑️  已移除 (不在 config 中): {item.name}", options.verbose
+                    )
+                result.removed += 1
+
+    return result
+
+
+def _sync_skill(target: TargetResult, skill: dict[str, Any], options: DeployOptions) -> SkillResult:
+    """將單一 skill 同步到 target，未變更時直接跳過"""
+    skill_name = skill["name"]
+    skill_source = skill["path"]
+    skill_target = target.base_dir / skill_name
+    result = SkillResult(name=skill_name)
+    messages = result.messages
+
+    # 檢查 source 是否存在
+    if not skill_source.exists():
+        _log_to(messages, f"  ⚠️  來源不存在，跳過: {skill_source}", options.verbose)
+        result.status = "skipped"
+        return result
+
+    if target.strategy == "symlink":
+        return _symlink_skill(target, skill, result, options)
+
+    # 與 manifest 比對，內容沒有變更且 target 仍完整存在時直接跳過
+    try:
+        with span("scan_tree"):
+            source_files, source_dirs = options.sources.scan(skill_source)
+        with span("build_manifest_entry"):
+            entry, unchanged = build_manifest_entry(
+                skill_source,
+                source_files,
+                target.manifest["skills"].get(skill_name),
+                target.strategy,
+                options.sources,
+            )
+    except OSError as e:
+        _log_to(messages, f"  ❌ 讀取來源失敗: {e}", options.verbose)
+        result.status, result.error = "failed", str(e)
+        return result
+
+    if unchanged and not options.force and skill_target.is_dir() and not skill_target.is_symlink():
+        _log_to(messages, f"  ⏭️  未變更，跳過: {skill_name}", options.verbose)
+        result.status, result.entry = "unchanged", entry
+        return result
+
+    # 如果 target 已存在，只同步有變更的檔案
+    updating = skill_target.exists() or skill_target.is_symlink()
+    if options.dry_run:
+        try:
+            with span("diff_tree"):
+                result.diff = diff_tree(
+                    skill_source,
+                    skill_target,
+                    source_files,
+                    target.strategy,
+                    options.store_dir,
+                    {rel: info[2] for rel, info in entry["files"].items()},
+                    options.checksum,
+                    options.sources,
+                )
+        except OSError as e:
+            _log_to(messages, f"  ❌ 讀取 target 失敗: {e}", options.verbose)
+            result.status, result.error = "failed", str(e)
+            return result
+        if not result.diff and skill_target.is_dir() and not skill_target.is_symlink():
+            _log_to(messages, f"  ⏭️  未變更，跳過: {skill_name}", options.verbose)
+            result.status = "unchanged"
+        elif updating:
+            _log_to(messages, f"  🔄 將更新: {skill_name}", options.verbose)
+            result.status = "synced"
+        else:
+            _log_to(messages, f"  ➕ 將複製: {skill_name} <- {skill_source}", options.verbose)
+            result.status = "synced"
+        return result
+
+    try:
+        tree_options = {
+            "copy_mode": options.copy_mode,
+            "strategy": target.strategy,
+            "source_files": source_files,
+            "source_dirs": source_dirs,
+            "store_dir": options.store_dir,
+            "digests": {rel: info[2] for rel, info in entry["files"].items()},
+            "force": options.force,
+        }
+        if options.atomic:
+            # 在 staging 區 (見 stage_dir) 建立新版本，再以一次 rename 換上
+            stage = stage_dir(target.base_dir) / skill_name
+            stage.parent.mkdir(parents=True, exist_ok=True)
+            with span("stage_tree"):
+                result.stats = stage_tree(skill_source, skill_target, stage, **tree_options)
+        else:
+            with span("sync_tree"):
+                result.stats = sync_tree(skill_source, skill_target, **tree_options)
+    except Exception as e:
+        _log_to(messages, f"  ❌ 複製失敗: {e}", options.verbose)
+        result.status, result.error = "failed", str(e)
+        return result
+
+    if updating:
+        _log_to(
+            messages,
+            f"  🔄 更新: {skill_name} "
+            f"({result.stats.files_copied} 個檔案已複製, {result.stats.files_deleted} 個已移除)",
+            options.verbose,
+        )
+    else:
+        _log_to(messages, f"  ✅ 已複製: {skill_name} <- {skill_source}", options.verbose)
+    result.status, result.entry = "synced", entry
+    return result
+
+
+def _symlink_skill(
+    target: TargetResult, skill: dict[str, Any], result: SkillResult, options: DeployOptions
+) -> SkillResult:
+    """以 symlink 部署 skill：整個目錄只需一個 metadata 操作"""
+    skill_name = skill["name"]
+    skill_source = skill["path"]
+    skill_target = target.base_dir / skill_name
+    entry = {"source": str(skill_source), "strategy": "symlink", "files": {}}
+
+    if skill_target.is_symlink() and os.readlink(skill_target) == str(skill_source):
+        _log_to(result.messages, f"  ⏭️  未變更，跳過: {skill_name}", options.verbose)
+        result.status, result.entry = "unchanged", entry
+        return result
+
+    if options.dry_run:
+        _log_to(
+            result.messages, f"  🔗 將建立 symlink: {skill_name} -> {skill_source}", options.verbose
+        )
+        result.status = "synced"
+        return result
+
+    updating = skill_target.exists() or skill_target.is_symlink()
+    try:
+        with span("symlink_tree"):
+            symlink_tree(
+                skill_source,
+                skill_target,
+                trash_dir(target.base_dir),
+                stage_dir(target.base_dir),
+            )
+    except OSError as e:
+        _log_to(result.messages, f"  ❌ 建立 symlink 失敗: {e}", options.verbose)
+        result.status, result.error = "failed", str(e)
+        return result
+
+    action = "🔄 更新" if updating else "🔗 已建立"
+    _log_to(result.messages, f"  {action} symlink: {skill_name} -> {skill_source}", options.verbose)
+    result.stats.copy_methods["symlink"] = 1
+    result.status, result.entry = "synced", entry
+    return result
+
+
+def _finish_target(
+    result: TargetResult,
+    skill_count: int,
+    options: DeployOptions,
+    kept_skills: set[str] = frozenset(),
+):
+    """
+    合併 skill 訊息、移除 staged 部署換下來的舊目錄，並寫入這次部署的 manifest
+
+    kept_skills 是這次沒有同步的 skills，沿用它們在 manifest 中的舊記錄。
+    """
+    for skill_result in result.skills:
+        result.messages.extend(skill_result.messages)
+        # 新版本都已換上之後才移除舊目錄 (移到 trash 在背景刪除)，不會讓 target 出現缺漏
+        if skill_result.stats.replaced_tree is not None:
+            try:
+                with (
+                    span("remove_replaced", skill=skill_result.name),
+                    fs_identity(owner_ids(result.owner)),
+                ):
+                    _trash.discard(skill_result.stats.replaced_tree, trash_dir(result.base_dir))
+            except OSError as e:
+                _log_to(result.messages, f"   ⚠️  無法移除舊目錄: {e}", options.verbose)
+
+    # target 是掛載點時 staging 區在 target 目錄中 (見 stage_dir)，用完即移除
+    stage = stage_dir(result.base_dir) if result.count("synced") else None
+    if stage is not None and stage.parent == result.base_dir and not options.dry_run:
+        with contextlib.suppress(OSError), fs_identity(owner_ids(result.owner)):
+            stage.rmdir()
+
+    # 記錄這次部署的內容，下次執行時用來跳過未變更的 skills
+    if not options.dry_run:
+        previous = result.manifest["skills"]
+        deployed = {name: previous[name] for name in kept_skills if name in previous}
+        deployed.update(
+            (skill_result.name, skill_result.entry)
+            for skill_result in result.skills
+            if skill_result.entry is not None
+        )
+        result.manifest["skills"] = deployed
+        # 沒有任何變更時不重寫 manifest，no-op 部署只需要讀取
+        if deployed != previous:
+            try:
+                with span("save_manifest"), fs_identity(owner_ids(result.owner)):
+                    save_manifest(result.base_dir, result.manifest)
+            except OSError as e:
+                _log_to(result.messages, f"   ⚠️  無法寫入 manifest: {e}", options.verbose)
+
+    if result.owner is not None and not options.dry_run and os.geteuid() == 0:
+        try:
+            with span("chown"):
+                chown_target(result)
+        except OSError as e:
+            _log_to(result.messages, f"   ⚠️  無法變更擁有者: {e}", options.verbose)
+
+    methods = result.copy_methods()
+    if methods:
+        used = ", ".join(f"{method} ({count})" for method, count in sorted(methods.items()))
+        _log_to(result.messages, f"   📋 複製方式: {used}", options.verbose)
+
+    # 顯示統計
+    done_count = result.count("synced") + result.count("unchanged")
+    _log_to(result.messages, f"   ✨ 完成: {done_count}/{skill_count} 個 skills\n", options.verbose)
+
+
+@functools.cache
+def _fs_credentials():
+    """
+    取得 libc 的 setfsuid、setfsgid 與加回讀取權限的函式；非 Linux 或 libc 不提供時返回 None
+
+    setfsuid 換成一般使用者時 kernel 會清掉 thread 的 filesystem capabilities，
+    加回 CAP_DAC_READ_SEARCH 讓 thread 仍可讀取 root 才能讀取的 sources，寫入則受該使用者的權限限制。
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        setfsuid, setfsgid, capget, capset = libc.setfsuid, libc.setfsgid, libc.capget, libc.capset
+    except (OSError, AttributeError):
+        return None
+
+    class CapHeader(ctypes.Structure):
+        _fields_ = [("version", ctypes.c_uint32), ("pid", ctypes.c_int)]
+
+    class CapData(ctypes.Structure):
+        _fields_ = [
+            ("effective", ctypes.c_uint32),
+            ("permitted", ctypes.c_uint32),
+            ("inheritable", ctypes.c_uint32),
+        ]
+
+    def keep_read_access():
+        header = CapHeader(LINUX_CAPABILITY_VERSION_3, 0)
+        data = (CapData * 2)()
+        if capget(ctypes.byref(header), data) == 0:
+            data[0].effective |= data[0].permitted & (1 << CAP_DAC_READ_SEARCH)
+            capset(ctypes.byref(header), data)
+
+    return setfsuid, setfsgid, keep_read_access
+
+
+def _fs_ids() -> tuple[int, int] | None:
+    """目前 thread 存取檔案時的 (uid, gid)；不是以 root 執行或不支援 setfsuid 時返回 None"""
+    credentials = _fs_credentials() if os.geteuid() == 0 else None
+    if credentials is None:
+        return None
+    setfsuid, setfsgid, _ = credentials
+    # 傳入無效的 id (-1) 時不變更，只返回目前的值
+    return setfsuid(-1), setfsgid(-1)
+
+
+def owner_ids(owner: str | Path | None) -> tuple[int, int] | None:
+    """存取 owner (樣板 target 的 home 目錄) 時使用的 (uid, gid)：該目錄的擁有者"""
+    if owner is None:
+        return None
+    st = os.stat(owner)
+    return st.st_uid, st.st_gid
+
+
+@contextlib.contextmanager
+def fs_identity(ids: tuple[int, int] | None):
+    """
+    在目前的 thread 中以 ids = (uid, gid) 的身分存取檔案 (setfsuid/setfsgid 只影響呼叫的 thread)
+
+    以 root 部署到其他使用者的 home 時，target 中的操作都由 kernel 以該使用者的權限檢查：
+    使用者在 home 中建立的 symlink 無法讓 deploy 寫入、刪除它無權存取的檔案，
+    新建立的項目也直接屬於該使用者。ids 為 None、不是以 root 執行或不支援時不切換。
+    """
+    previous = _fs_ids()
+    if ids is None or previous is None or ids == previous:
+        yield
+        return
+    setfsuid, setfsgid, keep_read_access = _fs_credentials()
+
+    def switch(uid: int, gid: int):
+        setfsgid(gid)
+        setfsuid(uid)
+        if _fs_ids() != (uid, gid):
+            raise PermissionError(f"無法切換身分為 uid={uid} gid={gid}")
+        if uid != 0:
+            keep_read_access()
+
+    try:
+        switch(*ids)
+        yield
+    finally:
+        switch(*previous)
+
+
+def open_beneath(home: Path, path: Path) -> int:
+    """
+    從 home 開始逐層開啟 path 目錄並返回它的 file descriptor
+
+    home 之下的每一層都以 O_NOFOLLOW 開啟，任何一層是 symlink 或不是目錄時引發 OSError
+    (filename 為該層的路徑)，不會經由 symlink 走到 home 之外；path 不在 home 之中時引發 ValueError。
+    """
+    if not path.is_relative_to(home) or ".." in path.relative_to(home).parts:
+        raise ValueError(f"{path} 不在 {home} 之中")
+    fd = os.open(home, os.O_RDONLY | os.O_DIRECTORY)
+    current = home
+    try:
+        for part in path.relative_to(home).parts:
+            current /= part
+            try:
+                next_fd = os.open(part, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+            except OSError as e:
+                raise OSError(e.errno, e.strerror, str(current)) from None
+            os.close(fd)
+            fd = next_fd
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def check_home_target(home: Path, base_dir: Path):
+    """
+    確認 home 中的 target 沒有經由 symlink 指到 home 之外 (以 root 部署到其他使用者的 home 時)
+
+    target 解析後必須在 home 之中，從 home 到 target 以及狀態目錄、trash、stage 的每一層
+    都必須是真正的目錄；還不存在的部分由 deploy 建立。不符合時引發 ValueError。
+    """
+    if not base_dir.resolve().is_relative_to(home.resolve()):
+        raise ValueError(f"{base_dir} 不在 {home} 之中")
+    state_dir = target_state_dir(base_dir)
+    for path in (base_dir, state_dir / TRASH_NAME, state_dir / STAGE_NAME):
+        try:
+            os.close(open_beneath(home, path))
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            if e.errno in (errno.ELOOP, errno.ENOTDIR):
+                raise ValueError(f"{e.filename} 是 symlink 或不是目錄") from None
+            raise ValueError(f"無法檢查 {e.filename}: {e.strerror}") from None
+
+
+def chown_target(result: TargetResult):
+    """
+    將這次部署到其他使用者 home 中的項目交給 home 目錄的擁有者 (以 root 執行時使用)
+
+    只處理 target 目錄、建立的上層目錄、狀態目錄與這次同步的 skills。
+    hardlink 與 store 部署的檔案與 source/store 共用 inode，只變更目錄的擁有者。
+    所有操作都經由 open_beneath 開啟的目錄 (不跟隨 symlink)，home 中的 symlink
+    無法讓 root chown home 之外的檔案。
+    """
+    home = result.owner
+    uid, gid = owner_ids(home)
+
+    def chown(name: str, dir_fd: int):
+        os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+
+    # target 目錄與 root 建立的上層目錄 (例如 ~/.claude)
+    for path in (*reversed(result.base_dir.parents), result.base_dir):
+        if not path.is_relative_to(home) or path == home:
+            continue
+        fd = open_beneath(home, path)
+        try:
+            if path == result.base_dir or os.fstat(fd).st_uid == 0:
+                os.fchown(fd, uid, gid)
+        finally:
+            os.close(fd)
+
+    try:
+        state_fd = open_beneath(home, target_state_dir(result.base_dir))
+    except FileNotFoundError:
+        state_fd = None
+    if state_fd is not None:
+        try:
+            os.fchown(state_fd, uid, gid)
+            for name in os.listdir(state_fd):
+                if name != TRASH_NAME:
+                    chown(name, state_fd)
+        finally:
+            os.close(state_fd)
+
+    shared_inodes = result.strategy in ("hardlink", "store")
+    base_fd = open_beneath(home, result.base_dir)
+    try:
+        for skill in result.skills:
+            if skill.status != "synced":
+                continue
+            try:
+                st = os.stat(skill.name, dir_fd=base_fd, follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            chown(skill.name, base_fd)
+            if not stat.S_ISDIR(st.st_mode):
+                continue
+            # fwalk 不跟隨 symlink，並確認開啟的目錄與 stat 的結果是同一個
+            for _root, dirs, files, root_fd in os.fwalk(skill.name, dir_fd=base_fd):
+                for name in dirs if shared_inodes else dirs + files:
+                    chown(name, root_fd)
+    finally:
+        os.close(base_fd)
+
+
+def _print_target_summary(result: TargetResult, dry_run: bool):
+    """輸出 target 的簡化統計"""
+    if result.error:
+        print(f"✗ {result.name}: {result.error}")
+        return
+    synced_count = result.count("synced")
+    unchanged_count = result.count("unchanged")
+
+    if dry_run:
+        summary_parts = [f"{synced_count} to sync"]
+        if unchanged_count > 0:
+            summary_parts.append(f"{unchanged_count} unchanged")
+        if result.removed > 0:
+            summary_parts.append(f"{result.removed} to remove")
+        print(f"  {result.name}: {', '.join(summary_parts)}")
+        _print_target_diff(result)
+    else:
+        summary_parts = [f"{synced_count} synced"]
+        if unchanged_count > 0:
+            summary_parts.append(f"{unchanged_count} unchanged")
+        if result.removed > 0:
+            summary_parts.append(f"{result.removed} removed")
+        # 回報這個 target 實際使用的複製方式
+        methods = result.copy_methods()
+        mode_note = f" [{', '.join(sorted(methods))}]" if methods else ""
+        print(f"✓ {result.name}: {', '.join(summary_parts)}{mode_note}")
+
+
+def _print_target_diff(result: TargetResult):
+    """dry-run 時輸出每個檔案的差異 (+ 新增、~ 修改、- 刪除) 與 bytes 合計"""
+    totals = {"+": [0, 0], "~": [0, 0], "-": [0, 0]}
+    for skill in result.skills:
+        if not skill.diff:
+            continue
+        for mark, entries in (
+            ("+", skill.diff.added),
+            ("~", skill.diff.modified),
+            ("-", skill.diff.deleted),
+        ):
+            for rel, size in entries:
+                print(f"    {mark} {skill.name}/{rel} ({size} bytes)")
+                totals[mark][0] += 1
+                totals[mark][1] += size
+    if any(count for count, _ in totals.values()):
+        (added, added_bytes), (modified, modified_bytes), (deleted, deleted_bytes) = totals.values()
+        print(
+            f"    files: {added} added, {modified} modified, {deleted} deleted "
+            f"(+{added_bytes} / ~{modified_bytes} / -{deleted_bytes} bytes)"
+        )
+
+
+# Prometheus metrics：(名稱, 說明, 從 TargetResult 取值的函式)，每個 target 一個 sample
+TARGET_METRICS = (
+    ("deploy_target_duration_seconds", "處理 target 花費的秒數", lambda r: r.duration),
+    ("deploy_skills_synced", "這次同步的 skills 數", lambda r: r.count("synced")),
+    ("deploy_skills_unchanged", "未變更而跳過的 skills 數", lambda r: r.count("unchanged")),
+    ("deploy_skills_failed", "同步失敗的 skills 數", lambda r: r.count("failed")),
+    ("deploy_items_removed", "因不在 config 中而移除的項目數", lambda r: r.removed),
+    ("deploy_files_copied", "寫入的檔案數", lambda r: r.total("files_copied")),
+    ("deploy_bytes_copied", "寫入的 bytes", lambda r: r.total("bytes_copied")),
+)
+
+
+def _escape_label(value: str) -> str:
+    """Prometheus label 值的跳脫 (反斜線、雙引號、換行)"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_metrics(path: Path, results: list[TargetResult], duration: float):
+    """
+    以 node_exporter textfile collector 格式寫入這次部署的 metrics
+
+    先寫入同一個目錄中的暫存檔再 os.replace，collector 不會讀到寫到一半的檔案。
+
+    Args:
+        path: metrics 檔案路徑 (通常是 textfile collector 目錄中的 *.prom)
+        results: link_skills 的部署結果
+        duration: 整次部署花費的秒數
+    """
+    lines: list[str] = []
+    for name, description, value in TARGET_METRICS:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        for result in results:
+            lines.append(f'{name}{{target="{_escape_label(result.name)}"}} {value(result)}')
+
+    failed = sum(result.count("failed") + bool(result.error) for result in results)
+    run_metrics = (
+        ("deploy_run_duration_seconds", "整次部署花費的秒數", duration),
+        ("deploy_run_success", "最後一次部署沒有失敗的 skills 或 targets 時為 1", int(failed == 0)),
+        ("deploy_run_timestamp_seconds", "最後一次部署完成的 Unix 時間", time.time()),
+    )
+    for name, description, value in run_metrics:
+        lines.extend((f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {value}"))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_text("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+
+def _positive_int(value: str) -> int:
+    """argparse 用的正整數型別"""
+    import argparse
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"必須是正整數: {value}")
+    return number
+
+
+class InotifyWatcher:
+    """透過 ctypes 使用 Linux inotify 監看目錄 (只支援 Linux)"""
+
+    def __init__(self):
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._add_watch.restype = ctypes.c_int
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失敗")
+        self._fd = fd
+        self._watches: dict[int, Path] = {}
+        self._recursive: set[Path] = set()
+
+    def add(self, path: Path, recursive: bool = False):
+        """監看目錄 (recursive 時包含所有子目錄，之後新增的子目錄也會自動加入)"""
+        wd = self._add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            return
+        self._watches[wd] = path
+        if recursive:
+            self._recursive.add(path)
+            dirs: set[str] = set()
+            try:
+                scan_tree(path, dirs)
+            except OSError:
+                return
+            for rel in dirs:
+                self._add_watch_only(path / rel)
+
+    def _add_watch_only(self, path: Path):
+        wd = self._add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self._watches[wd] = path
+
+    def read(self, timeout: float) -> set[Path]:
+        """等待最多 timeout 秒，返回有變更的路徑"""
+        import select
+        import struct
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed: set[Path] = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = struct.unpack_from("iIII", data, offset)
+            offset += 16
+            name = data[offset : offset + length].split(b"\0", 1)[0]
+            offset += length
+            base = self._watches.get(wd)
+            if base is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                continue
+            path = base / os.fsdecode(name) if name else base
+            changed.add(path)
+            # 監看中的目錄底下新增了子目錄：一併監看
+            created_dir = mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO)
+            if created_dir and any(path.is_relative_to(root) for root in self._recursive):
+                self._add_watch_only(path)
+                dirs: set[str] = set()
+                with contextlib.suppress(OSError):
+                    scan_tree(path, dirs)
+                for rel in dirs:
+                    self._add_watch_only(path / rel)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """以定期 os.scandir 比對 stat 監看目錄 (不支援 inotify 時使用)"""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._roots: list[tuple[Path, bool]] = []
+        self._snapshot: dict[Path, tuple[int, ...]] = {}
+
+    def add(self, path: Path, recursive: bool = False):
+        """監看目錄 (recursive 時包含所有子目錄)"""
+        self._roots.append((path, recursive))
+        self._snapshot.update(self._scan(path, recursive))
+
+    @staticmethod
+    def _scan(path: Path, recursive: bool) -> dict[Path, tuple[int, ...]]:
+        snapshot: dict[Path, tuple[int, ...]] = {}
+        try:
+            if recursive:
+                dirs: set[str] = set()
+                for rel, st in scan_tree(path, dirs).items():
+                    snapshot[path / rel] = st[:3]
+                for rel in dirs:
+                    snapshot[path / rel] = ()
+            else:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        st = entry.stat()
+                        snapshot[Path(entry.path)] = (st.st_size, st.st_mtime_ns, st.st_mode)
+        except OSError:
+            pass
+        return snapshot
+
+    def read(self, timeout: float) -> set[Path]:
+        """等待 timeout 秒 (至少 interval 的一部分) 後比對，返回有變更的路徑"""
+        time.sleep(min(timeout, self.interval))
+        snapshot: dict[Path, tuple[int, ...]] = {}
+        for path, recursive in self._roots:
+            snapshot.update(self._scan(path, recursive))
+        changed = {
+            path
+            for path in snapshot.keys() | self._snapshot.keys()
+            if snapshot.get(path) != self._snapshot.get(path)
+        }
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        self._snapshot = {}
+
+
+def _make_watcher(poll: bool, interval: float) -> "InotifyWatcher | PollingWatcher":
+    """Linux 上優先使用 inotify，否則使用 polling"""
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(interval)
+
+
+def _load_watch_paths(config_path: Path) -> tuple[list[str], list[Path], dict[str, Path]]:
+    """watch 模式需要監看的內容：(config 中的 skills, source 目錄, 解析後的 skill 路徑)"""
+    plan = load_plan(config_path)
+    skill_names = plan["skills"]
+    source_dirs = [Path(path) for path in plan["source_dirs"]]
+    resolved, _ = resolve_skills(config_path, skill_names, source_dirs)
+    return skill_names, source_dirs, resolved
+
+
+def affected_skills(
+    changed: set[Path],
+    config_path: Path,
+    skill_names: list[str],
+    source_dirs: list[Path],
+    resolved: dict[str, Path],
+) -> tuple[set[str], bool]:
+    """
+    將變更的路徑對應到需要重新同步的 skills
+
+    Returns:
+        (需要同步的 skill 名稱, 是否需要重新解析 skills / 完整重新部署)
+        config 檔案變更，或 source 目錄中新增、刪除 config 中的 skill 時為 True
+    """
+    names = set(skill_names)
+    affected: set[str] = set()
+    reload = False
+    config_file = config_path.absolute()
+    for path in changed:
+        if path.absolute() == config_file:
+            return set(), True
+        if path.parent in source_dirs and path.name in names:
+            affected.add(path.name)
+            reload = True
+            continue
+        for name, skill_path in resolved.items():
+            if path == skill_path or path.is_relative_to(skill_path):
+                affected.add(name)
+                break
+    return affected, reload
+
+
+def watch_skills(
+    config_path: Path,
+    stop: threading.Event | None = None,
+    poll: bool = False,
+    debounce: float = 0.2,
+    interval: float = 0.5,
+    **deploy_options: Any,
+):
+    """
+    先完整部署一次，之後監看 source 目錄與 config，只重新同步有變更的 skills
+
+    Linux 上使用 inotify，其他平台或 poll=True 時以 polling 比對 stat。
+    連續的變更會等安靜 debounce 秒後才一起同步。
+
+    Args:
+        config_path: config 檔案路徑
+        stop: 設定後結束監看 (測試或嵌入使用；CLI 以 Ctrl-C 結束)
+        poll: 強制使用 polling
+        debounce: 合併連續變更的等待秒數
+        interval: polling 的間隔秒數
+        **deploy_options: 傳給 link_skills 的其他參數
+    """
+    stop = stop or threading.Event()
+    link_skills(config_path, **deploy_options)
+
+    while not stop.is_set():
+        skill_names, source_dirs, resolved = _load_watch_paths(config_path)
+        watcher = _make_watcher(poll, interval)
+        try:
+            watcher.add(config_path.absolute().parent)
+            for source_dir in source_dirs:
+                watcher.add(source_dir)
+            for skill_path in resolved.values():
+                watcher.add(skill_path, recursive=True)
+            log(f"👀 監看 {len(resolved)} 個 skills 的變更 (Ctrl-C 結束)", force=True)
+
+            while not stop.is_set():
+                changed = watcher.read(interval)
+                # debounce：持續收集變更，直到安靜 debounce 秒
+                while changed and not stop.is_set():
+                    more = watcher.read(debounce)
+                    if not more:
+                        break
+                    changed |= more
+                if not changed:
+                    continue
+
+                affected, reload = affected_skills(
+                    changed, config_path, skill_names, source_dirs, resolved
+                )
+                if reload and not affected:
+                    link_skills(config_path, **deploy_options)
+                elif affected:
+                    link_skills(config_path, only_skills=affected, **deploy_options)
+                if reload:
+                    break
+        finally:
+            watcher.close()
+
+
+def collect_store_references(config: dict[str, Any], config_dir: Path) -> set[str]:
+    """所有 targets (包含未啟用的) 的 manifest 中以 store 方式部署的 digests"""
+    referenced: set[str] = set()
+    for target_config in expand_targets(config.get("targets", {})).values():
+        if "path" not in target_config:
+            continue
+        manifest = load_manifest(expand_path(target_config["path"], config_dir))
+        for entry in manifest["skills"].values():
+            if entry.get("strategy") == "store":
+                referenced.update(info[2] for info in entry["files"].values() if info[2])
+    return referenced
+
+
+def gc_command(argv: list[str]) -> int:
+    """deploy gc：移除 store 中沒有被任何已部署 target 引用的 blobs"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="deploy gc", description="移除 content-addressed store 中不再被引用的 blobs"
+    )
+    parser.add_argument(
+        "config",
+        nargs="?",
+        default="skills_config.toml",
+        help="Config 檔案路徑 (預設: skills_config.toml)",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Dry-run 模式：只顯示將移除的數量，不實際刪除",
+    )
+    args = parser.parse_args(argv)
+
+    config_path = Path(args.config)
+    config = load_config(config_path)
+    store_dir = resolve_store_dir(config, config_path.parent)
+    referenced = collect_store_references(config, config_path.parent)
+    # trash 中換下來的舊目錄仍 hardlink 著 blobs，先刪除才不會被當成仍在使用
+    wait_for_trash()
+    if not args.dry_run:
+        for target_config in expand_targets(config.get("targets", {})).values():
+            if "path" in target_config:
+                trash = trash_dir(expand_path(target_config["path"], config_path.parent))
+                with fs_identity(owner_ids(target_config.get("owner"))):
+                    empty_trash(trash)
+    removed, freed = gc_store(store_dir, referenced, args.dry_run)
+
+    if args.dry_run:
+        print(f"  gc: {removed} blobs to remove ({freed} bytes)")
+    else:
+        print(f"✓ gc: {removed} blobs removed ({freed} bytes freed)")
+    return 0
+
+
+# bundle：第一個 member 是 MANIFEST.json，之後是 skills/<skill>/<相對路徑>
+BUNDLE_MANIFEST = "MANIFEST.json"
+BUNDLE_VERSION = 1
+BUNDLE_PREFIX = "skills/"
+BUNDLE_CHUNK_SIZE = 1 << 20
+
+
+def _bundle_mode(path: Path, writing: bool) -> str:
+    """依副檔名決定 tarfile 的模式 (.tar.gz/.tgz 使用 gzip)"""
+    compressed = path.name.endswith((".tar.gz", ".tgz"))
+    if writing:
+        return "w:gz" if compressed else "w"
+    return "r|gz" if compressed else "r|"
+
+
+def _is_bundle_relpath(rel: Any) -> bool:
+    """rel 是否為 bundle 中合法的相對路徑：非空、不是絕對路徑，且不含空的部分、. 或 .."""
+    return (
+        isinstance(rel, str)
+        and not rel.startswith("/")
+        and all(part not in ("", ".", "..") for part in rel.split("/"))
+    )
+
+
+def _validate_bundle_manifest(manifest: Any):
+    """
+    檢查 bundle manifest 的結構與路徑，在修改任何 target 之前拒絕可能寫到 skill 目錄之外的 bundle
+
+    Raises:
+        ValueError: 格式錯誤、skill 名稱不是單一路徑元件，或目錄與檔案路徑是絕對路徑或包含 ..
+    """
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("skills"), dict):
+        raise ValueError("bundle manifest 格式錯誤")
+    for name, skill in manifest["skills"].items():
+        if not _is_bundle_relpath(name) or "/" in name:
+            raise ValueError(f"bundle 中的 skill 名稱不合法: {name!r}")
+        if (
+            not isinstance(skill, dict)
+            or not isinstance(skill.get("dirs"), list)
+            or not isinstance(skill.get("files"), dict)
+        ):
+            raise ValueError(f"bundle manifest 中 {name} 的格式錯誤")
+        for rel in [*skill["dirs"], *skill["files"]]:
+            if not _is_bundle_relpath(rel):
+                raise ValueError(f"bundle 中的路徑不合法: {name}/{rel}")
+        for rel, info in skill["files"].items():
+            if not (
+                isinstance(info, list)
+                and len(info) == 4
+                and all(isinstance(info[i], int) for i in (0, 1, 3))
+                and isinstance(info[2], str)
+            ):
+                raise ValueError(f"bundle manifest 中 {name}/{rel} 的格式錯誤")
+
+
+def build_bundle(
+    skills: dict[str, Path], output: Path, sources: SourceCache | None = None
+) -> dict[str, Any]:
+    """
+    將 skills 打包成一個 tar 檔案
+
+    第一個 member 是 MANIFEST.json，記錄每個 skill 的子目錄與每個檔案的
+    [size, mtime_ns, digest, mode]；套用時只需依序讀一次檔案。
+    先寫入暫存檔再 rename，不會留下寫到一半的 bundle。
+
+    Args:
+        skills: {skill 名稱: skill 來源目錄}
+        output: bundle 檔案路徑
+        sources: 若提供，透過它掃描 source 目錄 (套用 exclude 規則)
+
+    Returns:
+        寫入的 bundle manifest
+    """
+    import io
+    import tarfile
+
+    manifest: dict[str, Any] = {"version": BUNDLE_VERSION, "skills": {}}
+    sources = sources or SourceCache()
+    for name, source in skills.items():
+        files, dirs = sources.scan(source)
+        manifest["skills"][name] = {
+            "dirs": sorted(dirs),
+            "files": {
+                rel: [st.size, st.mtime_ns, file_digest(source / rel), stat.S_IMODE(st.mode)]
+                for rel, st in sorted(files.items())
+            },
+        }
+
+    tmp = output.with_name(f".{output.name}.tmp")
+    with tarfile.open(tmp, _bundle_mode(output, writing=True), format=tarfile.PAX_FORMAT) as tar:
+        data = json.dumps(manifest, ensure_ascii=False, sort_keys=True).encode()
+        info = tarfile.TarInfo(BUNDLE_MANIFEST)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+
+        for name, skill in manifest["skills"].items():
+            for rel in skill["dirs"]:
+                info = tarfile.TarInfo(f"{BUNDLE_PREFIX}{name}/{rel}")
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            for rel, (size, mtime_ns, _, mode) in skill["files"].items():
+                info = tarfile.TarInfo(f"{BUNDLE_PREFIX}{name}/{rel}")
+                info.size = size
+                info.mode = mode
+                info.mtime = mtime_ns // 1_000_000_000
+                with open(skills[name] / rel, "rb") as f:
+                    tar.addfile(info, f)
+    os.replace(tmp, output)
+    return manifest
+
+
+def _plan_bundle_skill(
+    target: TargetResult,
+    name: str,
+    skill: dict[str, Any],
+    source: str,
+    needed: dict[tuple[str, str], list[tuple[Path, tuple[int, int] | None]]],
+    options: DeployOptions,
+) -> SkillResult:
+    """
+    比對 target 中的 skill 與 bundle：刪除 bundle 中沒有的項目，
+    並將需要寫入的檔案加入 needed (digest 與 target 的 manifest 相同且 stat 未變更的檔案跳過)
+
+    needed 中記錄寫入位置與寫入時使用的身分 (見 fs_identity)。
+    """
+    result = SkillResult(name=name, status="unchanged")
+    skill_target = target.base_dir / name
+    previous = target.manifest["skills"].get(name) or {}
+    previous_files = previous.get("files", {}) if previous.get("strategy") == "copy" else {}
+
+    if skill_target.is_symlink() or (skill_target.exists() and not skill_target.is_dir()):
+        if not options.dry_run:
+            skill_target.unlink()
+        result.stats.files_deleted += 1
+    current_dirs: set[str] = set()
+    current: dict[str, FileStat] = {}
+    if skill_target.is_dir() and not skill_target.is_symlink():
+        current = scan_tree(skill_target, current_dirs, follow_symlinks=False)
+
+    entry_files = {}
+    writes: list[str] = []
+    for rel, (size, mtime_ns, digest, _) in skill["files"].items():
+        old = previous_files.get(rel)
+        st = current.get(rel)
+        if (
+            old is not None
+            and st is not None
+            and old[2] == digest
+            and (st.size, st.mtime_ns) == (old[0], old[1])
+        ):
+            entry_files[rel] = old
+            continue
+        writes.append(rel)
+        entry_files[rel] = [size, mtime_ns, digest]
+        result.stats.files_copied += 1
+        result.stats.bytes_copied += size
+
+    # 移除 bundle 中沒有的目錄與檔案 (目錄由上而下，父目錄移除後子目錄一併消失)
+    removed_dirs: list[str] = []
+    for rel in sorted(current_dirs - set(skill["dirs"])):
+        if not any(rel.startswith(f"{parent}/") for parent in removed_dirs):
+            if not options.dry_run:
+                shutil.rmtree(skill_target / rel)
+            removed_dirs.append(rel)
+            result.stats.files_deleted += 1
+    for rel in current.keys() - skill["files"].keys():
+        if not any(rel.startswith(f"{parent}/") for parent in removed_dirs):
+            if not options.dry_run:
+                (skill_target / rel).unlink()
+            result.stats.files_deleted += 1
+
+    # 上面已移除 target 中不屬於 bundle 的 symlinks；寫入位置仍必須留在 skill 目錄中
+    root = skill_target.resolve()
+    ids = owner_ids(target.owner)
+    for rel in writes:
+        destination = skill_target / rel
+        if not options.dry_run and not destination.parent.resolve().is_relative_to(root):
+            raise ValueError(f"{destination} 不在 skill 目錄 {skill_target} 中")
+        needed.setdefault((name, rel), []).append((destination, ids))
+
+    if result.stats.files_copied or result.stats.files_deleted:
+        result.status = "synced"
+        if result.stats.files_copied:
+            result.stats.copy_methods["bundle"] = result.stats.files_copied
+        _log_to(
+            result.messages,
+            f"  🔄 更新: {name} ({result.stats.files_copied} 個檔案已寫入, "
+            f"{result.stats.files_deleted} 個已移除)",
+            options.verbose,
+        )
+    else:
+        _log_to(result.messages, f"  ⏭️  未變更，跳過: {name}", options.verbose)
+    result.entry = {"source": source, "strategy": "copy", "files": entry_files}
+    return result
+
+
+def _write_bundle_member(
+    reader,
+    destinations: list[tuple[Path, tuple[int, int] | None]],
+    digest: str,
+    mode: int,
+    mtime_ns: int,
+    dirs: set[Path],
+):
+    """
+    將一個 bundle member 串流寫入所有需要它的 target (每個檔案寫入暫存檔後 rename)
+
+    destinations 為 (寫入位置, 身分)，每個 target 中的檔案操作都以該 target 的身分
+    (見 fs_identity) 執行。暫存檔以 mkstemp 建立 (O_EXCL，不會經由已存在的 symlink
+    寫到別處)；內容與 manifest 的 digest 不符或寫入失敗時移除已建立的暫存檔，
+    不會換上任何檔案。mode 只保留權限位元，bundle 不能建立 setuid/setgid 檔案。
+    """
+    import hashlib
+    import tempfile
+
+    tmps: list[tuple[Path, tuple[int, int] | None]] = []
+    try:
+        with contextlib.ExitStack() as stack:
+            outputs = []
+            for destination, ids in destinations:
+                with fs_identity(ids):
+                    if destination.parent not in dirs:
+                        destination.parent.mkdir(parents=True, exist_ok=True)
+                        dirs.add(destination.parent)
+                    if destination.is_dir() and not destination.is_symlink():
+                        shutil.rmtree(destination)
+                    fd, tmp = tempfile.mkstemp(
+                        prefix=f"{INTERNAL_PREFIX}tmp-{destination.name}.", dir=destination.parent
+                    )
+                tmps.append((Path(tmp), ids))
+                outputs.append(stack.enter_context(open(fd, "wb")))
+            hasher = hashlib.sha256()
+            while chunk := reader.read(BUNDLE_CHUNK_SIZE):
+                hasher.update(chunk)
+                for f in outputs:
+                    f.write(chunk)
+            if hasher.hexdigest() != digest:
+                name = destinations[0][0].name
+                raise ValueError(f"{name} 的內容與 bundle manifest 的 digest 不符")
+            for f in outputs:
+                f.flush()
+                os.fchmod(f.fileno(), mode & 0o777)
+                os.utime(f.fileno(), ns=(mtime_ns, mtime_ns))
+    except BaseException:
+        for tmp, ids in tmps:
+            with contextlib.suppress(OSError), fs_identity(ids):
+                tmp.unlink()
+        raise
+    for (tmp, ids), (destination, _) in zip(tmps, destinations, strict=True):
+        with fs_identity(ids):
+            os.replace(tmp, destination)
+
+
+def apply_bundle(
+    bundle: Path,
+    config_path: Path,
+    dry_run: bool = False,
+    verbose: bool = False,
+) -> list[TargetResult]:
+    """
+    將 bundle 套用到 config 中啟用的 targets
+
+    bundle 只讀一次：先讀 MANIFEST.json 與每個 target 的 manifest 比對，
+    之後依序串流每個 member，只寫入 digest 不同的檔案；同一個檔案一次寫入所有需要的 targets。
+    bundle 中沒有的 skills 與檔案會被移除。所有 targets 都以 copy 方式部署。
+    路徑會離開 skill 目錄的 bundle，以及含有檔案與目錄以外 member (symlink、裝置等) 的
+    bundle 都會被拒絕。
+
+    Returns:
+        每個 target 的部署結果
+
+    Raises:
+        ValueError: 不是有效的 bundle
+    """
+    import tarfile
+
+    config = load_config(config_path)
+    config_dir = config_path.parent
+    options = DeployOptions(dry_run=dry_run, verbose=verbose)
+    source = f"bundle:{bundle.resolve()}"
+
+    with tarfile.open(bundle, _bundle_mode(bundle, writing=False)) as tar:
+        first = tar.next()
+        if first is None or first.name != BUNDLE_MANIFEST:
+            raise ValueError(f"{bundle} 不是有效的 bundle (缺少 {BUNDLE_MANIFEST})")
+        manifest = json.load(tar.extractfile(first))
+        _validate_bundle_manifest(manifest)
+        if manifest.get("version") != BUNDLE_VERSION:
+            raise ValueError(f"不支援的 bundle 版本: {manifest.get('version')}")
+
+        if dry_run:
+            print("[dry-run]")
+        skills = [{"name": name} for name in manifest["skills"]]
+        # 與 link_skills 相同，其他使用者 home 中的 targets 以該使用者的身分處理 (見 fs_identity)
+        results = []
+        for name, target_config in expand_targets(config.get("targets", {})).items():
+            if target_config.get("enabled", False):
+                with fs_identity(owner_ids(target_config.get("owner"))):
+                    results.append(
+                        _prepare_target(name, target_config, config_dir, skills, options)
+                    )
+        # 被拒絕的 targets (見 check_home_target) 不寫入任何檔案
+        ready = [result for result in results if not result.error]
+        needed: dict[tuple[str, str], list[tuple[Path, tuple[int, int] | None]]] = {}
+        for result in ready:
+            with fs_identity(owner_ids(result.owner)):
+                result.skills = [
+                    _plan_bundle_skill(result, name, skill, source, needed, options)
+                    for name, skill in manifest["skills"].items()
+                ]
+
+        skill_dirs = {name: set(skill["dirs"]) for name, skill in manifest["skills"].items()}
+        created: set[Path] = set()
+        for member in tar:
+            if not (member.isfile() or member.isdir()):
+                raise ValueError(f"bundle 包含不支援的 member: {member.name}")
+            name, _, rel = member.name.removeprefix(BUNDLE_PREFIX).partition("/")
+            if dry_run or name not in manifest["skills"]:
+                continue
+            # 只建立 manifest 中記錄 (已檢查過路徑) 的目錄
+            if member.isdir() and rel in skill_dirs[name]:
+                for result in ready:
+                    with fs_identity(owner_ids(result.owner)):
+                        (result.base_dir / name / rel).mkdir(parents=True, exist_ok=True)
+            elif member.isfile() and (name, rel) in needed:
+                _, mtime_ns, digest, mode = manifest["skills"][name]["files"][rel]
+                reader = tar.extractfile(member)
+                _write_bundle_member(reader, needed[(name, rel)], digest, mode, mtime_ns, created)
+
+    for result in results:
+        # 沒有檔案的 skill 不會出現在 member 中，仍需建立目錄
+        if not dry_run and result.skills:
+            with fs_identity(owner_ids(result.owner)):
+                for skill_result in result.skills:
+                    (result.base_dir / skill_result.name).mkdir(parents=True, exist_ok=True)
+        # _finish_target 以該使用者的身分寫入 manifest，chown 則仍需 root
+        if not result.error:
+            _finish_target(result, len(skills), options)
+        for message in result.messages:
+            print(message)
+        _print_target_summary(result, dry_run)
+    return results
+
+
+def build_bundle_command(argv: list[str]) -> int:
+    """deploy build-bundle：將 config 中的 skills 打包成一個 bundle 檔案"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="deploy build-bundle",
+        description="將解析後的 skills 與含 digests 的 manifest 打包成一個 bundle 檔案",
+    )
+    parser.add_argument(
+        "config",
+        nargs="?",
+        default="skills_config.toml",
+        help="Config 檔案路徑 (預設: skills_config.toml)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=Path("skills.bundle.tar"),
+        help="bundle 檔案路徑，.tar.gz/.tgz 會以 gzip 壓縮 (預設: skills.bundle.tar)",
+    )
+    args = parser.parse_args(argv)
+
+    config_path = Path(args.config)
+    config = load_config(config_path)
+    source_dirs = [
+        expand_path(path, config_path.parent) for path in config.get("sources", {}).get("paths", [])
+    ]
+    resolved, not_found = resolve_skills(config_path, config.get("skills", []), source_dirs)
+    if not_found:
+        print(f"⚠ Not found: {', '.join(not_found)}")
+    if not resolved:
+        print("⚠ 沒有可打包的 skills")
+        return 1
+
+    sources = SourceCache(config.get("exclude", []), config.get("skill_exclude", {}))
+    manifest = build_bundle(resolved, args.output, sources)
+    file_count = sum(len(skill["files"]) for skill in manifest["skills"].values())
+    print(f"✓ bundle: {len(resolved)} skills, {file_count} files -> {args.output}")
+    return 0
+
+
+def apply_bundle_command(argv: list[str]) -> int:
+    """deploy apply-bundle：將 bundle 套用到 config 中啟用的 targets"""
+    import argparse
+    import tarfile
+
+    parser = argparse.ArgumentParser(
+        prog="deploy apply-bundle",
+        description="從 bundle 串流寫入 config 中啟用的 targets，跳過 digest 相同的檔案",
+    )
+    parser.add_argument("bundle", type=Path, help="bundle 檔案路徑")
+    parser.add_argument(
+        "config",
+        nargs="?",
+        default="skills_config.toml",
+        help="Config 檔案路徑 (預設: skills_config.toml)",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Dry-run 模式：只顯示將執行的操作，不實際寫入檔案",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="顯示詳細輸出")
+    args = parser.parse_args(argv)
+
+    try:
+        results = apply_bundle(args.bundle, Path(args.config), args.dry_run, args.verbose)
+    except (OSError, ValueError, tarfile.TarError) as e:
+        print(f"✗ 無法套用 bundle: {e}")
+        return 1
+    return 0 if results else 1
+
+
+def _expected_digest(
+    source: Path, rel: str, st: FileStat, recorded: dict[str, Any], sources: SourceCache
+) -> str:
+    """source 檔案的 digest：stat 與 manifest 記錄相同時直接使用記錄，否則重新計算"""
+    old = recorded.get(rel)
+    if old is not None and old[2] and old[0] == st.size and old[1] == st.mtime_ns:
+        return old[2]
+    return sources.digest(source / rel, st)
+
+
+def verify_skill(
+    source: Path,
+    target: Path,
+    strategy: str,
+    entry: dict[str, Any] | None,
+    store_dir: Path | None,
+    sources: SourceCache,
+    checksum: bool = False,
+) -> tuple[list[tuple[str, str]], list[tuple[str, Path, Path, FileStat]]]:
+    """
+    以 stat 比對已部署的 skill 與 source
+
+    stat 一致的檔案 (hardlink/store 指向同一個 inode) 直接視為一致；
+    size 相同但其他 stat 不同的檔案 (或 checksum=True 時所有檔案) 需要比對內容。
+
+    Returns:
+        (已確定的差異 [(種類, 相對路徑)]，
+        需要比對內容的檔案 [(相對路徑, target 檔案, skill source, source stat)])
+    """
+    if strategy == "symlink":
+        if target.is_symlink() and os.readlink(target) == str(source):
+            return [], []
+        return [("modified" if target.exists() or target.is_symlink() else "missing", "")], []
+    if not target.is_dir() or target.is_symlink():
+        return [("missing", "")], []
+
+    source_files, _ = sources.scan(source)
+    target_files = scan_tree(target, follow_symlinks=False)
+    recorded = (entry or {}).get("files", {})
+    drift = [("missing", rel) for rel in sorted(source_files.keys() - target_files.keys())]
+    drift += [("extra", rel) for rel in sorted(target_files.keys() - source_files.keys())]
+
+    candidates = []
+    for rel, st in sorted(source_files.items()):
+        current = target_files.get(rel)
+        if current is None:
+            continue
+        if current.size != st.size or not stat.S_ISREG(current.mode):
+            drift.append(("modified", rel))
+            continue
+        origin = st
+        if strategy == "store":
+            # store 部署的檔案應與 source 內容對應的 blob 是同一個 inode
+            digest = _expected_digest(source, rel, st, recorded, sources)
+            with contextlib.suppress(OSError):
+                blob = store_blob_path(store_dir, digest, st.mode).stat()
+                origin = FileStat(
+                    blob.st_size, blob.st_mtime_ns, blob.st_mode, blob.st_dev, blob.st_ino
+                )
+        if not checksum and _is_up_to_date(current, origin, strategy):
+            continue
+        candidates.append((rel, target / rel, source, st))
+    return drift, candidates
+
+
+def verify_targets(
+    plan: dict[str, Any],
+    skills: dict[str, Path],
+    jobs: int,
+    checksum: bool = False,
+) -> dict[str, list[tuple[str, str]]]:
+    """
+    檢查每個啟用的 target 中已部署的 skills 是否與 source 一致
+
+    先以 stat 過濾 (見 verify_skill)，剩下的檔案在 thread pool 中平行計算 digest。
+    source 的 digest 在 stat 與 manifest 記錄相同時直接沿用記錄。
+
+    Returns:
+        {target 名稱: [(種類, "skill/相對路徑")]}；種類為 missing、extra 或 modified
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    sources = SourceCache(plan["exclude"], plan["skill_exclude"])
+    store_dir = Path(plan["store_dir"]) if plan["store_dir"] else None
+    drift: dict[str, list[tuple[str, str]]] = {}
+    # 需要比對內容的檔案：(target 名稱, 顯示路徑, target 檔案, skill source, 相對路徑, stat, 記錄)
+    pending: list[tuple[str, str, Path, Path, str, FileStat, dict[str, Any]]] = []
+
+    for name, target_config in expand_targets(plan["targets"]).items():
+        base_dir = Path(target_config["path"])
+        strategy = target_config.get("strategy", "copy")
+        manifest = load_manifest(base_dir)
+        drift[name] = []
+        if base_dir.is_dir():
+            for item in sorted(base_dir.iterdir()):
+                if item.name not in skills:
+                    drift[name].append(("extra", item.name))
+        for skill_name, source in skills.items():
+            entry = manifest["skills"].get(skill_name)
+            found, candidates = verify_skill(
+                source, base_dir / skill_name, strategy, entry, store_dir, sources, checksum
+            )
+            drift[name] += [
+                (kind, f"{skill_name}/{rel}" if rel else skill_name) for kind, rel in found
+            ]
+            recorded = (entry or {}).get("files", {})
+            for rel, target_file, skill_source, st in candidates:
+                pending.append(
+                    (name, f"{skill_name}/{rel}", target_file, skill_source, rel, st, recorded)
+                )
+
+    def differs(item) -> bool:
+        _, _, target_file, skill_source, rel, st, recorded = item
+        expected = _expected_digest(skill_source, rel, st, recorded, sources)
+        return file_digest(target_file) != expected
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for item, changed in zip(pending, pool.map(differs, pending), strict=True):
+            if changed:
+                drift[item[0]].append(("modified", item[1]))
+    for entries in drift.values():
+        entries.sort(key=lambda entry: entry[1])
+    return drift
+
+
+def verify_command(argv: list[str]) -> int:
+    """deploy verify：檢查已部署的 skills 是否被修改，有差異時返回 1"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="deploy verify", description="檢查每個 target 中已部署的 skills 是否與 source 一致"
+    )
+    parser.add_argument(
+        "config",
+        nargs="?",
+        default="skills_config.toml",
+        help="Config 檔案路徑 (預設: skills_config.toml)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=_positive_int,
+        default=os.cpu_count() or 1,
+        metavar="N",
+        help="平行計算 digest 的 worker 數量 (預設: CPU 數)",
+    )
+    parser.add_argument(
+        "--checksum",
+        action="store_true",
+        help="比對所有檔案的內容，不使用 stat 快速判斷",
+    )
+    args = parser.parse_args(argv)
+
+    config_path = Path(args.config)
+    plan = load_plan(config_path)
+    for message in plan["messages"]:
+        print(message)
+    if not plan["ok"]:
+        return 1
+    source_dirs = [Path(path) for path in plan["source_dirs"]]
+    skills, not_found = resolve_skills(config_path, plan["skills"], source_dirs)
+    if not_found:
+        print(f"⚠ Not found: {', '.join(not_found)}")
+
+    drift = verify_targets(plan, skills, args.jobs, args.checksum)
+    for name, entries in drift.items():
+        if not entries:
+            print(f"✓ {name}: {len(skills)} skills verified")
+            continue
+        kinds = [kind for kind, _ in entries]
+        summary = ", ".join(
+            f"{kinds.count(kind)} {kind}"
+            for kind in ("modified", "missing", "extra")
+            if kind in kinds
+        )
+        print(f"✗ {name}: drift detected ({summary})")
+        for kind, path in entries:
+            print(f"    {kind}: {path}")
+    if any(drift.values()):
+        print("💡 執行 deploy --force 重新同步所有 skills")
+        return 1
+    return 0
+
+
+# skill catalog：從每個 skill 的 SKILL.md frontmatter 建立的 SQLite 索引
+SKILL_FILE = "SKILL.md"
+CATALOG_VERSION = 1
+CATALOG_SCHEMA = """
+CREATE TABLE skills (
+    skill TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL,
+    source TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL
+)
+"""
+
+
+def _consume_frontmatter(f) -> bytes:
     """
-    在多個 source 目錄中搜尋 skill
+    從檔案開頭讀取兩行 --- 之間的 YAML frontmatter，檔案位置停在結束的 --- 之後
 
-    Args:
-        skill_name: skill 名稱
-        source_dirs: source 目錄列表
+    沒有 frontmatter (或沒有結束的 ---) 時返回 b""，檔案位置回到開頭
+    """
+    if f.readline().rstrip() == b"---":
+        lines = []
+        for line in f:
+            if line.rstrip() == b"---":
+                return b"".join(lines)
+            lines.append(line)
+    f.seek(0)
+    return b""
+
+
+def read_frontmatter(path: Path) -> bytes:
+    """讀取 SKILL.md 的 frontmatter；只讀到結束的 --- 為止，不讀取後面的內容"""
+    with open(path, "rb") as f:
+        return _consume_frontmatter(f)
+
+
+def read_skill_body(path: Path) -> str:
+    """讀取 SKILL.md frontmatter 之後的內文"""
+    with open(path, "rb") as f:
+        _consume_frontmatter(f)
+        return f.read().decode("utf-8", errors="replace")
+
+
+def _frontmatter_scalar(value: str) -> str:
+    """去掉 YAML 純量的引號：雙引號依 JSON 規則處理跳脫字元，單引號中 '' 代表 '"""
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value[1:-1]
+    if len(value) >= 2 and value[0] == value[-1] == "'":
+        return value[1:-1].replace("''", "'")
+    return value
+
+
+def parse_frontmatter(text: str) -> dict[str, str]:
+    """
+    解析 SKILL.md frontmatter 中第一層的 key: value
+
+    只支援 skills 實際使用的 YAML 子集：純量、單/雙引號字串、
+    > (folded) 與 | (literal) 區塊，以及縮排的續行；巢狀結構以原文保留。
+    """
+    fields: dict[str, str] = {}
+    key = None
+    style = ""
+    block: list[str] = []
+
+    def flush():
+        if key is None:
+            return
+        if style.startswith("|"):
+            fields[key] = "\n".join(block).strip()
+        elif style.startswith(">"):
+            # folded：同一段落的行以空白連接，空行代表換行
+            paragraphs = "\n".join(block).split("\n\n")
+            fields[key] = "\n".join(" ".join(p.split()) for p in paragraphs).strip()
+        else:
+            fields[key] = _frontmatter_scalar(" ".join(block).strip())
+
+    for line in text.splitlines():
+        if line[:1] not in ("", " ", "\t", "#") and ":" in line:
+            flush()
+            key, _, value = line.partition(":")
+            key = key.strip()
+            value = value.strip()
+            style = value if value[:1] in (">", "|") else ""
+            block = [] if style or not value else [value]
+        elif key is not None and not line.startswith("#"):
+            block.append(line.strip())
+    flush()
+    return fields
+
+
+def catalog_path(config_path: Path) -> Path:
+    """config 的 skill catalog，存放在 config 旁的 .deploy-cache 中"""
+    return config_cache_dir(config_path) / f"catalog-{config_path.name}.sqlite3"
+
+
+def open_catalog(config_path: Path):
+    """開啟 (必要時建立) skill catalog；schema 版本不同時重新建立"""
+    import sqlite3
+
+    path = catalog_path(config_path)
+    path.parent.mkdir(exist_ok=True)
+    conn = sqlite3.connect(path)
+    if conn.execute("PRAGMA user_version").fetchone()[0] != CATALOG_VERSION:
+        conn.close()
+        path.unlink(missing_ok=True)
+        conn = sqlite3.connect(path)
+        with conn:
+            conn.executescript(CATALOG_SCHEMA)
+            conn.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+    return conn
+
+
+@traced("update_catalog")
+def update_catalog(conn, source_dirs: list[Path]) -> tuple[int, int]:
+    """
+    以 sources 中的 skills 增量更新 catalog
+
+    每個 skill 只 stat 一次 SKILL.md，size 與 mtime 都與記錄相同時不讀取檔案；
+    與部署相同，同名的 skill 以先列出的 source 為準。沒有 SKILL.md 的目錄不列入。
 
     Returns:
-        找到的 skill 路徑，找不到則返回 None
+        (更新的 skills 數, 移除的 skills 數)
     """
-    for source_dir in source_dirs:
-        skill_path = source_dir / skill_name
-        if skill_path.exists() and skill_path.is_dir():
-            return skill_path
-    return None
+    recorded = {
+        skill: (source, size, mtime_ns)
+        for skill, source, size, mtime_ns in conn.execute(
+            "SELECT skill, source, size, mtime_ns FROM skills"
+        )
+    }
+    rows = []
+    present = set()
+    for skill, path in build_source_index(source_dirs).items():
+        try:
+            st = os.stat(path / SKILL_FILE)
+        except OSError:
+            continue
+        present.add(skill)
+        if recorded.get(skill) == (str(path), st.st_size, st.st_mtime_ns):
+            continue
+        try:
+            frontmatter = read_frontmatter(path / SKILL_FILE)
+        except OSError:
+            continue
+        fields = parse_frontmatter(frontmatter.decode("utf-8", errors="replace"))
+        rows.append(
+            (
+                skill,
+                fields.get("name") or skill,
+                fields.get("description", ""),
+                str(path),
+                st.st_size,
+                st.st_mtime_ns,
+                sha256_hex(frontmatter),
+            )
+        )
+    removed = [(skill,) for skill in recorded.keys() - present]
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO skills VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.executemany("DELETE FROM skills WHERE skill = ?", removed)
+    return len(rows), len(removed)
 
 
-def expand_path(path_str: str, config_dir: Path) -> Path:
+def _open_updated_catalog(config_path: Path) -> tuple[Any, dict[str, Any]]:
     """
-    展開路徑，支援:
-    - ~ (home directory)
-    - 相對路徑 (相對於 config 檔案所在目錄)
+    讀取 config 的部署計畫並以它的 sources 更新 catalog
+
+    Returns:
+        (catalog 連線 (skills 或 sources 設定無效時為 None), 部署計畫)
     """
-    path = Path(path_str).expanduser()
+    plan = load_plan(config_path)
+    # catalog 只需要 sources；所有 targets 都停用 (或無效) 時仍可列出與搜尋 skills
+    if not plan["source_dirs"]:
+        for message in plan["messages"]:
+            print(message)
+        return None, plan
+    conn = open_catalog(config_path)
+    update_catalog(conn, [Path(path) for path in plan["source_dirs"]])
+    return conn, plan
 
-    # 如果是相對路徑，相對於 config 檔案所在目錄
-    if not path.is_absolute():
-        path = (config_dir / path).resolve()
 
-    return path
+def list_command(argv: list[str]) -> int:
+    """deploy list：列出 sources 中所有 skills 的名稱與描述"""
+    import argparse
 
+    parser = argparse.ArgumentParser(
+        prog="deploy list", description="列出 sources 中所有 skills (依 SKILL.md frontmatter)"
+    )
+    parser.add_argument(
+        "config",
+        nargs="?",
+        default="skills_config.toml",
+        help="Config 檔案路徑 (預設: skills_config.toml)",
+    )
+    args = parser.parse_args(argv)
 
-def load_config(config_path: Path) -> dict[str, Any]:
-    """讀取 TOML config 檔案"""
-    try:
-        with open(config_path, "rb") as f:
-            config = tomllib.load(f)
-        return config
-    except FileNotFoundError:
-        print(f"錯誤: Config 檔案不存在: {config_path}")
-        sys.exit(1)
-    except tomllib.TOMLDecodeError as e:
-        print(f"錯誤: Config 檔案格式錯誤: {e}")
-        sys.exit(1)
+    conn, plan = _open_updated_catalog(Path(args.config))
+    if conn is None:
+        return 1
+    with contextlib.closing(conn):
+        rows = conn.execute("SELECT skill, description FROM skills ORDER BY skill").fetchall()
+    configured = {skill for skill, _ in rows if skill in plan["skills"]}
+    width = max((len(skill) for skill, _ in rows), default=0)
+    for skill, description in rows:
+        marker = "●" if skill in configured else " "
+        summary = " ".join(description.split())
+        if len(summary) > 80:
+            summary = summary[:79] + "…"
+        print(f"{marker} {skill:<{width}}  {summary}")
+    print(f"\n{len(rows)} skills ({len(configured)} 個已在 config 中，以 ● 標示)")
+    return 0
+
+
+def info_command(argv: list[str]) -> int:
+    """deploy info：顯示一個 skill 的 frontmatter 與來源"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="deploy info", description="顯示 skill 的詳細資訊")
+    parser.add_argument("skill", help="skill 名稱 (目錄名稱)")
+    parser.add_argument(
+        "config",
+        nargs="?",
+        default="skills_config.toml",
+        help="Config 檔案路徑 (預設: skills_config.toml)",
+    )
+    args = parser.parse_args(argv)
 
+    conn, _ = _open_updated_catalog(Path(args.config))
+    if conn is None:
+        return 1
+    with contextlib.closing(conn):
+        row = conn.execute(
+            "SELECT name, description, source, size, digest FROM skills WHERE skill = ?",
+            (args.skill,),
+        ).fetchone()
+    if row is None:
+        print(f"✗ 找不到 skill: {args.skill}")
+        return 1
+    name, description, source, size, digest = row
+    print(f"name:        {name}")
+    print(f"source:      {source}")
+    print(f"SKILL.md:    {size} bytes (frontmatter sha256 {digest[:12]})")
+    print("description:")
+    for line in description.splitlines() or [""]:
+        print(f"  {line}")
+    return 0
 
-def copy_skill(source: Path, target: Path, dry_run: bool = False) -> bool:
+
+# 全文搜尋：FTS5 index 中各欄位的 bm25 權重 (skill 目錄名稱、name、description、SKILL.md 內文)
+SEARCH_WEIGHTS = (10.0, 10.0, 5.0, 1.0)
+SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_docs (
+    id INTEGER PRIMARY KEY,
+    skill TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+    skill, name, description, body, tokenize = 'unicode61'
+);
+"""
+
+
+@traced("update_search_index")
+def update_search_index(conn) -> int:
     """
-    複製 skill 目錄
+    以 catalog 中的 skills 增量更新 FTS5 全文索引
 
-    Args:
-        source: skill 來源目錄
-        target: 目標路徑 (完整路徑，包含 skill 名稱)
-        dry_run: 只顯示操作，不實際執行
+    先執行 update_catalog；只有 SKILL.md 的 size 或 mtime 與索引時不同的 skills
+    才會重新讀取內文，FTS5 的 rowid 對應 search_docs.id 以便直接替換。
 
     Returns:
-        是否成功複製
+        重新索引的 skills 數
     """
-    # 檢查 source 是否存在
-    if not source.exists():
-        print(f"  ⚠️  來源不存在，跳過: {source}")
-        return False
-
-    # 如果 target 已存在
-    if target.exists():
-        if dry_run:
-            print(f"  🔄 將覆蓋: {target}")
-        else:
-            # 移除已存在的目錄或檔案
-            if target.is_file():
-                target.unlink()
-                print(f"  🗑️  已移除舊檔案: {target}")
-            elif target.is_dir():
-                shutil.rmtree(target)
-                print(f"  🗑️  已移除舊目錄: {target}")
+    conn.executescript(SEARCH_SCHEMA)
+    indexed = {
+        skill: (doc_id, size, mtime_ns)
+        for doc_id, skill, size, mtime_ns in conn.execute(
+            "SELECT id, skill, size, mtime_ns FROM search_docs"
+        )
+    }
+    catalog = conn.execute(
+        "SELECT skill, name, description, source, size, mtime_ns FROM skills"
+    ).fetchall()
+    changed = 0
+    with conn:
+        for skill, name, description, source, size, mtime_ns in catalog:
+            doc = indexed.pop(skill, None)
+            if doc is not None and doc[1:] == (size, mtime_ns):
+                continue
+            try:
+                body = read_skill_body(Path(source) / SKILL_FILE)
+            except OSError:
+                continue
+            if doc is not None:
+                conn.execute("DELETE FROM search_fts WHERE rowid = ?", (doc[0],))
+            doc_id = conn.execute(
+                "INSERT OR REPLACE INTO search_docs (id, skill, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                (doc[0] if doc else None, skill, size, mtime_ns),
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO search_fts (rowid, skill, name, description, body) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (doc_id, skill, name, description, body),
+            )
+            changed += 1
+        # catalog 中已不存在的 skills
+        for doc_id, _, _ in indexed.values():
+            conn.execute("DELETE FROM search_fts WHERE rowid = ?", (doc_id,))
+            conn.execute("DELETE FROM search_docs WHERE id = ?", (doc_id,))
+    return changed
 
-    # 複製目錄
-    if dry_run:
-        print(f"  ➡️  {source} -> {target}")
-    else:
-        try:
-            shutil.copytree(source, target)
-            print(f"  ✅ 已複製: {target.name} <- {source}")
-            return True
-        except Exception as e:
-            print(f"  ❌ 複製失敗: {e}")
-            return False
 
-    return True
+def fts_query(text: str) -> str:
+    """將使用者輸入轉成 FTS5 查詢：每個詞都是前綴比對的 phrase，所有詞都必須出現"""
+    terms = text.split()
+    return " ".join('"{}"*'.format(term.replace('"', '""')) for term in terms)
 
 
-def link_skills(config_path: Path, dry_run: bool = False, verbose: bool = False):
+def search_catalog(conn, query: str, limit: int = 10) -> list[tuple[str, str, str]]:
     """
-    主要執行函式：根據 config 複製 skills
+    以 bm25 排序搜尋 skills
 
-    Config 格式：
-    - skills: skill 名稱列表 (例如：["architect", "frontend-design"])
-    - sources.paths: skill 來源目錄列表 (例如：["./skills", "~/external-skills"])
-    - targets: 目標 IDE 目錄設定
+    Returns:
+        [(skill, description, SKILL.md 內文的片段 (符合的字詞以 [] 標示))]，最相關的在前
     """
-    log(f"📖 讀取 config: {config_path}\n", verbose)
-    config = load_config(config_path)
-    config_dir = config_path.parent
+    weights = ", ".join(str(weight) for weight in SEARCH_WEIGHTS)
+    return conn.execute(
+        "SELECT skill, description, snippet(search_fts, 3, '[', ']', '…', 12) "
+        "FROM search_fts WHERE search_fts MATCH ? "
+        f"ORDER BY bm25(search_fts, {weights}) LIMIT ?",
+        (fts_query(query), limit),
+    ).fetchall()
 
-    # 解析 skills
-    skills_config = config.get("skills", [])
 
-    # 檢查 skills 格式
-    if not isinstance(skills_config, list) or not skills_config:
-        print("⚠ Config 中沒有定義任何 skills")
-        return
+def search_command(argv: list[str]) -> int:
+    """deploy search：以全文搜尋 sources 中的 skills"""
+    import argparse
+    import sqlite3
 
-    if not isinstance(skills_config[0], str):
-        print("✗ skills 必須是字串列表")
-        print('  正確格式：skills = ["skill1", "skill2"]')
-        return
+    parser = argparse.ArgumentParser(
+        prog="deploy search",
+        description="搜尋 sources 中的 skills (名稱、frontmatter 描述與 SKILL.md 內文)",
+    )
+    parser.add_argument("query", help="搜尋字詞 (以空白分隔，所有字詞都必須出現，可比對前綴)")
+    parser.add_argument(
+        "config",
+        nargs="?",
+        default="skills_config.toml",
+        help="Config 檔案路徑 (預設: skills_config.toml)",
+    )
+    parser.add_argument(
+        "-n",
+        "--limit",
+        type=_positive_int,
+        default=10,
+        metavar="N",
+        help="最多顯示幾筆結果 (預設: 10)",
+    )
+    args = parser.parse_args(argv)
 
-    skill_names = skills_config
+    if not args.query.split():
+        print("✗ 請輸入搜尋字詞")
+        return 1
+    conn, plan = _open_updated_catalog(Path(args.config))
+    if conn is None:
+        return 1
+    with contextlib.closing(conn):
+        try:
+            update_search_index(conn)
+        except sqlite3.OperationalError as e:
+            print(f"✗ 無法建立全文索引 (SQLite 需要支援 FTS5): {e}")
+            return 1
+        results = search_catalog(conn, args.query, args.limit)
 
-    # 解析 sources
-    sources_config = config.get("sources", {})
-    source_paths_str = sources_config.get("paths", [])
+    if not results:
+        print(f"找不到符合 '{args.query}' 的 skills")
+        return 1
+    width = max(len(skill) for skill, _, _ in results)
+    for skill, description, snippet in results:
+        marker = "●" if skill in plan["skills"] else " "
+        summary = " ".join(description.split())
+        if len(summary) > 80:
+            summary = summary[:79] + "…"
+        print(f"{marker} {skill:<{width}}  {summary}")
+        if "[" in snippet:
+            print(f"  {'':<{width}}  {' '.join(snippet.split())}")
+    return 0
 
-    if not source_paths_str:
-        print("⚠ Config 中沒有定義 sources.paths")
-        return
 
-    # 展開 source 路徑
-    source_dirs = [expand_path(path, config_dir) for path in source_paths_str]
+# token 估計：英文單字每 6 個字母約 1 個 token、數字每 3 位 1 個，其他非空白字元各 1 個
+TOKEN_PATTERN = re.compile(r"([A-Za-z]+)|([0-9]+)|\S")
+TOKEN_CACHE_VERSION = 1
+# deploy cost 的分類：SKILL.md、references/ 底下的檔案，其他檔案都算 assets
+COST_PARTS = ("SKILL.md", "references", "assets")
 
-    log(f"📚 找到 {len(source_dirs)} 個 source 目錄", verbose)
-    log(f"🎯 找到 {len(skill_names)} 個 skills\n", verbose)
 
-    # 建立 skills 列表（帶有實際路徑）
-    skills = []
-    not_found_skills = []
-    for skill_name in skill_names:
-        skill_path = find_skill_in_sources(skill_name, source_dirs)
-        if skill_path:
-            skills.append({"name": skill_name, "path": skill_path})
+def estimate_tokens(data: bytes) -> int:
+    """
+    粗略估計文字被 agent 載入 context 時的 token 數 (接近 BPE tokenizer，不需要詞彙表)
+
+    含有 NUL 的檔案視為二進位檔 (agent 不會當成文字讀取)，估計為 0。
+    """
+    if b"\0" in data:
+        return 0
+    tokens = 0
+    for match in TOKEN_PATTERN.finditer(data.decode("utf-8", errors="replace")):
+        if match.lastindex == 1:
+            tokens += 1 + (len(match.group()) - 1) // 6
+        elif match.lastindex == 2:
+            tokens += (len(match.group()) + 2) // 3
         else:
-            not_found_skills.append(skill_name)
-            log(f"⚠️  找不到 skill: {skill_name}", verbose)
+            tokens += 1
+    return tokens
 
-    if not skills:
-        print("⚠ 沒有可連結的 skills")
-        return
 
-    # 解析 targets
-    targets = config.get("targets", {})
-    if not targets:
-        print("⚠ Config 中沒有定義任何 targets")
-        return
+class TokenCache:
+    """
+    以檔案 digest 為 key 的 token 估計快取，存放在 config 旁的 .deploy-cache 中
 
-    enabled_targets = {
-        name: target_config
-        for name, target_config in targets.items()
-        if target_config.get("enabled", False)
-    }
+    另外記錄每個檔案上次的 (size, mtime, digest)：stat 沒有變更的檔案不需要讀取，
+    內容相同的檔案 (不同 skills、sources 或改名後) 共用同一個估計值。
+    """
 
-    if not enabled_targets:
-        print("⚠ 沒有啟用的 targets (enabled = true)")
-        return
+    def __init__(self, config_path: Path):
+        self.path = config_cache_dir(config_path) / f"tokens-{config_path.name}.json"
+        self._files: dict[str, list] = {}
+        self._tokens: dict[str, int] = {}
+        self._seen: dict[str, list] = {}
+        self._dirty = False
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached["version"] == TOKEN_CACHE_VERSION:
+                self._files = dict(cached["files"])
+                self._tokens = dict(cached["tokens"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
 
-    log(f"📍 啟用的 targets: {', '.join(enabled_targets.keys())}\n", verbose)
+    def tokens(self, path: Path, st: FileStat) -> int:
+        """檔案的估計 token 數；stat 與記錄相同時不讀取檔案"""
+        key = str(path)
+        old = self._files.get(key)
+        if old and old[0] == st.size and old[1] == st.mtime_ns and old[2] in self._tokens:
+            self._seen[key] = old
+            return self._tokens[old[2]]
 
-    if dry_run:
-        log("🔍 Dry-run 模式 (不會實際複製檔案)\n", verbose)
-        print("[dry-run]")
+        data = path.read_bytes()
+        digest = sha256_hex(data)
+        if digest not in self._tokens:
+            self._tokens[digest] = estimate_tokens(data)
+        self._seen[key] = self._files[key] = [st.size, st.mtime_ns, digest]
+        self._dirty = True
+        return self._tokens[digest]
 
-    # 收集錯誤訊息
-    failed_skills: list[tuple[str, str]] = []  # (skill_name, error_message)
+    def save(self):
+        """寫入快取；只保留這次用到的檔案與 digests，移除的檔案不會一直累積"""
+        if not self._dirty and self._seen.keys() == self._files.keys():
+            return
+        digests = {info[2] for info in self._seen.values()}
+        write_cache_file(
+            self.path,
+            {
+                "version": TOKEN_CACHE_VERSION,
+                "files": self._seen,
+                "tokens": {digest: self._tokens[digest] for digest in digests},
+            },
+        )
 
-    # 對每個 enabled target 建立連結
-    for target_name, target_config in enabled_targets.items():
-        log(f"🎯 處理 target: {target_name}", verbose)
 
-        target_base_dir = expand_path(target_config["path"], config_dir)
-        log(f"   目標目錄: {target_base_dir}", verbose)
+def _cost_part(rel: str) -> str:
+    """檔案在 deploy cost 中的分類 (見 COST_PARTS)"""
+    if rel == SKILL_FILE:
+        return "SKILL.md"
+    if rel.startswith("references/"):
+        return "references"
+    return "assets"
 
-        # 建立目標目錄 (如果不存在)
-        if not target_base_dir.exists():
-            if dry_run:
-                log(f"   📁 將建立目錄: {target_base_dir}", verbose)
-            else:
-                target_base_dir.mkdir(parents=True, exist_ok=True)
-                log(f"   📁 已建立目錄: {target_base_dir}", verbose)
 
-        # 收集所有應該存在的 skill 名稱
-        expected_skills = {skill["name"] for skill in skills}
+def skill_token_costs(
+    skills: dict[str, Path], cache: TokenCache, sources: SourceCache | None = None
+) -> dict[str, dict[str, int]]:
+    """
+    估計每個 skill 的 token 數
+
+    Args:
+        skills: {skill 名稱: 來源路徑}
+        cache: token 估計快取
+        sources: 若提供，透過它掃描 source 目錄 (與部署共用掃描結果)
 
-        # 檢查並清理不在 config 中的舊項目
-        removed_count = 0
-        if target_base_dir.exists():
-            for item in target_base_dir.iterdir():
-                if item.name not in expected_skills:
-                    # 這個項目不在 config 中，應該移除
-                    if dry_run:
-                        log(f"   🗑️  將移除 (不在 config 中): {item.name}", verbose)
-                        removed_count += 1
-                    else:
-                        if item.is_symlink():
-                            item.unlink()
-                            log(f"   🗑️  已移除 symlink (不在 config 中): {item.name}", verbose)
-                        elif item.is_file():
-                            item.unlink()
-                            log(f"   🗑️  已移除 (不在 config 中): {item.name}", verbose)
-                        elif item.is_dir():
-                            shutil.rmtree(item)
-                            log(f"   🗑️  已移除 (不在 config 中): {item.name}", verbose)
-                        removed_count += 1
-
-        # 為每個 skill 複製或更新目錄
-        success_count = 0
-
-        for skill in skills:
-            skill_name = skill["name"]
-            skill_source = skill["path"]
-            skill_target = target_base_dir / skill_name
-
-            # 檢查 source 是否存在
-            if not skill_source.exists():
-                log(f"  ⚠️  來源不存在，跳過: {skill_source}", verbose)
-                continue
+    Returns:
+        {skill 名稱: {COST_PARTS 中的分類: token 數}}
+    """
+    costs = {}
+    for name, path in skills.items():
+        files = sources.scan(path)[0] if sources else scan_tree(path)
+        parts = dict.fromkeys(COST_PARTS, 0)
+        for rel, st in files.items():
+            parts[_cost_part(rel)] += cache.tokens(path / rel, st)
+        costs[name] = parts
+    return costs
 
-            # 如果 target 已存在
-            if skill_target.exists():
-                # 目錄已存在，需要更新
-                if dry_run:
-                    log(f"  🔄 將更新: {skill_name}", verbose)
-                else:
-                    # 移除舊目錄並重新複製
-                    if skill_target.is_symlink() or skill_target.is_file():
-                        skill_target.unlink()
-                    elif skill_target.is_dir():
-                        shutil.rmtree(skill_target)
-                    log(f"  🔄 更新: {skill_name}", verbose)
-
-            # 複製目錄
-            if not skill_target.exists() or dry_run:
-                if dry_run:
-                    log(f"  ➕ 將複製: {skill_name} <- {skill_source}", verbose)
-                    success_count += 1
-                else:
-                    try:
-                        shutil.copytree(skill_source, skill_target)
-                        log(f"  ✅ 已複製: {skill_name} <- {skill_source}", verbose)
-                        success_count += 1
-                    except Exception as e:
-                        failed_skills.append((skill_name, str(e)))
-                        log(f"  ❌ 複製失敗: {e}", verbose)
-
-        # 顯示統計
-        log(f"   ✨ 完成: {success_count}/{len(skills)} 個 skills\n", verbose)
-
-        # 簡化輸出
-        summary_parts = [f"{success_count} synced"]
-        if removed_count > 0:
-            summary_parts.append(f"{removed_count} removed")
 
-        if dry_run:
-            summary_parts = [f"{success_count} to sync"]
-            if removed_count > 0:
-                summary_parts.append(f"{removed_count} to remove")
-            print(f"  {target_name}: {', '.join(summary_parts)}")
-        else:
-            print(f"✓ {target_name}: {', '.join(summary_parts)}")
+def cost_command(argv: list[str]) -> int:
+    """deploy cost：估計每個 skill 與每個 target 的 token 數，超過 max_tokens 時返回 1"""
+    import argparse
 
-    # 顯示警告和錯誤
-    if not_found_skills:
-        print(f"⚠ Not found: {', '.join(not_found_skills)}")
+    parser = argparse.ArgumentParser(
+        prog="deploy cost",
+        description="估計 skills 載入 agent context 的 token 數 (SKILL.md、references、assets)",
+    )
+    parser.add_argument(
+        "config",
+        nargs="?",
+        default="skills_config.toml",
+        help="Config 檔案路徑 (預設: skills_config.toml)",
+    )
+    args = parser.parse_args(argv)
 
-    if failed_skills:
-        for skill_name, error in failed_skills:
-            print(f"✗ Failed: {skill_name} ({error})")
+    config_path = Path(args.config)
+    plan = load_plan(config_path)
+    for message in plan["messages"]:
+        print(message)
+    # 估計 token 數只需要 sources；沒有啟用的 targets 時只是不檢查 max_tokens
+    if not plan["source_dirs"]:
+        return 1
+    source_dirs = [Path(path) for path in plan["source_dirs"]]
+    skills, not_found = resolve_skills(config_path, plan["skills"], source_dirs)
 
-    if dry_run:
-        log("\n💡 這是 dry-run 模式的結果", verbose)
-        log("   要實際複製檔案，請執行: ./deploy.py", verbose)
+    cache = TokenCache(config_path)
+    costs = skill_token_costs(skills, cache, SourceCache(plan["exclude"], plan["skill_exclude"]))
+    cache.save()
+
+    totals = {part: sum(parts[part] for parts in costs.values()) for part in COST_PARTS}
+    width = max([len(name) for name in costs] + [len("total")])
+
+    def row(name: str, columns: list) -> str:
+        return f"{name:<{width}}" + "".join(f"  {column:>10}" for column in columns)
+
+    print(row("skill", [*COST_PARTS, "total"]))
+    for name, parts in costs.items():
+        print(row(name, [*parts.values(), sum(parts.values())]))
+    print(row("total", [*totals.values(), sum(totals.values())]))
+    if not_found:
+        print(f"⚠ Not found: {', '.join(not_found)}")
+
+    # 每個 target 部署相同的 skills，差別在於各自的 max_tokens
+    print()
+    total = sum(totals.values())
+    split = " / ".join(f"{part} {totals[part]}" for part in COST_PARTS)
+    exceeded = False
+    for name, target_config in expand_targets(plan["targets"]).items():
+        limit = target_config.get("max_tokens")
+        if limit is None:
+            print(f"  {name}: {total} tokens ({split})")
+        elif total > limit:
+            print(f"✗ {name}: {total} tokens ({split})，超過 max_tokens ({limit})")
+            exceeded = True
+        else:
+            print(f"✓ {name}: {total} tokens ({split})，max_tokens {limit}")
+    return 1 if exceeded else 0
+
+
+# deploy 的子命令；第一個參數不是子命令時視為一般部署
+SUBCOMMANDS = {
+    "gc": gc_command,
+    "build-bundle": build_bundle_command,
+    "apply-bundle": apply_bundle_command,
+    "verify": verify_command,
+    "list": list_command,
+    "info": info_command,
+    "search": search_command,
+    "cost": cost_command,
+}
 
 
-def main():
+def main(argv: list[str] | None = None):
     """主程式入口"""
     import argparse
 
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in SUBCOMMANDS:
+        sys.exit(SUBCOMMANDS[argv[0]](argv[1:]))
+
     parser = argparse.ArgumentParser(
         description="從 skills 資料庫複製 skills 到各 IDE 的 skills 目錄"
     )
@@ -330,11 +4052,104 @@ def main():
         action="store_true",
         help="顯示詳細輸出",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=_positive_int,
+        default=1,
+        metavar="N",
+        help="同時處理 targets 與 skills 的 worker 總數，每個裝置另有各自的上限 (預設: 1)",
+    )
+
+    parser.add_argument(
+        "--copy-mode",
+        choices=COPY_MODES,
+        default="auto",
+        help="檔案複製方式：reflink (copy-on-write)、copy (一般複製) 或 auto (預設，"
+        "依序嘗試 reflink、copy_file_range、一般複製)",
+    )
+
+    parser.add_argument(
+        "--checksum",
+        action="store_true",
+        help="dry-run 時對 stat 不同但 size 相同的檔案比對內容，只列出內容真的不同的檔案",
+    )
+
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="不使用 manifest 與 target 中的檔案，重新複製所有 skills (修復 verify 回報的差異)",
+    )
+
+    parser.add_argument(
+        "--no-atomic",
+        dest="atomic",
+        action="store_false",
+        help="直接在 target 中更新檔案，不先建立 staging 目錄再以 rename 換上",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="部署後持續監看 source 目錄與 config，只重新同步有變更的 skills",
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="watch 模式改用 polling (不使用 inotify)",
+    )
+
+    parser.add_argument(
+        "--wait-trash",
+        action="store_true",
+        help="結束前等待背景刪除完成 (預設下次執行時繼續刪除沒刪完的項目)",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        metavar="FILE",
+        help="部署完成後以 Prometheus textfile 格式寫入 metrics (供 node_exporter 收集)",
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        metavar="FILE",
+        help="將各階段、target 與 skill 的執行時間以 Chrome trace-event 格式寫入 FILE "
+        "(可在 chrome://tracing 或 Perfetto 中檢視)",
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     config_path = Path(args.config)
-    link_skills(config_path, args.dry_run, args.verbose)
+    deploy_options = {
+        "dry_run": args.dry_run,
+        "verbose": args.verbose,
+        "jobs": args.jobs,
+        "copy_mode": args.copy_mode,
+        "atomic": args.atomic,
+        "metrics_file": args.metrics_file,
+        "checksum": args.checksum,
+        "force": args.force,
+    }
+    tracer = start_tracing() if args.trace else None
+    failed = False
+    try:
+        if args.watch:
+            with contextlib.suppress(KeyboardInterrupt):
+                watch_skills(config_path, poll=args.poll, **deploy_options)
+        else:
+            results = link_skills(config_path, **deploy_options)
+            failed = any(result.error for result in results)
+        if args.wait_trash:
+            wait_for_trash()
+    finally:
+        if tracer is not None:
+            stop_tracing()
+            tracer.save(args.trace)
+            log(f"📈 trace 已寫入: {args.trace}", args.verbose)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
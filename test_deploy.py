@@ -6,16 +6,41 @@ Tests for deploy.py
 真正的 TDD 應該先寫測試，看著它失敗，然後寫最少的程式碼讓它通過。
 """
 
+import json
+import os
+import shutil
+import sys
 from pathlib import Path
 
 import pytest
 
+import deploy
 from deploy import (
+    PollingWatcher,
+    affected_skills,
+    build_source_index,
+    compile_excludes,
+    copy_file,
     copy_skill,
+    cost_command,
+    estimate_tokens,
     expand_path,
     find_skill_in_sources,
+    gc_command,
+    info_command,
     link_skills,
+    list_command,
     load_config,
+    parse_frontmatter,
+    read_frontmatter,
+    resolve_skills,
+    scan_tree,
+    search_command,
+    stage_tree,
+    sync_tree,
+    target_state_dir,
+    verify_command,
+    watch_skills,
 )
 
 
@@ -75,6 +100,121 @@ class TestFindSkillInSources:
         assert result is None
 
 
+class TestBuildSourceIndex:
+    """測試單次掃描建立的 source 索引"""
+
+    def test_first_source_wins(self, tmp_path):
+        """同名 skill 出現在多個 sources 時，以先列出的 source 為準"""
+        source1 = tmp_path / "source1"
+        source2 = tmp_path / "source2"
+        (source1 / "architect").mkdir(parents=True)
+        (source2 / "architect").mkdir(parents=True)
+        (source2 / "pm").mkdir()
+
+        index = build_source_index([source1, source2])
+
+        assert index == {"architect": source1 / "architect", "pm": source2 / "pm"}
+
+    def test_ignores_files_and_missing_sources(self, tmp_path):
+        """只索引目錄，不存在的 source 目錄直接略過"""
+        source = tmp_path / "source"
+        source.mkdir()
+        (source / "README.md").write_text("not a skill")
+        (source / "skill").mkdir()
+
+        index = build_source_index([tmp_path / "missing", source])
+
+        assert index == {"skill": source / "skill"}
+
+    def test_follows_symlinked_skill_directories(self, tmp_path):
+        """指向目錄的 symlink 也視為 skill"""
+        real = tmp_path / "real"
+        real.mkdir()
+        source = tmp_path / "source"
+        source.mkdir()
+        (source / "linked").symlink_to(real)
+
+        assert build_source_index([source]) == {"linked": source / "linked"}
+
+    def test_matches_find_skill_in_sources(self, tmp_path):
+        """索引結果與逐一搜尋的結果一致"""
+        sources = [tmp_path / "a", tmp_path / "b"]
+        for source, names in zip(sources, (["x", "y"], ["y", "z"]), strict=True):
+            for name in names:
+                (source / name).mkdir(parents=True)
+
+        index = build_source_index(sources)
+
+        for name in ("x", "y", "z", "missing"):
+            assert index.get(name) == find_skill_in_sources(name, sources)
+
+
+class TestResolveSkills:
+    """測試持久化的 skill 解析快取"""
+
+    @pytest.fixture
+    def source(self, tmp_path):
+        source = tmp_path / "source"
+        (source / "architect").mkdir(parents=True)
+        return source
+
+    @pytest.fixture
+    def config_file(self, tmp_path):
+        config_file = tmp_path / "test.toml"
+        config_file.write_text("")
+        return config_file
+
+    def test_resolves_and_reports_missing(self, source, config_file):
+        """解析結果依 skills 順序，找不到的另外列出"""
+        resolved, not_found = resolve_skills(config_file, ["missing", "architect"], [source])
+
+        assert resolved == {"architect": source / "architect"}
+        assert not_found == ["missing"]
+
+    def test_cache_hit_skips_scanning(self, tmp_path, source, config_file, monkeypatch):
+        """source 目錄未變更時直接使用快取，不掃描 source"""
+        resolve_skills(config_file, ["architect"], [source])
+
+        def fail(*args):
+            raise AssertionError("source index should not be rebuilt")
+
+        monkeypatch.setattr(deploy, "build_source_index", fail)
+        resolved, _ = resolve_skills(config_file, ["architect"], [source])
+
+        assert resolved == {"architect": source / "architect"}
+        assert (tmp_path / ".deploy-cache" / "resolve-test.toml.json").exists()
+
+    def test_cache_invalidated_when_source_changes(self, source, config_file):
+        """source 目錄新增 skill 時快取失效"""
+        _, not_found = resolve_skills(config_file, ["architect", "pm"], [source])
+        assert not_found == ["pm"]
+
+        (source / "pm").mkdir()
+        resolved, not_found = resolve_skills(config_file, ["architect", "pm"], [source])
+
+        assert resolved["pm"] == source / "pm"
+        assert not_found == []
+
+    def test_cache_invalidated_when_skill_list_changes(self, source, config_file):
+        """skills 列表變更時快取失效"""
+        (source / "pm").mkdir()
+        resolve_skills(config_file, ["architect"], [source])
+
+        resolved, _ = resolve_skills(config_file, ["architect", "pm"], [source])
+
+        assert list(resolved) == ["architect", "pm"]
+
+    def test_corrupt_cache_is_ignored(self, tmp_path, source, config_file):
+        """損壞的快取檔案視為沒有快取"""
+        cache_dir = tmp_path / ".deploy-cache"
+        cache_dir.mkdir()
+        (cache_dir / "resolve-test.toml.json").write_text("[1, 2")
+
+        resolved, _ = resolve_skills(config_file, ["architect"], [source])
+
+        assert resolved == {"architect": source / "architect"}
+
+
 class TestExpandPath:
     """測試路徑展開功能"""
 
@@ -955,3 +1095,2069 @@ enabled = true
         assert (skill_link / "new.md").read_text() == "new"
         assert not (skill_link / "old.md").exists()
         assert "更新" in captured.out or "🔄" in captured.out
+
+
+@pytest.fixture
+def skills_dir(tmp_path):
+    """測試用的 source 目錄，每個子目錄是一個 skill"""
+    skills_dir = tmp_path / "skills"
+    skills_dir.mkdir()
+    return skills_dir
+
+
+@pytest.fixture
+def target_dir(tmp_path):
+    """預設 target 的部署目錄 (尚未建立)"""
+    return tmp_path / "ide" / "skills"
+
+
+@pytest.fixture
+def make_config(tmp_path, skills_dir, target_dir):
+    """
+    返回建立測試 config 的函數
+
+    config 只有 skills_dir 一個 source，skills 為呼叫當下 skills_dir 中的所有目錄；
+    targets 為 {名稱: 路徑}，預設只有部署到 target_dir 的 ide
+    """
+
+    def make(targets=None, extra="", target_extra=""):
+        config_file = tmp_path / "test.toml"
+        skill_names = ", ".join(f'"{p.name}"' for p in sorted(skills_dir.iterdir()))
+        target_sections = "".join(
+            f'\n[targets.{name}]\npath = "{path}"\nenabled = true\n{target_extra}\n'
+            for name, path in (targets or {"ide": target_dir}).items()
+        )
+        config_file.write_text(
+            f'skills = [{skill_names}]\n{extra}\n[sources]\npaths = ["{skills_dir}"]\n'
+            f"{target_sections}"
+        )
+        return config_file
+
+    return make
+
+
+class TestIncrementalSync:
+    """測試以 manifest 跳過未變更的 skills"""
+
+    @pytest.fixture
+    def skill(self, skills_dir):
+        skill = skills_dir / "skill"
+        (skill / "references").mkdir(parents=True)
+        (skill / "SKILL.md").write_text("content")
+        (skill / "references" / "go.md").write_text("go")
+        return skill
+
+    @pytest.fixture
+    def config_file(self, skill, make_config):
+        return make_config()
+
+    def test_writes_manifest_with_digests(self, target_dir, config_file):
+        """部署後應在 target 目錄寫入 manifest"""
+        import hashlib
+
+        link_skills(config_file)
+
+        manifest = json.loads((target_state_dir(target_dir) / "manifest.json").read_text())
+        files = manifest["skills"]["skill"]["files"]
+        assert set(files) == {"SKILL.md", "references/go.md"}
+        assert files["SKILL.md"][0] == len("content")
+        assert files["SKILL.md"][2] == hashlib.sha256(b"content").hexdigest()
+
+    def test_skips_unchanged_skill(self, target_dir, config_file, capsys):
+        """內容未變更時第二次部署應該跳過"""
+        link_skills(config_file)
+        marker = target_dir / "skill" / "SKILL.md"
+        inode = marker.stat().st_ino
+        capsys.readouterr()
+
+        link_skills(config_file, verbose=True)
+
+        captured = capsys.readouterr()
+        assert "未變更" in captured.out
+        assert "1 unchanged" in captured.out
+        assert marker.stat().st_ino == inode
+
+    def test_touched_file_with_same_content_is_unchanged(self, skill, config_file, capsys):
+        """只有 mtime 變更但內容相同時仍視為未變更"""
+        link_skills(config_file)
+        st = (skill / "SKILL.md").stat()
+        os.utime(skill / "SKILL.md", ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        capsys.readouterr()
+
+        link_skills(config_file, verbose=True)
+
+        assert "未變更" in capsys.readouterr().out
+
+    def test_resyncs_modified_skill(self, skill, target_dir, config_file):
+        """來源內容變更時應該重新部署"""
+        link_skills(config_file)
+
+        (skill / "references" / "go.md").write_text("go v2")
+        link_skills(config_file)
+
+        assert (target_dir / "skill" / "references" / "go.md").read_text() == "go v2"
+
+    def test_resyncs_when_target_was_removed(self, target_dir, config_file):
+        """target 中的 skill 被刪除時，即使 manifest 記錄未變更也要重新部署"""
+        link_skills(config_file)
+        shutil.rmtree(target_dir / "skill")
+
+        link_skills(config_file)
+
+        assert (target_dir / "skill" / "SKILL.md").read_text() == "content"
+
+    def test_manifest_is_kept_outside_target(self, tmp_path, target_dir, config_file):
+        """manifest 放在 target 旁邊，target 目錄只包含 skills"""
+        link_skills(config_file)
+
+        assert [p.name for p in target_dir.iterdir()] == ["skill"]
+        assert (tmp_path / "ide" / ".skills.deploy" / "manifest.json").exists()
+
+    def test_corrupt_manifest_triggers_full_deploy(self, target_dir, config_file):
+        """損壞的 manifest 應視為空的 manifest"""
+        target_state_dir(target_dir).mkdir(parents=True)
+        (target_state_dir(target_dir) / "manifest.json").write_text("{not json")
+
+        link_skills(config_file)
+
+        assert (target_dir / "skill" / "SKILL.md").read_text() == "content"
+
+
+class TestSyncTree:
+    """測試檔案層級的 delta 同步"""
+
+    @pytest.fixture
+    def source(self, tmp_path):
+        source = tmp_path / "source"
+        (source / "references").mkdir(parents=True)
+        (source / "assets").mkdir()
+        (source / "SKILL.md").write_text("skill")
+        (source / "references" / "go.md").write_text("go")
+        (source / "assets" / "template.md").write_text("template")
+        return source
+
+    def test_initial_sync_copies_everything(self, tmp_path, source):
+        """第一次同步複製所有檔案"""
+        target = tmp_path / "target"
+
+        stats = sync_tree(source, target)
+
+        assert stats.files_copied == 3
+        assert stats.bytes_copied == len("skill") + len("go") + len("template")
+        assert (target / "references" / "go.md").read_text() == "go"
+
+    def test_copies_only_modified_files(self, tmp_path, source):
+        """只複製有變更的檔案，其他檔案維持原 inode"""
+        target = tmp_path / "target"
+        sync_tree(source, target)
+        untouched_inode = (target / "assets" / "template.md").stat().st_ino
+
+        (source / "references" / "go.md").write_text("go v2")
+        stats = sync_tree(source, target)
+
+        assert stats.files_copied == 1
+        assert stats.files_deleted == 0
+        assert (target / "references" / "go.md").read_text() == "go v2"
+        assert (target / "assets" / "template.md").stat().st_ino == untouched_inode
+
+    def test_no_changes_is_noop(self, tmp_path, source):
+        """沒有變更時不執行任何檔案操作"""
+        target = tmp_path / "target"
+        sync_tree(source, target)
+
+        stats = sync_tree(source, target)
+
+        assert stats.files_copied == 0
+        assert stats.files_deleted == 0
+
+    def test_deletes_removed_files_and_directories(self, tmp_path, source):
+        """刪除 source 中已不存在的檔案與目錄"""
+        target = tmp_path / "target"
+        sync_tree(source, target)
+
+        shutil.rmtree(source / "assets")
+        (source / "references" / "go.md").unlink()
+        stats = sync_tree(source, target)
+
+        assert not (target / "assets").exists()
+        assert not (target / "references" / "go.md").exists()
+        assert (target / "references").is_dir()
+        assert stats.files_deleted == 2
+
+    def test_handles_file_directory_type_changes(self, tmp_path, source):
+        """source 中檔案與目錄互換時正確替換"""
+        target = tmp_path / "target"
+        sync_tree(source, target)
+
+        shutil.rmtree(source / "assets")
+        (source / "assets").write_text("now a file")
+        (source / "SKILL.md").unlink()
+        (source / "SKILL.md").mkdir()
+        (source / "SKILL.md" / "inner.md").write_text("inner")
+        sync_tree(source, target)
+
+        assert (target / "assets").read_text() == "now a file"
+        assert (target / "SKILL.md" / "inner.md").read_text() == "inner"
+
+    def test_does_not_write_through_hardlinks(self, tmp_path, source):
+        """target 檔案與 source 共用 inode 時，更新不可改寫 source"""
+        other = tmp_path / "other"
+        (other / "references").mkdir(parents=True)
+        (other / "references" / "go.md").write_text("other")
+        target = tmp_path / "target"
+        target.mkdir()
+        os.link(other / "references" / "go.md", tmp_path / "shared.md")
+        (target / "references").mkdir()
+        os.link(tmp_path / "shared.md", target / "references" / "go.md")
+
+        sync_tree(source, target)
+
+        assert (target / "references" / "go.md").read_text() == "go"
+        assert (other / "references" / "go.md").read_text() == "other"
+
+    def test_replaces_symlinked_target_without_touching_link_destination(self, tmp_path, source):
+        """target 是 symlink 時只移除 symlink，不動到它指向的目錄"""
+        elsewhere = tmp_path / "elsewhere"
+        elsewhere.mkdir()
+        (elsewhere / "keep.md").write_text("keep")
+        target = tmp_path / "target"
+        target.symlink_to(elsewhere)
+
+        sync_tree(source, target)
+
+        assert not target.is_symlink()
+        assert (target / "SKILL.md").read_text() == "skill"
+        assert (elsewhere / "keep.md").read_text() == "keep"
+
+
+class TestParallelDeploy:
+    """測試以 thread pool 平行處理 targets"""
+
+    @pytest.fixture
+    def targets(self, tmp_path, skills_dir):
+        for index in range(6):
+            skill = skills_dir / f"skill-{index}"
+            skill.mkdir()
+            (skill / "SKILL.md").write_text(f"skill {index}")
+        targets = {f"ide{index}": tmp_path / f"ide{index}" / "skills" for index in range(3)}
+        (targets["ide1"] / "stale").mkdir(parents=True)
+        return targets
+
+    @pytest.fixture
+    def config_file(self, targets, make_config):
+        return make_config(targets)
+
+    def test_parallel_deploy_syncs_all_targets(self, targets, config_file):
+        """jobs > 1 時所有 targets 都應該完整部署"""
+        results = link_skills(config_file, jobs=4)
+
+        assert [result.name for result in results] == ["ide0", "ide1", "ide2"]
+        for target_dir in targets.values():
+            names = sorted(p.name for p in target_dir.iterdir())
+            assert names == [f"skill-{index}" for index in range(6)]
+        assert results[1].removed == 1
+
+    def test_output_is_independent_of_jobs(self, targets, config_file, capsys):
+        """輸出順序不受 jobs 數影響"""
+        outputs = []
+        for jobs in (1, 8):
+            # 每次都從相同的 targets 狀態開始部署
+            deploy.wait_for_trash()
+            for target_dir in targets.values():
+                shutil.rmtree(target_dir.parent, ignore_errors=True)
+            (targets["ide1"] / "stale").mkdir(parents=True)
+            link_skills(config_file, verbose=True, jobs=jobs)
+            outputs.append(capsys.readouterr().out)
+
+        assert outputs[0] == outputs[1]
+        assert "✓ ide1: 6 synced, 1 removed" in outputs[0]
+
+
+class TestCopyFile:
+    """測試 reflink / copy_file_range / 一般複製的選擇與 fallback"""
+
+    @pytest.fixture(autouse=True)
+    def _reset_reflink_cache(self):
+        deploy._reflink_unsupported.clear()
+        deploy._copy_range_unsupported.clear()
+        yield
+        deploy._reflink_unsupported.clear()
+        deploy._copy_range_unsupported.clear()
+
+    @pytest.fixture
+    def source(self, tmp_path):
+        source = tmp_path / "source.md"
+        source.write_text("content")
+        os.utime(source, ns=(1_000_000_000, 1_000_000_000))
+        return source
+
+    def test_copy_mode_uses_plain_copy(self, tmp_path, source):
+        """copy 模式一律使用一般複製並保留 mtime"""
+        destination = tmp_path / "dest.md"
+
+        assert copy_file(source, destination, "copy") == "copy"
+        assert destination.read_text() == "content"
+        assert destination.stat().st_mtime_ns == 1_000_000_000
+
+    def test_auto_mode_copies_content(self, tmp_path, source):
+        """auto 模式不論使用哪種方式都要得到相同內容與 metadata"""
+        destination = tmp_path / "dest.md"
+
+        method = copy_file(source, destination, "auto")
+
+        assert method in {"reflink", "copy_file_range", "copy"}
+        assert destination.read_text() == "content"
+        assert destination.stat().st_mtime_ns == 1_000_000_000
+
+    def test_reflink_falls_back_to_copy_when_unsupported(self, tmp_path, source, monkeypatch):
+        """檔案系統不支援 FICLONE 時 reflink 模式改用一般複製"""
+        import errno
+        import fcntl
+
+        calls = []
+
+        def unsupported(*args):
+            calls.append(args)
+            raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+        monkeypatch.setattr(fcntl, "ioctl", unsupported)
+
+        assert copy_file(source, tmp_path / "a.md", "reflink") == "copy"
+        assert (tmp_path / "a.md").read_text() == "content"
+        assert (tmp_path / "a.md").stat().st_mtime_ns == 1_000_000_000
+        # 同一組裝置之後直接使用一般複製
+        assert copy_file(source, tmp_path / "b.md", "reflink") == "copy"
+        assert len(calls) == 1
+
+    def test_unsupported_reflink_is_tried_once_per_devices(self, tmp_path, source, monkeypatch):
+        """不支援 FICLONE 但支援 copy_file_range 時，每組裝置只嘗試一次 FICLONE"""
+        import errno
+        import fcntl
+
+        calls = []
+
+        def unsupported(*args):
+            calls.append(args)
+            raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+        def fake_copy_range(source_fd, destination_fd, count):
+            return os.write(destination_fd, os.read(source_fd, count))
+
+        monkeypatch.setattr(fcntl, "ioctl", unsupported)
+        monkeypatch.setattr(os, "copy_file_range", fake_copy_range, raising=False)
+
+        for name in ("a.md", "b.md", "c.md"):
+            assert copy_file(source, tmp_path / name, "auto") == "copy_file_range"
+            assert (tmp_path / name).read_text() == "content"
+        assert len(calls) == 1
+
+    def test_unsupported_copy_range_is_tried_once_per_devices(self, tmp_path, source, monkeypatch):
+        """兩種方式都不支援時，之後的檔案直接一般複製"""
+        import errno
+        import fcntl
+
+        calls = []
+
+        def unsupported(*args):
+            calls.append(args)
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        monkeypatch.setattr(fcntl, "ioctl", unsupported)
+        monkeypatch.setattr(os, "copy_file_range", unsupported, raising=False)
+
+        for name in ("a.md", "b.md", "c.md"):
+            assert copy_file(source, tmp_path / name, "auto") == "copy"
+            assert (tmp_path / name).read_text() == "content"
+        assert len(calls) == 2
+
+    def test_reflink_is_reported_when_supported(self, tmp_path, source, monkeypatch):
+        """FICLONE 成功時回報 reflink"""
+        import fcntl
+
+        def fake_clone(destination_fd, request, source_fd):
+            assert request == deploy.FICLONE
+            os.write(destination_fd, os.read(source_fd, 1024))
+
+        monkeypatch.setattr(fcntl, "ioctl", fake_clone)
+
+        assert copy_file(source, tmp_path / "dest.md", "reflink") == "reflink"
+        assert (tmp_path / "dest.md").read_text() == "content"
+
+    def test_other_errors_are_not_treated_as_unsupported(self, tmp_path, source, monkeypatch):
+        """I/O 錯誤與目標已存在不會改用一般複製，也不會刪除既有的目標"""
+        import errno
+        import fcntl
+
+        def broken(*args):
+            raise OSError(errno.EIO, "Input/output error")
+
+        monkeypatch.setattr(fcntl, "ioctl", broken)
+        with pytest.raises(OSError) as error:
+            copy_file(source, tmp_path / "a.md", "auto")
+        assert error.value.errno == errno.EIO
+
+        existing = tmp_path / "existing.md"
+        existing.write_text("keep")
+        with pytest.raises(FileExistsError):
+            copy_file(source, existing, "auto")
+        assert existing.read_text() == "keep"
+        assert not deploy._reflink_unsupported
+        assert not deploy._copy_range_unsupported
+
+    def test_link_skills_reports_copy_method(self, skills_dir, make_config, capsys):
+        """summary 應該列出 target 實際使用的複製方式"""
+        (skills_dir / "skill").mkdir()
+        (skills_dir / "skill" / "SKILL.md").write_text("content")
+        config_file = make_config()
+
+        link_skills(config_file, verbose=True, copy_mode="copy")
+
+        captured = capsys.readouterr()
+        assert "✓ ide: 1 synced [copy]" in captured.out
+        assert "複製方式: copy (1)" in captured.out
+
+
+class TestDeployStrategy:
+    """測試每個 target 的 copy / hardlink / symlink 部署方式"""
+
+    @pytest.fixture
+    def skill(self, skills_dir):
+        skill = skills_dir / "skill"
+        (skill / "references").mkdir(parents=True)
+        (skill / "SKILL.md").write_text("content")
+        (skill / "references" / "go.md").write_text("go")
+        return skill
+
+    def test_hardlink_shares_inodes_without_reading_data(
+        self, skill, target_dir, make_config, monkeypatch
+    ):
+        """hardlink 部署的檔案與 source 共用 inode，且不讀取任何內容"""
+        config_file = make_config(target_extra='strategy = "hardlink"')
+
+        def fail(*args):
+            raise AssertionError("hardlink deploy must not read file contents")
+
+        monkeypatch.setattr(deploy, "file_digest", fail)
+        link_skills(config_file)
+
+        deployed = target_dir / "skill" / "references" / "go.md"
+        assert deployed.stat().st_ino == (skill / "references" / "go.md").stat().st_ino
+        assert not (target_dir / "skill").is_symlink()
+
+    def test_hardlink_second_run_is_unchanged(self, skill, make_config, capsys):
+        """hardlink 部署沒有變更時第二次執行應跳過"""
+        config_file = make_config(target_extra='strategy = "hardlink"')
+        link_skills(config_file)
+        capsys.readouterr()
+
+        link_skills(config_file)
+
+        assert "1 unchanged" in capsys.readouterr().out
+
+    def test_switching_from_copy_to_hardlink_relinks_files(self, skill, target_dir, make_config):
+        """從 copy 改為 hardlink 時，既有的複本要換成 hardlink"""
+        config_file = make_config(target_extra='strategy = "copy"')
+        link_skills(config_file)
+        assert (target_dir / "skill" / "SKILL.md").stat().st_ino != (
+            skill / "SKILL.md"
+        ).stat().st_ino
+
+        config_file.write_text(config_file.read_text().replace('"copy"', '"hardlink"'))
+        link_skills(config_file)
+
+        assert (target_dir / "skill" / "SKILL.md").stat().st_ino == (
+            skill / "SKILL.md"
+        ).stat().st_ino
+
+    def test_symlink_strategy_links_skill_directory(self, skill, target_dir, make_config, capsys):
+        """symlink 部署將整個 skill 目錄連結到 source"""
+        config_file = make_config(target_extra='strategy = "symlink"')
+
+        link_skills(config_file)
+        link_skills(config_file)
+
+        assert (target_dir / "skill").is_symlink()
+        assert (target_dir / "skill").resolve() == skill.resolve()
+        assert "1 unchanged" in capsys.readouterr().out
+
+    def test_symlink_strategy_replaces_existing_directory(self, skill, target_dir, make_config):
+        """symlink 部署會替換已存在的目錄"""
+        config_file = make_config(target_extra='strategy = "symlink"')
+        (target_dir / "skill").mkdir(parents=True)
+        (target_dir / "skill" / "old.md").write_text("old")
+
+        link_skills(config_file)
+
+        assert (target_dir / "skill").is_symlink()
+        assert (target_dir / "skill" / "SKILL.md").read_text() == "content"
+        assert not (skill / "old.md").exists()
+
+    def test_symlink_strategy_replaces_symlink_to_other_source(
+        self, tmp_path, skill, target_dir, make_config
+    ):
+        """symlink 指向其他位置時會被替換"""
+        config_file = make_config(target_extra='strategy = "symlink"')
+        other = tmp_path / "other"
+        other.mkdir()
+        target_dir.mkdir(parents=True)
+        (target_dir / "skill").symlink_to(other)
+
+        link_skills(config_file)
+
+        assert (target_dir / "skill").resolve() == skill.resolve()
+        assert sorted(p.name for p in target_dir.iterdir()) == ["skill"]
+
+    def test_copy_after_symlink_does_not_modify_source(self, skill, target_dir, make_config):
+        """從 symlink 改回 copy 時，不可寫入 symlink 指向的 source"""
+        config_file = make_config(target_extra='strategy = "symlink"')
+        link_skills(config_file)
+
+        config_file.write_text(config_file.read_text().replace('"symlink"', '"copy"'))
+        link_skills(config_file)
+
+        assert not (target_dir / "skill").is_symlink()
+        assert (target_dir / "skill" / "SKILL.md").read_text() == "content"
+        assert sorted(p.name for p in skill.iterdir()) == ["SKILL.md", "references"]
+
+    def test_unknown_strategy_skips_target(self, skill, target_dir, make_config, capsys):
+        """未知的 strategy 顯示錯誤且不處理該 target"""
+        config_file = make_config(target_extra='strategy = "teleport"')
+
+        link_skills(config_file)
+
+        assert "未知的 strategy" in capsys.readouterr().out
+        assert not target_dir.exists()
+
+
+class TestContentStore:
+    """測試 content-addressed store 與 gc"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        for name in ("alpha", "beta"):
+            (skills_dir / name).mkdir()
+            (skills_dir / name / "SKILL.md").write_text(f"{name} skill")
+        (skills_dir / "alpha" / "run.sh").write_text("echo hi")
+        (skills_dir / "alpha" / "run.sh").chmod(0o755)
+        # beta 與 alpha 有一個內容相同的檔案
+        (skills_dir / "beta" / "shared.md").write_text("alpha skill")
+        return skills_dir
+
+    @pytest.fixture
+    def targets(self, tmp_path):
+        return {"ide1": tmp_path / "ide1" / "skills", "ide2": tmp_path / "ide2" / "skills"}
+
+    @pytest.fixture
+    def config_file(self, tmp_path, targets, make_config):
+        return make_config(
+            targets,
+            extra=f'[store]\npath = "{tmp_path / "store"}"\n',
+            target_extra='strategy = "store"',
+        )
+
+    def _blobs(self, tmp_path):
+        return sorted(p.name for p in (tmp_path / "store" / "objects").glob("*/*"))
+
+    def test_targets_share_blobs(self, tmp_path, targets, config_file):
+        """所有 targets 的檔案都 hardlink 到同一個 blob"""
+        link_skills(config_file, jobs=4)
+
+        first = targets["ide1"] / "alpha" / "SKILL.md"
+        second = targets["ide2"] / "alpha" / "SKILL.md"
+        duplicate = targets["ide2"] / "beta" / "shared.md"
+        assert first.read_text() == "alpha skill"
+        assert first.stat().st_ino == second.stat().st_ino == duplicate.stat().st_ino
+        # 3 個不同內容：alpha SKILL.md (與 beta shared.md 相同)、run.sh (可執行)、beta SKILL.md
+        assert len(self._blobs(tmp_path)) == 3
+        assert any(name.endswith("-x") for name in self._blobs(tmp_path))
+        assert os.access(targets["ide1"] / "alpha" / "run.sh", os.X_OK)
+
+    def test_second_run_is_unchanged(self, config_file, capsys):
+        """store 部署沒有變更時第二次執行應跳過"""
+        link_skills(config_file)
+        capsys.readouterr()
+
+        link_skills(config_file)
+
+        assert "✓ ide1: 0 synced, 2 unchanged" in capsys.readouterr().out
+
+    def test_modified_file_gets_new_blob(self, skills_dir, targets, config_file):
+        """修改來源檔案後 target 指向新的 blob，舊 blob 不被改寫"""
+        link_skills(config_file)
+        old_inode = (targets["ide1"] / "beta" / "SKILL.md").stat().st_ino
+
+        (skills_dir / "beta" / "SKILL.md").write_text("beta v2")
+        link_skills(config_file)
+
+        deployed = targets["ide1"] / "beta" / "SKILL.md"
+        assert deployed.read_text() == "beta v2"
+        assert deployed.stat().st_ino != old_inode
+
+    def test_gc_removes_unreferenced_blobs(
+        self, tmp_path, skills_dir, targets, config_file, capsys
+    ):
+        """gc 只移除沒有任何 target 引用的 blobs"""
+        link_skills(config_file)
+        (skills_dir / "beta" / "SKILL.md").write_text("beta v2")
+        link_skills(config_file)
+        capsys.readouterr()
+
+        assert gc_command([str(config_file), "--dry-run"]) == 0
+        assert "1 blobs to remove" in capsys.readouterr().out
+        assert len(self._blobs(tmp_path)) == 4
+
+        assert gc_command([str(config_file)]) == 0
+        assert "1 blobs removed" in capsys.readouterr().out
+        assert len(self._blobs(tmp_path)) == 3
+        assert (targets["ide1"] / "beta" / "SKILL.md").read_text() == "beta v2"
+
+    def test_gc_keeps_blobs_still_hardlinked_elsewhere(self, tmp_path, targets, config_file):
+        """manifest 沒有引用但仍被 hardlink 的 blob 要保留"""
+        link_skills(config_file)
+        for manifest_owner in targets.values():
+            (target_state_dir(manifest_owner) / "manifest.json").unlink()
+
+        gc_command([str(config_file)])
+
+        assert len(self._blobs(tmp_path)) == 3
+
+
+class TestStagedDeploy:
+    """測試在 staging 目錄建立後以 rename 換上的部署"""
+
+    @pytest.fixture
+    def source(self, skills_dir):
+        source = skills_dir / "skill"
+        (source / "references").mkdir(parents=True)
+        (source / "SKILL.md").write_text("skill")
+        (source / "references" / "go.md").write_text("go")
+        return source
+
+    @pytest.fixture
+    def target(self, tmp_path, source):
+        """已部署 source 舊版本、並多了一個 stale.md 的 skill 目錄"""
+        target = tmp_path / "deployed" / "skill"
+        target.parent.mkdir()
+        sync_tree(source, target)
+        (target / "stale.md").write_text("stale")
+        return target
+
+    @pytest.fixture
+    def stage(self, tmp_path):
+        """與 target 在不同目錄 (同一個檔案系統) 的 staging 目錄"""
+        (tmp_path / "state").mkdir()
+        return tmp_path / "state" / "skill"
+
+    @pytest.mark.parametrize("exchange", [True, False])
+    def test_swaps_new_version_into_place(self, source, target, stage, monkeypatch, exchange):
+        """新版本換上後，舊目錄被移到 replaced_tree 等待刪除"""
+        if not exchange:
+            monkeypatch.setattr(deploy, "_rename_exchange", lambda first, second: False)
+        (source / "SKILL.md").write_text("skill v2")
+
+        stats = stage_tree(source, target, stage)
+
+        assert (target / "SKILL.md").read_text() == "skill v2"
+        assert not (target / "stale.md").exists()
+        assert stats.files_copied == 1
+        assert stats.files_deleted == 1
+        assert (stats.replaced_tree / "stale.md").read_text() == "stale"
+        assert stats.replaced_tree.parent == stage.parent
+        assert [p.name for p in target.parent.iterdir()] == ["skill"]
+
+    def test_unchanged_files_are_hardlinked_from_old_version(self, source, target, stage):
+        """沒有變更的檔案從舊版本以 hardlink 帶過來，不重新複製"""
+        old_inode = (target / "references" / "go.md").stat().st_ino
+
+        stats = stage_tree(source, target, stage)
+
+        assert stats.files_copied == 0
+        assert (target / "references" / "go.md").stat().st_ino == old_inode
+
+    def test_new_skill_is_renamed_into_place(self, tmp_path, source, stage):
+        """target 不存在時直接以 rename 放到位置上"""
+        target = tmp_path / "deployed" / "skill"
+        target.parent.mkdir()
+
+        stats = stage_tree(source, target, stage)
+
+        assert stats.replaced_tree is None
+        assert (target / "references" / "go.md").read_text() == "go"
+        assert [p.name for p in target.parent.iterdir()] == ["skill"]
+
+    def test_failure_keeps_old_version(self, source, target, stage, monkeypatch):
+        """建立 staging 失敗時，舊版本保持完整且 staging 目錄被清除"""
+        (source / "SKILL.md").write_text("skill v2")
+
+        def broken_copy(*args):
+            raise OSError("disk full")
+
+        monkeypatch.setattr(deploy, "copy_file", broken_copy)
+        with pytest.raises(OSError):
+            stage_tree(source, target, stage)
+
+        assert (target / "SKILL.md").read_text() == "skill"
+        assert sorted(p.name for p in target.parent.iterdir()) == ["skill"]
+        assert list(stage.parent.iterdir()) == []
+
+    def test_link_skills_stages_outside_target(self, source, target_dir, make_config, monkeypatch):
+        """staging 與換下來的舊目錄都在狀態目錄中，target 目錄中只會出現 skills"""
+        config_file = make_config()
+        link_skills(config_file)
+        (source / "SKILL.md").write_text("skill v2")
+        listings = []
+        original = deploy.swap_into_place
+
+        def recording_swap(staged, target):
+            listings.append(sorted(p.name for p in target_dir.iterdir()))
+            retired = original(staged, target)
+            listings.append(sorted(p.name for p in target_dir.iterdir()))
+            return retired
+
+        monkeypatch.setattr(deploy, "swap_into_place", recording_swap)
+
+        link_skills(config_file, jobs=2)
+        deploy.wait_for_trash()
+
+        assert listings == [["skill"], ["skill"]]
+        assert list(deploy.stage_dir(target_dir).iterdir()) == []
+        assert (target_dir / "skill" / "SKILL.md").read_text() == "skill v2"
+
+    @pytest.mark.parametrize("strategy", ["copy", "symlink"])
+    def test_target_on_its_own_filesystem(
+        self, source, target_dir, make_config, monkeypatch, strategy
+    ):
+        """target 目錄是掛載點時在 target 中 staging (rename 不能跨檔案系統)，完成後移除"""
+        config_file = make_config(target_extra=f'strategy = "{strategy}"')
+        (target_dir / "skill").mkdir(parents=True)
+        (target_dir / "skill" / "old.md").write_text("old")
+        original_stat = os.stat
+
+        def mounted_stat(path, *args, **kwargs):
+            st = original_stat(path, *args, **kwargs)
+            if Path(path) == target_dir:
+                return os.stat_result((st[0], st[1], st.st_dev + 1, *st[3:10]))
+            return st
+
+        monkeypatch.setattr(os, "stat", mounted_stat)
+
+        assert deploy.stage_dir(target_dir) == target_dir / ".deploy-stage"
+        results = link_skills(config_file)
+        deploy.wait_for_trash()
+
+        assert results[0].count("synced") == 1
+        assert sorted(p.name for p in target_dir.iterdir()) == ["skill"]
+        assert (target_dir / "skill" / "SKILL.md").read_text() == "skill"
+        assert not (target_dir / "skill" / "old.md").exists()
+
+    def test_non_atomic_mode_updates_in_place(self, source, target_dir, make_config):
+        """atomic=False 時直接在 target 中更新，目錄本身不被替換"""
+        config_file = make_config()
+        link_skills(config_file)
+        dir_inode = (target_dir / "skill").stat().st_ino
+        (source / "SKILL.md").write_text("skill v2")
+
+        link_skills(config_file, atomic=False)
+
+        assert (target_dir / "skill").stat().st_ino == dir_inode
+        assert (target_dir / "skill" / "SKILL.md").read_text() == "skill v2"
+
+
+class TestWatchMode:
+    """測試 watch 模式的變更偵測與重新同步"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        for name in ("alpha", "beta"):
+            (skills_dir / name / "references").mkdir(parents=True)
+            (skills_dir / name / "SKILL.md").write_text(name)
+        return skills_dir
+
+    @pytest.fixture
+    def config_file(self, make_config):
+        return make_config()
+
+    def _wait_for(self, condition, timeout=5.0):
+        import time
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if condition():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_maps_changed_paths_to_skills(self, tmp_path, skills_dir, config_file):
+        """skill 目錄中的變更對應到該 skill"""
+        resolved = {"alpha": skills_dir / "alpha", "beta": skills_dir / "beta"}
+        changed = {skills_dir / "alpha" / "references" / "go.md", tmp_path / "unrelated.txt"}
+
+        affected, reload = affected_skills(
+            changed, config_file, ["alpha", "beta"], [skills_dir], resolved
+        )
+
+        assert affected == {"alpha"}
+        assert reload is False
+
+    def test_config_change_requires_reload(self, skills_dir, config_file):
+        """config 檔案變更時需要完整重新部署"""
+        affected, reload = affected_skills({config_file}, config_file, ["alpha"], [skills_dir], {})
+
+        assert reload is True
+
+    def test_new_configured_skill_in_source_requires_reload(self, skills_dir, config_file):
+        """source 目錄出現 config 中的 skill 時重新解析並同步它"""
+        affected, reload = affected_skills(
+            {skills_dir / "gamma"}, config_file, ["alpha", "gamma"], [skills_dir], {}
+        )
+
+        assert affected == {"gamma"}
+        assert reload is True
+
+    def test_polling_watcher_detects_changes(self, skills_dir):
+        """polling watcher 偵測新增與修改的檔案"""
+        watcher = PollingWatcher(interval=0.01)
+        watcher.add(skills_dir / "alpha", recursive=True)
+
+        (skills_dir / "alpha" / "references" / "new.md").write_text("new")
+        changed = watcher.read(0.01)
+
+        assert skills_dir / "alpha" / "references" / "new.md" in changed
+        assert watcher.read(0.01) == set()
+
+    @pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify 只支援 Linux")
+    def test_inotify_watcher_follows_new_subdirectories(self, skills_dir):
+        """inotify watcher 自動監看新建立的子目錄"""
+        from deploy import InotifyWatcher
+
+        watcher = InotifyWatcher()
+        try:
+            watcher.add(skills_dir / "alpha", recursive=True)
+            (skills_dir / "alpha" / "assets").mkdir()
+            assert skills_dir / "alpha" / "assets" in watcher.read(1.0)
+
+            (skills_dir / "alpha" / "assets" / "a.md").write_text("a")
+            assert skills_dir / "alpha" / "assets" / "a.md" in watcher.read(1.0)
+        finally:
+            watcher.close()
+
+    @pytest.mark.parametrize("poll", [False, True])
+    def test_watch_resyncs_changed_skill(self, skills_dir, target_dir, config_file, poll):
+        """編輯 source 後只重新同步該 skill"""
+        import threading
+
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=watch_skills,
+            args=(config_file,),
+            kwargs={"stop": stop, "poll": poll, "debounce": 0.05, "interval": 0.05},
+        )
+        thread.start()
+        try:
+            assert self._wait_for(lambda: (target_dir / "beta" / "SKILL.md").exists())
+            beta_inode = (target_dir / "beta").stat().st_ino
+
+            (skills_dir / "alpha" / "references" / "go.md").write_text("go")
+
+            deployed = target_dir / "alpha" / "references" / "go.md"
+            assert self._wait_for(lambda: deployed.exists() and deployed.read_text() == "go")
+            assert (target_dir / "beta").stat().st_ino == beta_inode
+        finally:
+            stop.set()
+            thread.join(timeout=5)
+        assert not thread.is_alive()
+
+    def test_only_skills_keeps_manifest_of_other_skills(self, skills_dir, config_file, capsys):
+        """只同步部分 skills 時，其他 skills 的 manifest 記錄保持不變"""
+        link_skills(config_file)
+        (skills_dir / "alpha" / "SKILL.md").write_text("alpha v2")
+
+        results = link_skills(config_file, only_skills={"alpha"})
+        capsys.readouterr()
+
+        assert [skill.name for skill in results[0].skills] == ["alpha"]
+        link_skills(config_file)
+        assert "2 unchanged" in capsys.readouterr().out
+
+
+class TestBenchmark:
+    """測試合成 workload 的效能量測"""
+
+    def test_phases_report_bytes_and_file_ops(self, tmp_path):
+        """cold 寫入所有檔案、warm 只寫入變更、no-op 沒有任何檔案操作"""
+        from bench_deploy import run_benchmark
+
+        report = run_benchmark(
+            skills=3, files_per_skill=4, sizes="fixed:100", targets=2, work_dir=tmp_path
+        )
+        phases = report["phases"]
+
+        assert phases["cold"]["bytes_written"] == 3 * 4 * 100 * 2
+        assert phases["cold"]["skills_synced"] == 6
+        assert 0 < phases["warm"]["file_ops"] < phases["cold"]["file_ops"]
+        assert phases["noop"]["file_ops"] == 0
+        assert phases["noop"]["skills_unchanged"] == 6
+        assert list(tmp_path.iterdir()) == []
+
+    def test_invalid_size_distribution(self):
+        """無效的檔案大小分佈會拋出 ValueError"""
+        import random
+
+        from bench_deploy import parse_size_distribution
+
+        with pytest.raises(ValueError):
+            parse_size_distribution("normal:10", random.Random())
+
+
+class TestTracing:
+    """測試 --trace 輸出的 Chrome trace events"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        for name in ("alpha", "beta"):
+            (skills_dir / name).mkdir()
+            (skills_dir / name / "SKILL.md").write_text(name)
+        return skills_dir
+
+    @pytest.fixture
+    def config_file(self, make_config):
+        return make_config()
+
+    def test_trace_records_nested_spans(self, tmp_path, config_file, capsys):
+        """每個階段、target 與 skill 都有 span，且子 span 落在父 span 的時間內"""
+        trace_file = tmp_path / "trace.json"
+
+        deploy.main([str(config_file), "-j", "2", "--trace", str(trace_file)])
+
+        events = json.loads(trace_file.read_text())["traceEvents"]
+        spans = [event for event in events if event["ph"] == "X"]
+        names = {event["name"] for event in spans}
+        assert {"link_skills", "load_config", "resolve_skills", "prune", "sync_skill"} <= names
+        skills = sorted(event["args"]["skill"] for event in spans if event["name"] == "sync_skill")
+        assert skills == ["alpha", "beta"]
+
+        (root,) = [event for event in spans if event["name"] == "link_skills"]
+        for event in spans:
+            assert root["ts"] <= event["ts"]
+            assert event["ts"] + event["dur"] <= root["ts"] + root["dur"] + 1
+        assert any(event["name"] == "thread_name" for event in events)
+        assert deploy._tracer is None
+
+    def test_span_is_noop_when_disabled(self, capsys):
+        """未啟用 tracing 時 span 返回共用的 nullcontext，不記錄任何東西"""
+        assert deploy.span("a") is deploy.span("b")
+        tracer = deploy.start_tracing()
+        try:
+            with deploy.span("work", skill="alpha"):
+                pass
+        finally:
+            assert deploy.stop_tracing() is tracer
+        assert [event["name"] for event in tracer.events] == ["work"]
+        assert tracer.events[0]["args"] == {"skill": "alpha"}
+
+
+class TestMetricsFile:
+    """測試 --metrics-file 輸出的 Prometheus textfile metrics"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        for name in ("alpha", "beta"):
+            (skills_dir / name).mkdir()
+            (skills_dir / name / "SKILL.md").write_text(name)
+        return skills_dir
+
+    @pytest.fixture
+    def config_file(self, tmp_path, target_dir, make_config):
+        return make_config({"ide": target_dir, "cursor": tmp_path / "cursor" / "skills"})
+
+    def _samples(self, metrics_file):
+        samples = {}
+        for line in metrics_file.read_text().splitlines():
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_writes_per_target_metrics(self, tmp_path, config_file, capsys):
+        """每個 target 都有 synced、unchanged 與 bytes 等 metrics"""
+        metrics_file = tmp_path / "textfile" / "deploy.prom"
+
+        link_skills(config_file, metrics_file=metrics_file)
+        samples = self._samples(metrics_file)
+        assert samples['deploy_skills_synced{target="ide"}'] == 2
+        assert samples['deploy_bytes_copied{target="cursor"}'] == len("alpha") + len("beta")
+        assert samples['deploy_target_duration_seconds{target="ide"}'] > 0
+        assert samples["deploy_run_success"] == 1
+
+        link_skills(config_file, metrics_file=metrics_file)
+        samples = self._samples(metrics_file)
+        assert samples['deploy_skills_synced{target="ide"}'] == 0
+        assert samples['deploy_skills_unchanged{target="ide"}'] == 2
+        assert samples['deploy_files_copied{target="ide"}'] == 0
+        assert [p.name for p in metrics_file.parent.iterdir()] == ["deploy.prom"]
+
+    def test_dry_run_does_not_write_metrics(self, tmp_path, config_file, capsys):
+        """dry-run 不寫入 metrics"""
+        metrics_file = tmp_path / "deploy.prom"
+
+        link_skills(config_file, dry_run=True, metrics_file=metrics_file)
+        assert not metrics_file.exists()
+
+
+class TestDeviceScheduling:
+    """測試依 target 所在裝置分組的 I/O 排程"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        for index in range(4):
+            (skills_dir / f"skill-{index}").mkdir()
+            (skills_dir / f"skill-{index}" / "SKILL.md").write_text(str(index))
+        return skills_dir
+
+    @pytest.fixture
+    def targets(self, tmp_path):
+        return {"ssd": tmp_path / "ssd" / "skills", "hdd": tmp_path / "hdd" / "skills"}
+
+    def test_device_limits(self, monkeypatch):
+        """傳統硬碟只有一個 worker，target 的 jobs 設定會限制整個裝置"""
+        monkeypatch.setattr(deploy, "is_rotational", lambda device: device == 2)
+        results = [
+            deploy.TargetResult(name=name, base_dir=Path(name), device=device)
+            for name, device in (("a", 1), ("b", 1), ("c", 2), ("d", 3))
+        ]
+        configs = {"a": {}, "b": {"jobs": 2}, "c": {}, "d": {}}
+
+        assert deploy.device_limits(results, configs, 8) == {1: 2, 2: 1, 3: 8}
+
+    def test_skills_run_on_their_device_pool(self, targets, make_config, monkeypatch, capsys):
+        """每個 target 的 skills 只在所屬裝置的 workers 上執行"""
+        import threading
+
+        config_file = make_config(targets)
+        monkeypatch.setattr(deploy, "device_of", lambda path: 2 if "hdd" in path.parts else 1)
+        monkeypatch.setattr(deploy, "is_rotational", lambda device: device == 2)
+        threads = {}
+        original = deploy._sync_skill
+
+        def recording_sync(target, skill, options):
+            threads.setdefault(target.name, set()).add(threading.current_thread().name)
+            return original(target, skill, options)
+
+        monkeypatch.setattr(deploy, "_sync_skill", recording_sync)
+
+        results = link_skills(config_file, jobs=4)
+
+        assert [result.count("synced") for result in results] == [4, 4]
+        assert len(threads["hdd"]) == 1
+        assert all(name.startswith("dev-0:1") for name in threads["ssd"])
+        assert all(name.startswith("dev-0:2") for name in threads["hdd"])
+
+    def test_jobs_caps_workers_across_devices(self):
+        """所有裝置合計同時執行的 workers 不超過 jobs"""
+        import threading
+        import time
+
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def work(item):
+            with lock:
+                running.append(item)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(item)
+            return item
+
+        items = list(range(24))
+        results = deploy.run_by_device(work, items, lambda item: item % 3, {0: 4, 1: 4, 2: 4}, 4)
+
+        assert results == items
+        assert max(peak) <= 4
+
+    def test_invalid_target_jobs(self, targets, make_config, capsys):
+        """target 的 jobs 不是正整數時跳過該 target"""
+        config_file = make_config(targets, target_extra="jobs = 0")
+
+        assert link_skills(config_file) == []
+        assert "jobs 必須是正整數" in capsys.readouterr().out
+
+
+class TestTrash:
+    """測試先移到 trash、再於背景刪除的清理方式"""
+
+    @pytest.fixture
+    def config_file(self, skills_dir, target_dir, make_config):
+        (skills_dir / "alpha").mkdir()
+        (skills_dir / "alpha" / "SKILL.md").write_text("alpha")
+        stale = target_dir / "stale" / "references"
+        stale.mkdir(parents=True)
+        (stale / "big.md").write_text("x" * 1000)
+        return make_config()
+
+    def test_stale_directory_is_moved_to_trash(self, target_dir, config_file, capsys):
+        """不在 config 中的目錄立即從 target 消失，並在背景刪除"""
+        results = link_skills(config_file)
+        assert results[0].removed == 1
+        assert sorted(p.name for p in target_dir.iterdir()) == ["alpha"]
+
+        deploy.wait_for_trash()
+        assert list(deploy.trash_dir(target_dir).iterdir()) == []
+
+    def test_leftovers_are_removed_on_next_run(self, target_dir, config_file, capsys):
+        """上次沒刪完的 trash 項目在下次執行時刪除"""
+        leftover = deploy.trash_dir(target_dir) / "old" / "nested"
+        leftover.mkdir(parents=True)
+
+        link_skills(config_file)
+        deploy.wait_for_trash()
+
+        assert list(deploy.trash_dir(target_dir).iterdir()) == []
+
+    def test_replaced_tree_goes_through_trash(self, skills_dir, target_dir, config_file, capsys):
+        """staged 部署換下來的舊目錄不會留在 target 中"""
+        link_skills(config_file)
+        (skills_dir / "alpha" / "SKILL.md").write_text("alpha v2")
+
+        link_skills(config_file)
+        deploy.wait_for_trash()
+
+        assert sorted(p.name for p in target_dir.iterdir()) == ["alpha"]
+        assert (target_dir / "alpha" / "SKILL.md").read_text() == "alpha v2"
+        assert list(deploy.trash_dir(target_dir).iterdir()) == []
+
+    def test_discard_without_trash_removes_directly(self, tmp_path):
+        """沒有 trash 目錄時直接刪除"""
+        victim = tmp_path / "victim"
+        (victim / "sub").mkdir(parents=True)
+
+        deploy._trash.discard(victim, None)
+
+        assert not victim.exists()
+
+    def test_wait_trash_flag(self, target_dir, config_file, capsys):
+        """--wait-trash 結束前刪除完成"""
+        deploy.main([str(config_file), "--wait-trash"])
+
+        assert list(deploy.trash_dir(target_dir).iterdir()) == []
+
+
+class TestBundle:
+    """測試 build-bundle / apply-bundle"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        (skills_dir / "alpha" / "references").mkdir(parents=True)
+        (skills_dir / "alpha" / "SKILL.md").write_text("alpha")
+        (skills_dir / "alpha" / "references" / "guide.md").write_text("guide")
+        (skills_dir / "beta").mkdir()
+        (skills_dir / "beta" / "SKILL.md").write_text("beta")
+        return skills_dir
+
+    @pytest.fixture
+    def targets(self, tmp_path, target_dir):
+        return {"ide": target_dir, "cursor": tmp_path / "cursor" / "skills"}
+
+    @pytest.fixture
+    def config_file(self, targets, make_config):
+        return make_config(targets)
+
+    def test_build_and_apply(self, tmp_path, targets, config_file, capsys):
+        """bundle 套用後每個 target 都有完整的 skills，MANIFEST.json 是第一個 member"""
+        import tarfile
+
+        bundle = tmp_path / "skills.tar.gz"
+
+        assert deploy.build_bundle_command([str(config_file), "-o", str(bundle)]) == 0
+        with tarfile.open(bundle) as tar:
+            assert tar.getnames()[0] == "MANIFEST.json"
+
+        assert deploy.apply_bundle_command([str(bundle), str(config_file)]) == 0
+        for target_dir in targets.values():
+            assert (target_dir / "alpha" / "references" / "guide.md").read_text() == "guide"
+            assert (target_dir / "beta" / "SKILL.md").read_text() == "beta"
+
+    def test_apply_skips_matching_digests(self, tmp_path, targets, config_file, capsys):
+        """再次套用時 digest 相同的檔案不會重寫，被修改的檔案會被還原"""
+        bundle = tmp_path / "skills.tar"
+        deploy.build_bundle_command([str(config_file), "-o", str(bundle)])
+        deploy.apply_bundle(bundle, config_file)
+
+        results = deploy.apply_bundle(bundle, config_file)
+        assert [result.total("files_copied") for result in results] == [0, 0]
+        assert [result.count("unchanged") for result in results] == [2, 2]
+
+        (targets["ide"] / "beta" / "SKILL.md").write_text("edited locally")
+        results = deploy.apply_bundle(bundle, config_file)
+        assert [result.total("files_copied") for result in results] == [1, 0]
+        assert (targets["ide"] / "beta" / "SKILL.md").read_text() == "beta"
+
+    def test_apply_removes_items_not_in_bundle(self, tmp_path, targets, config_file, capsys):
+        """bundle 中沒有的 skills 與檔案會被移除"""
+        bundle = tmp_path / "skills.tar"
+        deploy.build_bundle_command([str(config_file), "-o", str(bundle)])
+        (targets["ide"] / "stale").mkdir(parents=True)
+        (targets["ide"] / "alpha" / "references").mkdir(parents=True)
+        (targets["ide"] / "alpha" / "references" / "old.md").write_text("old")
+
+        deploy.apply_bundle(bundle, config_file)
+
+        assert sorted(p.name for p in targets["ide"].iterdir()) == ["alpha", "beta"]
+        assert not (targets["ide"] / "alpha" / "references" / "old.md").exists()
+
+    def test_invalid_bundle(self, config_file, capsys):
+        """不是 bundle 的檔案會回報錯誤"""
+        assert deploy.apply_bundle_command([str(config_file), str(config_file)]) == 1
+        assert "無法套用 bundle" in capsys.readouterr().out
+
+    @pytest.mark.parametrize(
+        ("name", "rel"),
+        [
+            ("../escape", "SKILL.md"),
+            ("/escape", "SKILL.md"),
+            (".", "SKILL.md"),
+            ("alpha", "../../escape.md"),
+            ("alpha", "/escape.md"),
+            ("alpha", "references//escape.md"),
+        ],
+    )
+    def test_rejects_paths_outside_skill(self, tmp_path, targets, config_file, capsys, name, rel):
+        """skill 名稱或檔案路徑會離開 skill 目錄的 bundle，在修改任何 target 前被拒絕"""
+        import io
+        import tarfile
+
+        manifest = {
+            "version": deploy.BUNDLE_VERSION,
+            "skills": {name: {"dirs": [], "files": {rel: [4, 0, "digest", 0o644]}}},
+        }
+        bundle = tmp_path / "evil.tar"
+        with tarfile.open(bundle, "w") as tar:
+            for member, data in (
+                (deploy.BUNDLE_MANIFEST, json.dumps(manifest).encode()),
+                (f"skills/{name}/{rel}", b"evil"),
+            ):
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        (targets["ide"] / "stale").mkdir(parents=True)
+
+        assert deploy.apply_bundle_command([str(bundle), str(config_file)]) == 1
+        assert "不合法" in capsys.readouterr().out
+        assert (targets["ide"] / "stale").is_dir()
+        assert not list(tmp_path.rglob("escape*"))
+
+    def test_rejects_link_members(self, tmp_path, targets, config_file, capsys):
+        """含有 symlink 等非一般檔案 member 的 bundle 被拒絕，不會建立連結"""
+        import tarfile
+
+        bundle = tmp_path / "skills.tar"
+        deploy.build_bundle_command([str(config_file), "-o", str(bundle)])
+        with tarfile.open(bundle, "a") as tar:
+            info = tarfile.TarInfo("skills/alpha/escape")
+            info.type = tarfile.SYMTYPE
+            info.linkname = str(tmp_path)
+            tar.addfile(info)
+
+        assert deploy.apply_bundle_command([str(bundle), str(config_file)]) == 1
+        assert "不支援的 member" in capsys.readouterr().out
+        assert not (targets["ide"] / "alpha" / "escape").is_symlink()
+
+    def test_does_not_write_through_symlinks_in_target(self, tmp_path, targets, config_file):
+        """target 中指向其他位置的 symlink 目錄會被替換成真正的目錄，不會寫到連結的目的地"""
+        bundle = tmp_path / "skills.tar"
+        deploy.build_bundle_command([str(config_file), "-o", str(bundle)])
+        outside = tmp_path / "outside"
+        outside.mkdir()
+        (targets["ide"] / "alpha").mkdir(parents=True)
+        (targets["ide"] / "alpha" / "references").symlink_to(outside)
+
+        deploy.apply_bundle(bundle, config_file)
+
+        assert list(outside.iterdir()) == []
+        references = targets["ide"] / "alpha" / "references"
+        assert not references.is_symlink()
+        assert (references / "guide.md").read_text() == "guide"
+
+    def test_rejects_member_not_matching_digest(self, tmp_path, targets, config_file):
+        """member 內容與 manifest 的 digest 不符時不換上，也不留下暫存檔"""
+        import io
+        import tarfile
+
+        bundle = tmp_path / "skills.tar"
+        deploy.build_bundle_command([str(config_file), "-o", str(bundle)])
+        tampered = tmp_path / "tampered.tar"
+        with tarfile.open(bundle) as src, tarfile.open(tampered, "w") as dst:
+            for member in src:
+                data = src.extractfile(member).read() if member.isfile() else None
+                if member.name == "skills/beta/SKILL.md":
+                    data = b"evil"
+                    member.size = len(data)
+                dst.addfile(member, io.BytesIO(data) if data is not None else None)
+
+        with pytest.raises(ValueError, match="digest 不符"):
+            deploy.apply_bundle(tampered, config_file)
+
+        for target_dir in targets.values():
+            assert not (target_dir / "beta" / "SKILL.md").exists()
+            assert not [p for p in target_dir.rglob("*") if p.name.startswith(".deploy-")]
+
+    def test_temp_file_does_not_follow_planted_symlink(
+        self, tmp_path, targets, config_file, monkeypatch
+    ):
+        """規劃之後才出現在 target 中的 .deploy-tmp- symlink 不會被寫入"""
+        bundle = tmp_path / "skills.tar"
+        deploy.build_bundle_command([str(config_file), "-o", str(bundle)])
+        victim = tmp_path / "victim.txt"
+        victim.write_text("keep")
+        original = deploy._plan_bundle_skill
+
+        def plan_then_plant(target, name, *args):
+            result = original(target, name, *args)
+            (target.base_dir / name).mkdir(parents=True, exist_ok=True)
+            (target.base_dir / name / ".deploy-tmp-SKILL.md").symlink_to(victim)
+            return result
+
+        monkeypatch.setattr(deploy, "_plan_bundle_skill", plan_then_plant)
+
+        deploy.apply_bundle(bundle, config_file)
+
+        assert victim.read_text() == "keep"
+        assert (targets["ide"] / "beta" / "SKILL.md").read_text() == "beta"
+
+
+class TestTemplatedTargets:
+    """測試以 {home} 樣板展開到多個 home 目錄的 targets"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        (skills_dir / "alpha" / "references").mkdir(parents=True)
+        (skills_dir / "alpha" / "SKILL.md").write_text("alpha")
+        (skills_dir / "alpha" / "references" / "guide.md").write_text("guide")
+        return skills_dir
+
+    @pytest.fixture
+    def config_file(self, tmp_path, skills_dir):
+        """homes 為 tmp_path/home/* 的 config，home 目錄由各測試建立"""
+        (tmp_path / "home").mkdir()
+        (tmp_path / "home" / "not-a-dir").write_text("")
+        config_file = tmp_path / "test.toml"
+        config_file.write_text(
+            f'skills = ["alpha"]\n[sources]\npaths = ["{skills_dir}"]\n'
+            f'[targets.claude]\npath = "{{home}}/.claude/skills"\n'
+            f'homes = "{tmp_path / "home" / "*"}"\nenabled = true\n'
+        )
+        return config_file
+
+    def test_expands_one_target_per_home(self, tmp_path, config_file, capsys):
+        """每個 home 目錄展開成 <target>@<user>"""
+        for user in ("alice", "bob"):
+            (tmp_path / "home" / user).mkdir()
+
+        results = link_skills(config_file)
+
+        assert [result.name for result in results] == ["claude@alice", "claude@bob"]
+        for user in ("alice", "bob"):
+            deployed = tmp_path / "home" / user / ".claude" / "skills" / "alpha" / "SKILL.md"
+            assert deployed.read_text() == "alpha"
+
+    def test_template_without_homes(self, capsys):
+        """樣板 target 沒有設定 homes 時跳過"""
+        targets = {"claude": {"path": "{home}/.claude/skills", "enabled": True}}
+
+        assert deploy.expand_targets(targets) == {}
+        assert "必須設定 homes" in capsys.readouterr().out
+
+    def test_source_files_are_read_once(self, tmp_path, config_file, monkeypatch, capsys):
+        """部署到多個 homes 時每個 source 檔案只計算一次 digest"""
+        for user in ("u1", "u2", "u3", "u4"):
+            (tmp_path / "home" / user).mkdir()
+        calls = []
+        original = deploy.file_digest
+
+        def counting_digest(path):
+            calls.append(path)
+            return original(path)
+
+        monkeypatch.setattr(deploy, "file_digest", counting_digest)
+
+        results = link_skills(config_file, jobs=4)
+
+        assert len(results) == 4
+        assert len(calls) == 2
+
+    @pytest.mark.skipif(not hasattr(os, "geteuid") or os.geteuid() != 0, reason="需要以 root 執行")
+    def test_root_chowns_to_home_owner(self, tmp_path, config_file, capsys):
+        """以 root 執行時部署的項目交給 home 目錄的擁有者"""
+        home = tmp_path / "home" / "alice"
+        home.mkdir()
+        os.chown(home, 4321, 4321)
+
+        link_skills(config_file)
+
+        for path in (
+            home / ".claude",
+            home / ".claude" / "skills",
+            home / ".claude" / "skills" / "alpha" / "references" / "guide.md",
+            home / ".claude" / ".skills.deploy" / "manifest.json",
+        ):
+            assert path.stat().st_uid == 4321
+
+    @pytest.mark.skipif(not hasattr(os, "geteuid") or os.geteuid() != 0, reason="需要以 root 執行")
+    def test_apply_bundle_writes_as_home_owner(self, tmp_path, config_file, monkeypatch, capsys):
+        """apply-bundle 與 deploy 相同，以 home 擁有者的身分寫入 (不依賴事後的 chown)"""
+        home = tmp_path / "home" / "alice"
+        home.mkdir()
+        os.chown(home, 4321, 4321)
+        bundle = tmp_path / "skills.tar"
+        deploy.build_bundle_command([str(config_file), "-o", str(bundle)])
+        monkeypatch.setattr(deploy, "chown_target", lambda result: None)
+
+        deploy.apply_bundle(bundle, config_file)
+
+        skills = home / ".claude" / "skills"
+        for path in (
+            home / ".claude",
+            skills / "alpha" / "references",
+            skills / "alpha" / "references" / "guide.md",
+            home / ".claude" / ".skills.deploy" / "manifest.json",
+        ):
+            assert path.stat().st_uid == 4321
+        assert (skills / "alpha" / "SKILL.md").read_text() == "alpha"
+
+    @pytest.mark.parametrize("link", [".claude", ".claude/skills", ".claude/.skills.deploy/trash"])
+    def test_rejects_symlinked_target(self, tmp_path, config_file, link, capsys):
+        """target 路徑中有 symlink 時拒絕部署，不會清理或寫入 home 之外的檔案"""
+        victim = tmp_path / "victim"
+        (victim / "skills" / "notes").mkdir(parents=True)
+        (victim / "important.txt").write_text("keep")
+        (victim / "skills" / "important.txt").write_text("keep")
+        symlink = tmp_path / "home" / "alice" / link
+        symlink.parent.mkdir(parents=True)
+        symlink.symlink_to(victim, target_is_directory=True)
+
+        results = link_skills(config_file)
+        deploy.wait_for_trash()
+
+        assert "symlink" in results[0].error
+        assert "✗ claude@alice: 拒絕部署" in capsys.readouterr().out
+        assert (victim / "important.txt").read_text() == "keep"
+        assert (victim / "skills" / "important.txt").read_text() == "keep"
+        assert (victim / "skills" / "notes").is_dir()
+        assert not (victim / "alpha").exists()
+        assert not (victim / "skills" / "alpha").exists()
+
+    @pytest.mark.skipif(not hasattr(os, "geteuid") or os.geteuid() != 0, reason="需要以 root 執行")
+    def test_owner_identity_cannot_touch_other_files(self, tmp_path):
+        """以 home 擁有者的身分執行時只能讀取，不能修改其他使用者的檔案"""
+        (tmp_path / "victim").mkdir()
+        (tmp_path / "victim" / "important.txt").write_text("keep")
+
+        with deploy.fs_identity((4321, 4321)):
+            assert (tmp_path / "victim" / "important.txt").read_text() == "keep"
+            with pytest.raises(PermissionError):
+                (tmp_path / "victim" / "important.txt").unlink()
+
+        (tmp_path / "victim" / "important.txt").unlink()
+
+
+class TestPlanCache:
+    """測試 config 編譯後的部署計畫快取"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        (skills_dir / "alpha").mkdir()
+        (skills_dir / "alpha" / "SKILL.md").write_text("alpha")
+        return skills_dir
+
+    @pytest.fixture
+    def config_file(self, make_config):
+        return make_config()
+
+    def _forbid_parsing(self, monkeypatch):
+        def fail(config_path):
+            raise AssertionError("config 不應該被重新解析")
+
+        monkeypatch.setattr(deploy, "load_config", fail)
+
+    def test_cached_plan_skips_parsing(self, config_file, monkeypatch, capsys):
+        """config 沒有變更時不重新解析"""
+        link_skills(config_file)
+        self._forbid_parsing(monkeypatch)
+
+        results = link_skills(config_file)
+
+        assert results[0].count("unchanged") == 1
+
+    def test_touch_keeps_cache(self, config_file, monkeypatch, capsys):
+        """只有 mtime 變更、內容相同時沿用快取"""
+        link_skills(config_file)
+        stat = config_file.stat()
+        os.utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self._forbid_parsing(monkeypatch)
+
+        assert len(link_skills(config_file)) == 1
+
+    def test_edit_recompiles(self, config_file, capsys):
+        """config 內容變更時重新編譯"""
+        link_skills(config_file)
+        config_file.write_text(config_file.read_text().replace("enabled = true", "enabled = false"))
+
+        assert link_skills(config_file) == []
+        assert "沒有啟用的 targets" in capsys.readouterr().out
+
+    def test_validation_messages_survive_cache(self, config_file, make_config, capsys):
+        """快取命中時仍會輸出驗證訊息"""
+        config_file = make_config(target_extra='strategy = "teleport"')
+        for _ in range(2):
+            assert link_skills(config_file) == []
+            assert "未知的 strategy 'teleport'" in capsys.readouterr().out
+
+    def test_dry_run_does_not_write_plan(self, tmp_path, config_file, capsys):
+        """dry-run 不寫入 plan 快取"""
+        link_skills(config_file, dry_run=True)
+
+        assert not (tmp_path / ".deploy-cache" / "plan-test.toml.json").exists()
+
+
+class TestColdStart:
+    """測試 no-op 部署的啟動成本"""
+
+    def test_cached_noop_run_skips_heavy_modules(self, skills_dir, make_config, capsys):
+        """plan 已快取且沒有變更時，deploy 不載入 tomllib、hashlib 與 concurrent.futures"""
+        import subprocess
+
+        (skills_dir / "alpha").mkdir()
+        (skills_dir / "alpha" / "SKILL.md").write_text("alpha")
+        config_file = make_config()
+        link_skills(config_file)
+
+        code = (
+            "import sys, deploy; deploy.main(sys.argv[1:]); "
+            "print(sorted(m for m in ('tomllib', 'hashlib', 'concurrent.futures') "
+            "if m in sys.modules))"
+        )
+        output = subprocess.run(
+            [sys.executable, "-S", "-c", code, str(config_file)],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(deploy.__file__).parent,
+        ).stdout
+
+        assert "1 unchanged" in output
+        assert output.splitlines()[-1] == "[]"
+
+    def test_noop_does_not_rewrite_manifest(self, skills_dir, target_dir, make_config, capsys):
+        """沒有變更時不重寫 manifest"""
+        (skills_dir / "alpha").mkdir()
+        (skills_dir / "alpha" / "SKILL.md").write_text("alpha")
+        config_file = make_config()
+        link_skills(config_file)
+        manifest = target_state_dir(target_dir) / "manifest.json"
+        before = manifest.stat().st_mtime_ns
+        os.utime(manifest, ns=(before - 10**9, before - 10**9))
+
+        link_skills(config_file)
+
+        assert manifest.stat().st_mtime_ns == before - 10**9
+
+
+class TestDryRunDiff:
+    """測試 dry-run 的檔案層級差異"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        (skills_dir / "alpha" / "references").mkdir(parents=True)
+        (skills_dir / "alpha" / "SKILL.md").write_text("alpha")
+        (skills_dir / "alpha" / "references" / "old.md").write_text("old")
+        return skills_dir
+
+    @pytest.fixture
+    def config_file(self, make_config):
+        return make_config()
+
+    def test_reports_added_modified_deleted(self, skills_dir, target_dir, config_file, capsys):
+        """列出每個新增、修改與刪除的檔案與 bytes 合計，且不寫入任何東西"""
+        link_skills(config_file)
+        (skills_dir / "alpha" / "SKILL.md").write_text("alpha v2")
+        (skills_dir / "alpha" / "references" / "old.md").unlink()
+        (skills_dir / "alpha" / "references" / "new.md").write_text("new!")
+        capsys.readouterr()
+
+        results = link_skills(config_file, dry_run=True)
+
+        diff = results[0].skills[0].diff
+        assert diff.added == [("references/new.md", 4)]
+        assert diff.modified == [("SKILL.md", 8)]
+        assert diff.deleted == [("references/old.md", 3)]
+        out = capsys.readouterr().out
+        assert "+ alpha/references/new.md (4 bytes)" in out
+        assert "1 added, 1 modified, 1 deleted (+4 / ~8 / -3 bytes)" in out
+        assert (target_dir / "alpha" / "references" / "old.md").exists()
+
+    def test_identical_target_is_unchanged(self, target_dir, config_file, capsys):
+        """target 已一致時 (即使沒有 manifest) 沒有任何差異"""
+        link_skills(config_file)
+        (target_state_dir(target_dir) / "manifest.json").unlink()
+
+        results = link_skills(config_file, dry_run=True)
+
+        assert results[0].count("unchanged") == 1
+        assert "files:" not in capsys.readouterr().out
+
+    def test_checksum_ignores_metadata_only_changes(self, target_dir, config_file, capsys):
+        """--checksum 時內容相同、只有 mtime 不同的檔案不算修改"""
+        link_skills(config_file)
+        (target_state_dir(target_dir) / "manifest.json").unlink()
+        os.utime(target_dir / "alpha" / "SKILL.md", ns=(0, 0))
+
+        stat_only = link_skills(config_file, dry_run=True)
+        with_checksum = link_skills(config_file, dry_run=True, checksum=True)
+
+        assert stat_only[0].skills[0].diff.modified == [("SKILL.md", 5)]
+        assert not with_checksum[0].skills[0].diff
+
+
+class TestVerify:
+    """測試 deploy verify"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        (skills_dir / "alpha" / "references").mkdir(parents=True)
+        (skills_dir / "alpha" / "SKILL.md").write_text("alpha")
+        (skills_dir / "alpha" / "references" / "guide.md").write_text("guide")
+        return skills_dir
+
+    @pytest.fixture
+    def config_file(self, make_config):
+        """已部署的 config"""
+        config_file = make_config()
+        link_skills(config_file)
+        return config_file
+
+    def test_clean_target_passes(self, config_file, capsys):
+        """部署後未被修改時返回 0"""
+        assert verify_command([str(config_file)]) == 0
+        assert "✓ ide: 1 skills verified" in capsys.readouterr().out
+
+    def test_detects_same_size_edit(self, target_dir, config_file, capsys):
+        """大小相同、內容不同的手動修改會以 digest 比對找出"""
+        (target_dir / "alpha" / "SKILL.md").write_text("ALPHA")
+
+        assert verify_command([str(config_file), "-j", "2"]) == 1
+        out = capsys.readouterr().out
+        assert "✗ ide: drift detected (1 modified)" in out
+        assert "modified: alpha/SKILL.md" in out
+
+    @pytest.mark.parametrize("atomic", [True, False])
+    def test_force_deploy_repairs_drift(self, target_dir, config_file, capsys, atomic):
+        """verify 回報差異後，deploy --force 重新同步，再次 verify 沒有差異"""
+        skill_md = target_dir / "alpha" / "SKILL.md"
+        st = skill_md.stat()
+        skill_md.write_text("ALPHA")
+        os.utime(skill_md, ns=(st.st_atime_ns, st.st_mtime_ns))  # stat 與部署時相同
+        (target_dir / "alpha" / "references" / "guide.md").unlink()
+        (target_dir / "alpha" / "notes.md").write_text("local")
+        assert verify_command([str(config_file), "--checksum"]) == 1
+        assert "deploy --force" in capsys.readouterr().out
+
+        # 沒有 --force 時 manifest 未變更，skill 被跳過
+        assert link_skills(config_file, atomic=atomic)[0].count("unchanged") == 1
+        deploy.main([str(config_file), "--force"] + ([] if atomic else ["--no-atomic"]))
+
+        assert verify_command([str(config_file), "--checksum"]) == 0
+        assert skill_md.read_text() == "alpha"
+
+    def test_metadata_only_change_is_not_drift(self, target_dir, config_file):
+        """只有 mtime 不同、內容相同的檔案不算 drift"""
+        os.utime(target_dir / "alpha" / "SKILL.md", ns=(0, 0))
+
+        assert verify_command([str(config_file)]) == 0
+
+    def test_reports_missing_and_extra(self, target_dir, config_file, capsys):
+        """被刪除與多出來的檔案分別回報"""
+        (target_dir / "alpha" / "references" / "guide.md").unlink()
+        (target_dir / "alpha" / "notes.md").write_text("local")
+
+        assert verify_command([str(config_file)]) == 1
+        out = capsys.readouterr().out
+        assert "missing: alpha/references/guide.md" in out
+        assert "extra: alpha/notes.md" in out
+
+    def test_large_file_is_hashed_with_mmap(self, target_dir, config_file, monkeypatch):
+        """超過門檻的檔案以 mmap 計算 digest，結果與一般讀取相同"""
+        monkeypatch.setattr(deploy, "MMAP_THRESHOLD", 4)
+        (target_dir / "alpha" / "SKILL.md").write_text("ALPHA")
+
+        assert verify_command([str(config_file), "--checksum"]) == 1
+
+    def test_symlink_pointing_elsewhere_is_drift(self, tmp_path, target_dir, make_config, capsys):
+        """symlink 部署被改指向其他位置時回報"""
+        config_file = make_config(target_extra='strategy = "symlink"')
+        link_skills(config_file)
+        (target_dir / "alpha").unlink()
+        (target_dir / "alpha").symlink_to(tmp_path)
+
+        assert verify_command([str(config_file)]) == 1
+        assert "modified: alpha" in capsys.readouterr().out
+
+
+class TestFrontmatter:
+    """測試 SKILL.md frontmatter 的讀取與解析"""
+
+    def test_parses_folded_and_quoted_values(self):
+        """> 區塊以空白連接各行，雙引號與單引號字串去掉引號"""
+        fields = parse_frontmatter(
+            "name: architect\n"
+            "description: >\n"
+            "  Backend system design\n"
+            "  and documentation.\n"
+            'quoted: "Use when: (1) \\"PRD\\""\n'
+            "single: 'it''s'\n"
+        )
+
+        assert fields["name"] == "architect"
+        assert fields["description"] == "Backend system design and documentation."
+        assert fields["quoted"] == 'Use when: (1) "PRD"'
+        assert fields["single"] == "it's"
+
+    def test_literal_block_keeps_newlines(self):
+        """| 區塊保留換行"""
+        fields = parse_frontmatter("description: |\n  line one\n  line two\nname: x\n")
+
+        assert fields == {"description": "line one\nline two", "name": "x"}
+
+    def test_reads_only_until_closing_delimiter(self, tmp_path):
+        """只返回兩行 --- 之間的內容；沒有 frontmatter 時返回空 bytes"""
+        skill_file = tmp_path / "SKILL.md"
+        skill_file.write_text("---\nname: pm\n---\n\n# PM\n---\n")
+        plain_file = tmp_path / "README.md"
+        plain_file.write_text("# no frontmatter\n")
+
+        assert read_frontmatter(skill_file) == b"name: pm\n"
+        assert read_frontmatter(plain_file) == b""
+
+
+class TestCatalog:
+    """測試 deploy list / deploy info 使用的 skill catalog"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        for name, description in (("alpha", "First skill"), ("beta", "Second skill")):
+            (skills_dir / name).mkdir()
+            (skills_dir / name / "SKILL.md").write_text(
+                f"---\nname: {name}\ndescription: {description}\n---\n\n# {name}\n"
+            )
+        (skills_dir / "no-skill-file").mkdir()
+        return skills_dir
+
+    @pytest.fixture
+    def config_file(self, make_config):
+        return make_config()
+
+    def test_list_shows_skills_with_descriptions(self, config_file, capsys):
+        """列出有 SKILL.md 的 skills 與描述，config 中的 skills 以 ● 標示"""
+        assert list_command([str(config_file)]) == 0
+
+        out = capsys.readouterr().out
+        assert "● alpha  First skill" in out
+        assert "● beta   Second skill" in out
+        assert "no-skill-file" not in out
+
+    def test_info_shows_frontmatter_and_source(self, skills_dir, config_file, capsys):
+        """deploy info 顯示名稱、描述與來源；找不到時返回 1"""
+        assert info_command(["beta", str(config_file)]) == 0
+        out = capsys.readouterr().out
+        assert "name:        beta" in out
+        assert f"source:      {skills_dir / 'beta'}" in out
+        assert "  Second skill" in out
+
+        assert info_command(["missing", str(config_file)]) == 1
+
+    def test_works_without_enabled_targets(self, config_file, capsys):
+        """catalog 只需要 sources，所有 targets 都停用時仍可列出與搜尋 skills"""
+        config_file.write_text(config_file.read_text().replace("enabled = true", "enabled = false"))
+
+        assert list_command([str(config_file)]) == 0
+        assert search_command(["second", str(config_file)]) == 0
+        out = capsys.readouterr().out
+        assert "● alpha  First skill" in out
+        assert "beta" in out
+        assert "沒有啟用的 targets" not in out
+
+    def test_invalid_sources_fail(self, tmp_path, capsys):
+        """sources 設定無效時不建立 catalog 並返回 1"""
+        config_file = tmp_path / "no-sources.toml"
+        config_file.write_text('skills = ["alpha"]\n')
+
+        assert list_command([str(config_file)]) == 1
+        assert "sources" in capsys.readouterr().out
+
+    def test_updates_incrementally(self, skills_dir, config_file, monkeypatch, capsys):
+        """只重新讀取 stat 改變的 SKILL.md，刪除的 skill 從 catalog 移除"""
+        list_command([str(config_file)])
+        (skills_dir / "alpha" / "SKILL.md").write_text(
+            "---\nname: alpha\ndescription: Updated skill\n---\n"
+        )
+        (skills_dir / "beta" / "SKILL.md").unlink()
+        capsys.readouterr()
+
+        read = []
+        original = deploy.read_frontmatter
+        monkeypatch.setattr(
+            deploy, "read_frontmatter", lambda path: read.append(path.parent.name) or original(path)
+        )
+        list_command([str(config_file)])
+
+        assert read == ["alpha"]
+        out = capsys.readouterr().out
+        assert "Updated skill" in out
+        assert "beta" not in out
+
+
+class TestSearch:
+    """測試 deploy search 的 FTS5 全文索引"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        documents = {
+            "api-patterns": ("REST API design patterns", "Use pagination for list endpoints."),
+            "database-design": ("Schema design", "Normalize tables; design API access later."),
+            "committer": ("Create git commits", "Write concise commit messages."),
+        }
+        for name, (description, body) in documents.items():
+            (skills_dir / name).mkdir()
+            (skills_dir / name / "SKILL.md").write_text(
+                f"---\nname: {name}\ndescription: {description}\n---\n\n{body}\n"
+            )
+        return skills_dir
+
+    @pytest.fixture
+    def config_file(self, make_config):
+        return make_config()
+
+    def test_ranks_by_bm25(self, config_file, capsys):
+        """名稱與描述中的符合權重高於內文；每個字詞都可比對前綴"""
+        assert search_command(["api design", str(config_file)]) == 0
+
+        out = capsys.readouterr().out
+        assert out.index("api-patterns") < out.index("database-design")
+        assert "committer" not in out
+
+    def test_body_match_shows_snippet(self, config_file, capsys):
+        """只在 SKILL.md 內文中符合時顯示片段"""
+        assert search_command(["paginat", str(config_file)]) == 0
+
+        out = capsys.readouterr().out
+        assert "api-patterns" in out
+        assert "Use [pagination] for list endpoints." in out
+
+    def test_no_results_returns_one(self, config_file, capsys):
+        """沒有符合的 skills 時返回 1；特殊字元不會造成查詢語法錯誤"""
+        assert search_command(['kubernetes "AND (', str(config_file)]) == 1
+
+    def test_reindexes_only_changed_skills(self, skills_dir, config_file, monkeypatch, capsys):
+        """只重新讀取 mtime 改變的 SKILL.md 內文，刪除的 skill 不再出現"""
+        search_command(["design", str(config_file)])
+        (skills_dir / "committer" / "SKILL.md").write_text(
+            "---\nname: committer\ndescription: Git helper\n---\n\nSquash and rebase.\n"
+        )
+        (skills_dir / "database-design" / "SKILL.md").unlink()
+        capsys.readouterr()
+
+        read = []
+        original = deploy.read_skill_body
+        monkeypatch.setattr(
+            deploy, "read_skill_body", lambda path: read.append(path.parent.name) or original(path)
+        )
+
+        assert search_command(["rebase", str(config_file)]) == 0
+        assert read == ["committer"]
+        assert "committer" in capsys.readouterr().out
+        assert search_command(["normalize", str(config_file)]) == 1
+
+
+class TestTokenCost:
+    """測試 deploy cost 的 token 估計與 max_tokens 預算"""
+
+    @pytest.fixture
+    def skills_dir(self, skills_dir):
+        skill = skills_dir / "alpha"
+        (skill / "references").mkdir(parents=True)
+        (skill / "assets").mkdir()
+        (skill / "SKILL.md").write_text("Use this skill carefully.")
+        (skill / "references" / "guide.md").write_text("one two three")
+        (skill / "assets" / "template.txt").write_text("one two three")
+        (skill / "assets" / "logo.png").write_bytes(b"\x89PNG\0\0data")
+        return skills_dir
+
+    @pytest.fixture
+    def config_file(self, make_config):
+        return make_config()
+
+    def test_estimate_tokens(self):
+        """字母每 6 個約 1 個 token、數字每 3 位 1 個、標點各 1 個；二進位檔為 0"""
+        assert estimate_tokens(b"hello world") == 2
+        assert estimate_tokens(b"implementation") == 3
+        assert estimate_tokens(b"12345, ok!") == 5
+        assert estimate_tokens("技能".encode()) == 2
+        assert estimate_tokens(b"\x89PNG\0") == 0
+
+    def test_reports_parts_per_skill_and_target(self, config_file, capsys):
+        """分別列出 SKILL.md、references 與 assets 的 token 數"""
+        assert cost_command([str(config_file)]) == 0
+
+        out = capsys.readouterr().out
+        assert "alpha           6           3           3          12" in out
+        assert "ide: 12 tokens (SKILL.md 6 / references 3 / assets 3)" in out
+
+    def test_reports_without_enabled_targets(self, config_file, capsys):
+        """所有 targets 都停用時仍估計每個 skill 的 token 數"""
+        config_file.write_text(config_file.read_text().replace("enabled = true", "enabled = false"))
+
+        assert cost_command([str(config_file)]) == 0
+        assert "alpha           6           3           3          12" in capsys.readouterr().out
+
+    def test_estimates_are_cached_by_digest(self, config_file, monkeypatch, capsys):
+        """內容相同的檔案只估計一次，再次執行時不需要重新估計"""
+        calls = []
+        original = deploy.estimate_tokens
+        monkeypatch.setattr(
+            deploy, "estimate_tokens", lambda data: calls.append(data) or original(data)
+        )
+
+        cost_command([str(config_file)])
+        assert sorted(calls) == [b"Use this skill carefully.", b"one two three", b"\x89PNG\0\0data"]
+        calls.clear()
+        cost_command([str(config_file)])
+        assert calls == []
+
+    def test_cost_fails_over_budget(self, config_file, make_config, capsys):
+        """估計的 token 數超過 target 的 max_tokens 時返回 1"""
+        config_file = make_config(target_extra="max_tokens = 11")
+
+        assert cost_command([str(config_file)]) == 1
+        assert "✗ ide: 12 tokens" in capsys.readouterr().out
+
+    def test_deploy_skips_over_budget_target(self, target_dir, config_file, make_config, capsys):
+        """超過 max_tokens 的 target 不部署，deploy 以非 0 結束"""
+        config_file = make_config(target_extra="max_tokens = 11")
+
+        with pytest.raises(SystemExit) as exit_info:
+            deploy.main([str(config_file)])
+
+        assert exit_info.value.code == 1
+        assert not target_dir.exists()
+        assert "✗ ide: 估計 12 tokens，超過 max_tokens (11)" in capsys.readouterr().out
+
+    def test_deploy_within_budget(self, target_dir, config_file, make_config):
+        """預算內的 target 正常部署"""
+        config_file = make_config(target_extra="max_tokens = 12")
+
+        results = link_skills(config_file)
+
+        assert not results[0].error
+        assert (target_dir / "alpha" / "SKILL.md").exists()
+
+    def test_rejects_invalid_max_tokens(self, config_file, make_config, capsys):
+        """max_tokens 必須是正整數"""
+        config_file = make_config(target_extra='max_tokens = "lots"')
+
+        assert link_skills(config_file) == []
+        assert "max_tokens 必須是正整數" in capsys.readouterr().out
+
+
+class TestExcludes:
+    """測試 gitignore 格式的 exclude 規則"""
+
+    @pytest.fixture
+    def skill(self, skills_dir):
+        skill = skills_dir / "alpha"
+        (skill / ".git" / "objects").mkdir(parents=True)
+        (skill / ".git" / "HEAD").write_text("ref")
+        (skill / "node_modules" / "pkg").mkdir(parents=True)
+        (skill / "node_modules" / "pkg" / "index.js").write_text("js")
+        (skill / "references" / "drafts").mkdir(parents=True)
+        (skill / "references" / "drafts" / "wip.md").write_text("wip")
+        (skill / "references" / "guide.md").write_text("guide")
+        (skill / "SKILL.md").write_text("alpha")
+        (skill / "cache.pyc").write_bytes(b"pyc")
+        return skill
+
+    def test_compile_excludes(self):
+        """支援 *、**、開頭與結尾的 /、註解與 ! 重新包含 (最後符合的規則為準)"""
+        matcher = compile_excludes(
+            [".git/", "*.pyc", "/build/", "docs/**/*.tmp", "# comment", "!keep.pyc"]
+        )
+
+        assert matcher.match(".git/")
+        assert matcher.match("sub/.git/")
+        assert not matcher.match(".git")  # 結尾的 / 只比對目錄
+        assert matcher.match("lib/cache.pyc")
+        assert not matcher.match("lib/keep.pyc")
+        assert matcher.match("build/")
+        assert not matcher.match("src/build/")
+        assert matcher.match("docs/a/b/x.tmp")
+        assert not matcher.match("SKILL.md")
+        assert compile_excludes(["# only comments", ""]) is None
+        assert compile_excludes(["!keep.md"]) is None
+
+        # 與 gitignore 相同，最後一個符合的規則為準
+        matcher = compile_excludes(["!keep.md", "*.md"])
+        assert matcher.match("keep.md")
+        assert matcher.match("other.md")
+        matcher = compile_excludes(["*.md", "!keep*.md", "keep-not.md"])
+        assert matcher.match("other.md")
+        assert not matcher.match("keep.md")
+        assert matcher.match("keep-not.md")
+
+    def test_excluded_directories_are_not_entered(self, skill, monkeypatch):
+        """符合的目錄不會被 scandir 走進去"""
+        scanned = []
+        original = os.scandir
+        monkeypatch.setattr(
+            os, "scandir", lambda path: scanned.append(Path(path)) or original(path)
+        )
+
+        files = scan_tree(skill, exclude=compile_excludes([".git/", "node_modules/"]))
+
+        assert skill / ".git" not in scanned
+        assert skill / "node_modules" not in scanned
+        assert "references/guide.md" in files
+        assert not any(rel.startswith((".git/", "node_modules/")) for rel in files)
+
+    def test_deploy_applies_global_skill_and_skillignore(self, skill, target_dir, make_config):
+        """config 的 exclude、skill_exclude 與 .skillignore 都會套用，.skillignore 本身不部署"""
+        extra = 'exclude = [".git/", "node_modules/"]\n[skill_exclude]\nalpha = ["drafts/"]\n'
+        config_file = make_config(extra=extra)
+        (skill / ".skillignore").write_text("# 編譯產物\n*.pyc\n")
+
+        link_skills(config_file)
+
+        deployed = sorted(
+            str(path.relative_to(target_dir / "alpha"))
+            for path in (target_dir / "alpha").rglob("*")
+            if path.is_file()
+        )
+        assert deployed == ["SKILL.md", "references/guide.md"]
+
+    def test_new_exclude_removes_deployed_files(self, skill, target_dir, make_config):
+        """加入 exclude 後，已部署的檔案在下次部署時被移除"""
+        config_file = make_config()
+        link_skills(config_file)
+        assert (target_dir / "alpha" / "node_modules" / "pkg" / "index.js").exists()
+
+        (skill / ".skillignore").write_text("node_modules/\n")
+        results = link_skills(config_file)
+
+        assert results[0].count("synced") == 1
+        assert not (target_dir / "alpha" / "node_modules").exists()
+        assert (target_dir / "alpha" / "SKILL.md").exists()
+
+    def test_rejects_invalid_exclude(self, skill, make_config, capsys):
+        """exclude 必須是字串列表"""
+        config_file = make_config(extra='exclude = ".git"\n')
+
+        assert link_skills(config_file) == []
+        assert "exclude 必須是字串列表" in capsys.readouterr().out